@@ -2,9 +2,20 @@
 
 __all__ = [
     "comfy_backend",
+    "comfy_proxy",
     "flux_dev",
     "flux1",
     "kontext",
     "wan2_2",
     "juggernautxl",
+    "downloader",
+    "model_store",
+    "model_catalog",
+    "volume_commits",
+    "prompt_router",
+    "workflow_models",
+    "model_prefetch",
+    "output_offload",
+    "model_runtime",
+    "multi_model",
 ]
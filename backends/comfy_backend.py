@@ -1,10 +1,13 @@
 import modal
+import asyncio
 import os
+from pathlib import Path
 import subprocess
 import time
-from fastapi import FastAPI, Request, Response, HTTPException, BackgroundTasks
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 import httpx
-import shutil
 from fastapi.middleware.cors import CORSMiddleware
 
 comfyui_proc: subprocess.Popen | None = None
@@ -22,20 +25,108 @@ image = (
         "httpx",
         "websockets",
         "python-multipart",
+        "boto3",
     )
     .run_commands("git clone https://github.com/comfyanonymous/ComfyUI /root/ComfyUI")
     .run_commands("cd /root/ComfyUI && pip install -r requirements.txt")
+    # Shared helpers (downloader, ...) from this package
+    .add_local_dir(Path(__file__).resolve().parent, remote_path="/root/backends")
 )
 
+# Job records for queued model downloads, shared by the API and the workers
+download_jobs = modal.Dict.from_name("comfyui-download-jobs", create_if_missing=True)
+# Object keys of the outputs offloaded to R2, by prompt id (see output_offload.py)
+output_records = modal.Dict.from_name("comfyui-output-records", create_if_missing=True)
+# R2 credentials for the output offloader. Only attached when deploying with
+# OUTPUT_OFFLOAD=1, so ComfyUI deploys without a cloudflare-storage secret
+offload_secrets = (
+    [modal.Secret.from_name("cloudflare-storage", required_keys=["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"])]
+    if os.environ.get("OUTPUT_OFFLOAD") == "1"
+    else []
+)
+# Number of downloads that run at the same time (one worker container each)
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", "2"))
+# A running job refreshes heartbeat_at this often; one silent for JOB_STALE_AFTER
+# lost its worker and is reported as failed
+JOB_HEARTBEAT_INTERVAL = 15.0
+JOB_STALE_AFTER = 120.0
+# Finished job records are deleted this long after they finished
+JOB_RECORD_TTL = 7 * 86400
+
 # Standard model subdirectories
 MODEL_SUBDIRS = ["unet", "lora", "loras", "checkpoints", "text_encoders", "vae", "diffusion_models"]
 
+COMFYUI_DIR = "/root/ComfyUI"
+COMFYUI_URL = "http://127.0.0.1:8188"
+
+# Folder links, the startup probe and proxy header filtering come from
+# backends/comfy_proxy.py, shared with scripts/modal/comfy_app.py
+
+
+def create_proxy_app(comfyui_url: str = COMFYUI_URL, offloader=None) -> FastAPI:
+    """FastAPI app forwarding every HTTP call to the ComfyUI server at comfyui_url.
+
+    With an OutputOffloader, finished outputs are also pushed to R2 and
+    GET /outputs/{prompt_id} returns presigned URLs for them.
+    """
+    from backends.comfy_proxy import forwardable_headers
+
+    app = FastAPI()
+    client = httpx.AsyncClient(base_url=comfyui_url, timeout=180)
+
+    @app.on_event("startup")
+    async def start_offloading():
+        if offloader is not None:
+            app.state.offload_watcher = asyncio.create_task(offloader.watch(comfyui_url))
+
+    @app.on_event("shutdown")
+    async def close_client():
+        if offloader is not None:
+            app.state.offload_watcher.cancel()
+        await client.aclose()
+
+    @app.get("/outputs/{prompt_id}")
+    async def offloaded_outputs(prompt_id: str):
+        record = await offloader.urls(prompt_id) if offloader is not None else None
+        if record is None:
+            raise HTTPException(status_code=404, detail="No offloaded outputs for this prompt")
+        return record
+
+    @app.api_route("/{path:path}", methods=["GET","POST","PUT","PATCH","DELETE","OPTIONS","HEAD"])
+    async def proxy(path: str, request: Request):
+        url = f"/{path}"
+        if request.url.query:
+            url += f"?{request.url.query}"
+
+        headers = forwardable_headers(request.headers, drop={"host"})
+        # Only stream a request body when the client actually sent one, so plain
+        # GETs are not turned into chunked uploads.
+        has_body = "content-length" in request.headers or "transfer-encoding" in request.headers
+        upstream_req = client.build_request(
+            method=request.method,
+            url=url,
+            headers=headers,
+            content=request.stream() if has_body else None,
+        )
+        resp = await client.send(upstream_req, stream=True)
+        # Raw bytes keep the upstream Content-Encoding/Content-Length valid
+        return StreamingResponse(
+            resp.aiter_raw(),
+            status_code=resp.status_code,
+            headers=forwardable_headers(resp.headers),
+            background=BackgroundTask(resp.aclose),
+        )
+
+    return app
+
+
 @app.function(
     image=image,
     gpu="A100-40GB",
     cpu=4,
     memory=8192,
     volumes={"/storage": volume},
+    secrets=offload_secrets,
     timeout=3600,
     scaledown_window=120,
     max_containers=1,
@@ -43,37 +134,30 @@ MODEL_SUBDIRS = ["unet", "lora", "loras", "checkpoints", "text_encoders", "vae",
 )
 @modal.asgi_app()
 def comfyui_backend():
-    import fastapi
-    app = fastapi.FastAPI()
+    from backends.output_offload import output_offloader
+
+    # 1. All HTTP calls are proxied to the ComfyUI backend (see create_proxy_app)
+    app = create_proxy_app(offloader=output_offloader(output_records))
 
     # Download endpoint removed – use separate model_downloader service
     # 2. Startup: Mount storage and launch ComfyUI Python API backend process
     @app.on_event("startup")
-    def launch_comfyui():
-        os.makedirs("/storage/models", exist_ok=True)
-        for sub in MODEL_SUBDIRS:
-            sub_path = f"/storage/models/{sub}"
-            try:
-                os.makedirs(sub_path, exist_ok=True)
-            except FileExistsError:
-                # Directory may appear concurrently in another container
-                pass
-        os.makedirs("/storage/custom_nodes", exist_ok=True)
-        os.makedirs("/storage/output", exist_ok=True)
-        os.makedirs("/storage/input", exist_ok=True)
-        os.chdir("/root/ComfyUI")
-
-        # Replace UI folders with symlinks to persistent volume
-        for folder in ["models", "custom_nodes", "output", "input"]:
-            if os.path.exists(folder) or os.path.islink(folder):
-                try:
-                    if os.path.islink(folder) or os.path.isfile(folder):
-                        os.unlink(folder)
-                    else:
-                        shutil.rmtree(folder)
-                except Exception:
-                    pass
-            os.symlink(f"/storage/{folder}", folder)
+    async def launch_comfyui():
+        from backends.comfy_proxy import (
+            BOOT_FOLDERS,
+            LAUNCH_FOLDERS,
+            ensure_dir,
+            link_storage_folders,
+            wait_for_comfyui,
+        )
+        from backends.model_prefetch import start_prefetch
+
+        # Pull the hot model files into the page cache while ComfyUI boots;
+        # it logs its own per-file report and never holds up readiness
+        start_prefetch()
+        # Replace UI folders with symlinks to persistent volume; only custom_nodes
+        # is read at import time, so only it has to be linked before launch
+        await link_storage_folders(LAUNCH_FOLDERS, comfyui_dir=COMFYUI_DIR)
         # Launch ComfyUI server (API only)
         # --disable-security: authenticates UI on trusted internal calls
         # --listen: restricts to localhost inside container
@@ -84,54 +168,138 @@ def comfyui_backend():
             "--listen", "0.0.0.0",
             "--port", "8188",
             "--enable-cors-header", "*",
-        ])
-        # Optionally wait for API readiness
-        for _ in range(60):
-            try:
-                import urllib.request
-                with urllib.request.urlopen("http://127.0.0.1:8188/") as r:
-                    if r.status == 200:
-                        return
-            except Exception:
-                time.sleep(1)
-        raise RuntimeError("ComfyUI failed to start in 60s.")
+        ], cwd=COMFYUI_DIR)
+        # The other folders and the model subdirectories are not needed until a
+        # request touches them, so set them up while ComfyUI boots.
+        prep = asyncio.gather(
+            link_storage_folders(BOOT_FOLDERS, comfyui_dir=COMFYUI_DIR),
+            *(asyncio.to_thread(ensure_dir, f"/storage/models/{sub}") for sub in MODEL_SUBDIRS),
+        )
+        try:
+            await wait_for_comfyui(comfyui_proc, COMFYUI_URL)
+        finally:
+            await prep
 
     @app.on_event("shutdown")
     async def stop_comfyui():
+        import logging
+
+        from backends.model_prefetch import remember_usage
+
         global comfyui_proc
         if comfyui_proc:
+            try:
+                # ComfyUI's history dies with the process; keep which models it loaded
+                await remember_usage(COMFYUI_URL)
+                await volume.commit.aio()
+            except Exception as e:
+                logging.warning("Could not record model usage: %r", e)
             comfyui_proc.terminate()
             comfyui_proc.wait()
-        await client.aclose()
 
-    # 3. Proxy all HTTP (and optionally WebSocket) calls to ComfyUI backend
-    client = httpx.AsyncClient(base_url="http://127.0.0.1:8188", timeout=180)
+    return app
 
-    @app.api_route("/{path:path}", methods=["GET","POST","PUT","PATCH","DELETE","OPTIONS","HEAD"])
-    async def proxy(path: str, request: Request):
-        url = f"/{path}"
-        if request.url.query:
-            url += f"?{request.url.query}"
 
-        headers = {k: v for k, v in request.headers.items() if k.lower() not in {"host"}}
-        data = await request.body()
-        resp = await client.request(
-            method=request.method,
-            url=url,
-            headers=headers,
-            content=data if data else None,
-        )
-        return Response(
-            content=resp.content,
-            status_code=resp.status_code,
-            headers=dict(resp.headers),
-            media_type=resp.headers.get("content-type", "application/octet-stream"),
-        )
+# -------------------- CPU-only prompt router --------------------
+# Spreads prompts over several GPU workers (e.g. separate comfyui_backend
+# deployments, each a single container) by model affinity. Set
+# COMFYUI_WORKER_URLS to their comma-separated base URLs when deploying.
+@app.function(
+    image=image,
+    cpu=1,
+    memory=1024,
+    timeout=3600,
+    scaledown_window=300,
+    # Placement state lives in memory, so there is exactly one router
+    max_containers=1,
+    min_containers=0,
+    secrets=[modal.Secret.from_dict({"COMFYUI_WORKER_URLS": os.environ.get("COMFYUI_WORKER_URLS", "")})],
+)
+@modal.asgi_app()
+def prompt_router():
+    from backends.prompt_router import create_router_app
 
-    return app
+    urls = [u.strip() for u in os.environ["COMFYUI_WORKER_URLS"].split(",") if u.strip()]
+    return create_router_app(urls)
 
 
 # -------------------- CPU-only model downloader --------------------
+@app.function(
+    image=image,
+    volumes={"/storage": volume},
+    cpu=2,
+    memory=4096,
+    timeout=6 * 3600,
+    max_containers=DOWNLOAD_CONCURRENCY,
+    min_containers=0,
+)
+def run_download_job(
+    job_id: str, url: str, filename: str, subdirs: list, sha256: str | None = None, refresh: bool = False
+) -> dict:
+    """Worker for a queued /download job; publishes progress to download_jobs."""
+    import logging
+    import threading
+    from backends.downloader import ProgressTracker
+    from backends.model_catalog import ModelCatalog
+    from backends.model_store import ModelStore
+    from backends.volume_commits import scheduler_for
+
+    job = download_jobs[job_id]
+    # Progress and heartbeats come from different threads
+    lock = threading.Lock()
+
+    def publish(snapshot: dict):
+        with lock:
+            job.update(snapshot, heartbeat_at=time.time())
+            download_jobs[job_id] = job
+
+    publish({"status": "running", "started_at": time.time(), "error": None, "finished_at": None})
+    # Progress only moves while bytes arrive; the heartbeat shows the worker
+    # is alive through retries, hashing and linking too
+    stopped = threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(JOB_HEARTBEAT_INTERVAL):
+            try:
+                publish({})
+            except Exception as e:
+                logging.warning("Heartbeat for job %s failed: %s", job_id, e)
+
+    threading.Thread(target=heartbeat, name="job-heartbeat", daemon=True).start()
+    tracker = ProgressTracker(publish)
+    try:
+        # Ranged parallel download into the blob store; a retried job resumes
+        # from the volume and a known hash or url skips the network entirely
+        # (the url only when not refreshing)
+        store = ModelStore(catalog=ModelCatalog())
+        result = store.ingest(url, filename, subdirs, sha256=sha256, refresh=refresh, progress=tracker)
+        # The one commit per job: it has to land before the client is told the
+        # job completed, and the worker may be gone by the time a debounced
+        # commit would run
+        commits = scheduler_for(volume)
+        commits.mark_dirty(0 if result["cached"] else result["size"])
+        commits.flush()
+    except Exception as e:
+        stopped.set()
+        logging.error("Failed to download %s: %s", url, e)
+        publish({**tracker.snapshot(), "status": "failed", "error": str(e), "finished_at": time.time()})
+        raise
+    stopped.set()
+    publish(dict(
+        tracker.snapshot(),
+        status="completed",
+        bytes_done=result["size"],
+        total_bytes=result["size"],
+        throughput=result["throughput"] or 0.0,
+        eta_seconds=0,
+        sha256=result["sha256"],
+        paths=result["paths"],
+        cached=result["cached"],
+        finished_at=time.time(),
+    ))
+    return job
+
+
 @app.function(
     image=image,
     volumes={"/storage": volume},
@@ -144,45 +312,98 @@ def comfyui_backend():
 )
 @modal.asgi_app()
 def model_downloader():
-    import fastapi, os, requests, shutil, logging
+    import fastapi, uuid
     app = fastapi.FastAPI()
     # CORS so the ComfyUI frontend (different origin) can call this service
     app.add_middleware(
         CORSMiddleware,
         allow_origins=["*"],
-        allow_methods=["POST", "OPTIONS"],
+        allow_methods=["GET", "POST", "OPTIONS"],
         allow_headers=["*"],
     )
 
+    def current(job: dict, now: float) -> dict:
+        """The job as clients should see it: a running job whose worker went quiet has failed."""
+        if job["status"] == "running" and now - job.get("heartbeat_at", job.get("started_at", now)) > JOB_STALE_AFTER:
+            return {
+                **job,
+                "status": "failed",
+                "error": "Worker stopped sending heartbeats",
+                "finished_at": job.get("heartbeat_at", job["started_at"]),
+            }
+        return job
+
+    async def forget(job_id: str):
+        try:
+            await download_jobs.pop.aio(job_id)
+        except KeyError:
+            pass
+
+    async def live_jobs() -> list:
+        """All job records, after marking stale ones failed and deleting expired ones."""
+        now = time.time()
+        jobs = []
+        async for job_id, job in download_jobs.items.aio():
+            job = current(job, now)
+            if job.get("finished_at") and now - job["finished_at"] > JOB_RECORD_TTL:
+                await forget(job_id)
+                continue
+            jobs.append(job)
+        return jobs
+
     @app.post("/download")
     async def download_model(request: fastapi.Request):
         body = await request.json()
         url = body.get("url")
         filename = body.get("filename")
+        # A single subdir or a list; the file is stored once and linked into each
         subdir = body.get("subdir", "text_encoders")
+        subdirs = [subdir] if isinstance(subdir, str) else list(subdir)
+        sha256 = body.get("sha256")
+        # Fetch a url again even if it was downloaded before
+        refresh = bool(body.get("refresh", False))
         if not url or not filename:
             raise fastapi.HTTPException(status_code=400, detail="url and filename are required.")
-        if subdir not in MODEL_SUBDIRS:
+        if not subdirs or any(s not in MODEL_SUBDIRS for s in subdirs):
             raise fastapi.HTTPException(status_code=400, detail=f"Invalid subdir. Must be one of {MODEL_SUBDIRS}.")
-        full_dir = f"/storage/models/{subdir}"
-        os.makedirs(full_dir, exist_ok=True)
-        file_path = f"{full_dir}/{filename}"
 
-        def download_and_commit():
-            try:
-                r = requests.get(url, stream=True, timeout=60)
-                r.raise_for_status()
-                with open(file_path, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                volume.commit()
-            except requests.RequestException as e:
-                logging.error("Failed to download %s: %s", url, e)
-                raise fastapi.HTTPException(status_code=500, detail=f"Failed to download model: {e}")
-
-        download_and_commit()
-        return {"status": "downloaded", "path": file_path}
+        # Queue the transfer on the worker pool instead of holding this request open
+        job_id = uuid.uuid4().hex
+        job = {
+            "id": job_id,
+            "url": url,
+            "filename": filename,
+            "subdirs": subdirs,
+            "sha256": sha256,
+            "refresh": refresh,
+            "paths": [f"/storage/models/{s}/{filename}" for s in subdirs],
+            "status": "queued",
+            "bytes_done": 0,
+            "total_bytes": None,
+            "throughput": 0.0,
+            "eta_seconds": None,
+            "error": None,
+            "created_at": time.time(),
+        }
+        # Expire old records while we are here; downloads are infrequent
+        await live_jobs()
+        await download_jobs.put.aio(job_id, job)
+        await run_download_job.spawn.aio(job_id, url, filename, subdirs, sha256, refresh)
+        return job
+
+    @app.get("/jobs")
+    async def list_jobs(status: str | None = None):
+        jobs = await live_jobs()
+        if status:
+            jobs = [job for job in jobs if job["status"] == status]
+        return sorted(jobs, key=lambda job: job["created_at"], reverse=True)
+
+    @app.get("/jobs/{job_id}")
+    async def get_job(job_id: str):
+        job = await download_jobs.get.aio(job_id)
+        if job is None:
+            raise fastapi.HTTPException(status_code=404, detail=f"Unknown job {job_id}.")
+        return current(job, time.time())
 
     return app
 
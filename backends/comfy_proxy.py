@@ -0,0 +1,104 @@
+"""Helpers shared by the ComfyUI launchers.
+
+``scripts/modal/comfy_app.py`` and ``backends/comfy_backend.py`` both run
+ComfyUI against the shared volume and put a FastAPI proxy in front of it. The
+folder linking, the startup probe and the header filtering live here, so the
+two apps behave the same. The apps import this module inside their functions:
+at deploy time only the container has ``backends`` on its path.
+"""
+import asyncio
+import os
+import shutil
+import subprocess
+import time
+from typing import Dict, Iterable
+
+COMFYUI_DIR = "/root/ComfyUI"
+COMFYUI_URL = "http://127.0.0.1:8188"
+COMFYUI_STARTUP_TIMEOUT = 60.0
+STORAGE_ROOT = "/storage"
+# ComfyUI folders that are replaced by symlinks into the persistent volume.
+# Custom nodes are imported at launch, so that link must exist beforehand; the
+# rest are only read per request and can be linked while ComfyUI boots.
+LAUNCH_FOLDERS = ["custom_nodes"]
+BOOT_FOLDERS = ["models", "output", "input"]
+STORAGE_FOLDERS = LAUNCH_FOLDERS + BOOT_FOLDERS
+
+# Headers that only apply to a single connection and must not be forwarded (RFC 7230 §6.1)
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+}
+
+
+def ensure_dir(path: str):
+    try:
+        os.makedirs(path, exist_ok=True)
+    except FileExistsError:
+        # Directory may appear concurrently in another container
+        pass
+
+
+def link_storage_folder(folder: str, comfyui_dir: str = COMFYUI_DIR, storage_root: str = STORAGE_ROOT):
+    """Point ComfyUI's local folder at its counterpart on the volume."""
+    target = os.path.join(storage_root, folder)
+    ensure_dir(target)
+    local_path = os.path.join(comfyui_dir, folder)
+    for attempt in range(3):
+        if os.path.islink(local_path) or os.path.isfile(local_path):
+            os.unlink(local_path)
+        elif os.path.isdir(local_path):
+            shutil.rmtree(local_path, ignore_errors=True)
+        try:
+            os.symlink(target, local_path)
+            return
+        except FileExistsError:
+            # A booting ComfyUI may create the folder between the two steps
+            if attempt == 2:
+                raise
+
+
+async def link_storage_folders(folders: Iterable[str] = STORAGE_FOLDERS, comfyui_dir: str = COMFYUI_DIR):
+    # Each folder swap touches a different path, so they can run concurrently
+    await asyncio.gather(*(asyncio.to_thread(link_storage_folder, f, comfyui_dir) for f in folders))
+
+
+async def wait_for_comfyui(
+    process: subprocess.Popen, url: str = COMFYUI_URL, timeout: float = COMFYUI_STARTUP_TIMEOUT
+) -> float:
+    """Probe ComfyUI with a tight backoff until it answers; return seconds waited."""
+    import httpx
+
+    start = time.monotonic()
+    delay = 0.02
+    async with httpx.AsyncClient(timeout=2.0) as client:
+        while time.monotonic() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"ComfyUI exited with code {process.returncode} during startup")
+            try:
+                response = await client.get(f"{url}/")
+                if response.status_code == 200:
+                    return time.monotonic() - start
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.25)
+    raise RuntimeError(f"ComfyUI failed to start within {timeout:.0f} seconds")
+
+
+def forwardable_headers(headers, drop=()) -> Dict[str, str]:
+    """Strip hop-by-hop headers, including any named in the Connection header."""
+    connection_tokens = {
+        token.strip().lower()
+        for token in headers.get("connection", "").split(",")
+        if token.strip()
+    }
+    excluded = HOP_BY_HOP_HEADERS | connection_tokens | {h.lower() for h in drop}
+    return {k: v for k, v in headers.items() if k.lower() not in excluded}
@@ -0,0 +1,366 @@
+"""Parallel HTTP Range downloader with resumable sidecar state.
+
+Large model files are split into parts that are fetched over several
+connections and written in place into a preallocated ``<dest>.part`` file.
+Progress is recorded in ``<dest>.download.json`` so an interrupted transfer
+picks up where it stopped. Servers without Range support fall back to a
+single streamed GET.
+
+With ``hash_sha256=True`` the file is hashed while it downloads: a reader
+thread follows the contiguous prefix of completed bytes, so the digest is
+ready moments after the last part lands instead of needing a second pass.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONNECTIONS = 8
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_RETRIES = 5
+PARTIAL_SUFFIX = ".part"
+STATE_SUFFIX = ".download.json"
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+# How often in-flight part offsets are written to the sidecar state file
+STATE_FLUSH_INTERVAL = 2.0
+
+ProgressCallback = Callable[[int, Optional[int]], None]
+
+
+@dataclass
+class DownloadResult:
+    path: str
+    size: int
+    ranged: bool
+    resumed_bytes: int
+    seconds: float
+    sha256: Optional[str] = None
+
+    @property
+    def throughput(self) -> float:
+        """Average transfer rate in bytes per second, excluding resumed bytes."""
+        transferred = self.size - self.resumed_bytes
+        return transferred / self.seconds if self.seconds > 0 else 0.0
+
+
+class ProgressTracker:
+    """Progress callback that derives throughput and ETA and publishes snapshots.
+
+    ``download`` calls it from several worker threads; ``publish`` receives a
+    snapshot dict at most once per ``interval`` seconds, outside the lock.
+    """
+
+    def __init__(self, publish: Callable[[Dict], None], interval: float = 1.0):
+        self.publish = publish
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.bytes_done = 0
+        self.total_bytes: Optional[int] = None
+        self._start: Optional[float] = None
+        self._start_bytes = 0
+        self._last_publish = 0.0
+
+    def __call__(self, bytes_done: int, total: Optional[int]):
+        now = time.monotonic()
+        with self.lock:
+            if self._start is None:
+                # Bytes already on disk from a previous attempt don't count towards throughput
+                self._start, self._start_bytes = now, bytes_done
+            self.bytes_done, self.total_bytes = bytes_done, total
+            due = now - self._last_publish >= self.interval
+            if due:
+                self._last_publish = now
+                snapshot = self.snapshot()
+        if due:
+            self.publish(snapshot)
+
+    def snapshot(self) -> Dict:
+        elapsed = time.monotonic() - self._start if self._start is not None else 0.0
+        throughput = (self.bytes_done - self._start_bytes) / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total_bytes and throughput > 0:
+            eta = max(self.total_bytes - self.bytes_done, 0) / throughput
+        return {
+            "bytes_done": self.bytes_done,
+            "total_bytes": self.total_bytes,
+            "throughput": throughput,
+            "eta_seconds": eta,
+        }
+
+
+def probe(session: requests.Session, url: str, timeout: float = 60) -> Tuple[Optional[int], bool, Optional[str]]:
+    """Return (size, accepts_ranges, validator) for url.
+
+    A one-byte ranged GET is used instead of HEAD because several model hosts
+    answer HEAD with a redirect or without a Content-Length.
+    """
+    r = session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=timeout)
+    try:
+        r.raise_for_status()
+        validator = r.headers.get("ETag") or r.headers.get("Last-Modified")
+        if r.status_code == 206:
+            content_range = r.headers.get("Content-Range", "")
+            total = content_range.rpartition("/")[2]
+            if total.isdigit():
+                return int(total), True, validator
+        length = r.headers.get("Content-Length")
+        return (int(length) if length and length.isdigit() else None), False, validator
+    finally:
+        r.close()
+
+
+def _split(size: int, part_size: int) -> list:
+    return [[start, min(start + part_size, size) - 1] for start in range(0, size, part_size)]
+
+
+class _RangedTransfer:
+    """Shared state for the workers of one ranged download."""
+
+    def __init__(self, url, tmp_path, state_path, state, session, chunk_size, retries, timeout, progress):
+        self.url = url
+        self.tmp_path = tmp_path
+        self.state_path = state_path
+        self.state = state
+        self.session = session
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.failed = threading.Event()
+        self.bytes_done = sum(state["done"])
+        self.last_flush = time.monotonic()
+        self._first_open_part = 0
+
+    def flush_state(self, force: bool = False):
+        # Caller holds self.lock
+        now = time.monotonic()
+        if not force and now - self.last_flush < STATE_FLUSH_INTERVAL:
+            return
+        tmp = f"{self.state_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.state_path)
+        self.last_flush = now
+
+    def fetch_part(self, index: int):
+        start, end = self.state["parts"][index]
+        attempt = 0
+        fd = os.open(self.tmp_path, os.O_WRONLY)
+        try:
+            while True:
+                offset = start + self.state["done"][index]
+                if offset > end:
+                    return
+                try:
+                    headers = {"Range": f"bytes={offset}-{end}"}
+                    with self.session.get(self.url, headers=headers, stream=True, timeout=self.timeout) as r:
+                        r.raise_for_status()
+                        if r.status_code != 206:
+                            raise requests.HTTPError(f"Server ignored Range request (status {r.status_code})")
+                        for chunk in r.iter_content(chunk_size=self.chunk_size):
+                            if not chunk:
+                                continue
+                            os.pwrite(fd, chunk, offset)
+                            offset += len(chunk)
+                            with self.changed:
+                                self.state["done"][index] += len(chunk)
+                                self.bytes_done += len(chunk)
+                                self.flush_state()
+                                self.changed.notify_all()
+                            if self.progress:
+                                self.progress(self.bytes_done, self.state["size"])
+                    if start + self.state["done"][index] <= end:
+                        raise requests.ConnectionError(f"Connection closed early for part {index}")
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                    attempt += 1
+                    if attempt > self.retries:
+                        raise
+                    logger.warning("Part %d of %s interrupted (%s), retry %d/%d", index, self.url, e, attempt, self.retries)
+                    time.sleep(min(2 ** attempt * 0.25, 8))
+        finally:
+            os.close(fd)
+
+    def contiguous_bytes(self) -> int:
+        """Length of the fully written prefix of the file; caller holds self.lock."""
+        parts, done = self.state["parts"], self.state["done"]
+        while self._first_open_part < len(parts):
+            start, end = parts[self._first_open_part]
+            if start + done[self._first_open_part] <= end:
+                return start + done[self._first_open_part]
+            self._first_open_part += 1
+        return self.state["size"]
+
+    def hash_in_order(self, hasher) -> bool:
+        """Feed hasher from the start of the file as the written prefix grows.
+
+        Returns False if the transfer failed before the whole file was hashed.
+        """
+        size = self.state["size"]
+        hashed = 0
+        fd = os.open(self.tmp_path, os.O_RDONLY)
+        try:
+            while hashed < size:
+                with self.changed:
+                    self.changed.wait_for(lambda: self.failed.is_set() or self.contiguous_bytes() > hashed)
+                    if self.failed.is_set():
+                        return False
+                    limit = self.contiguous_bytes()
+                while hashed < limit:
+                    block = os.pread(fd, min(HASH_BLOCK_SIZE, limit - hashed), hashed)
+                    hasher.update(block)
+                    hashed += len(block)
+            return True
+        finally:
+            os.close(fd)
+
+    def abort(self):
+        with self.changed:
+            self.failed.set()
+            self.changed.notify_all()
+
+
+def _load_state(state_path: str, tmp_path: str, url: str, size: int, validator: Optional[str], part_size: int) -> Optional[Dict]:
+    if not (os.path.exists(state_path) and os.path.exists(tmp_path)):
+        return None
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("url") != url or state.get("size") != size or state.get("validator") != validator:
+        logger.info("Discarding stale partial download for %s", url)
+        return None
+    if state.get("part_size") != part_size or os.path.getsize(tmp_path) != size:
+        return None
+    return state
+
+
+def _preallocate(path: str, size: int):
+    with open(path, "wb") as f:
+        f.truncate(size)
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except (AttributeError, OSError):
+            # Not every filesystem (or platform) supports fallocate; the sparse
+            # file from truncate() is good enough for positional writes.
+            pass
+
+
+def _stream_single(session, url, tmp_path, chunk_size, timeout, progress, hasher=None) -> int:
+    written = 0
+    with session.get(url, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        total = r.headers.get("Content-Length")
+        total = int(total) if total and total.isdigit() else None
+        with open(tmp_path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    f.write(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    written += len(chunk)
+                    if progress:
+                        progress(written, total)
+    if total is not None and written != total:
+        raise requests.ConnectionError(f"Expected {total} bytes from {url}, got {written}")
+    return written
+
+
+def download(
+    url: str,
+    dest: str,
+    connections: int = DEFAULT_CONNECTIONS,
+    part_size: int = DEFAULT_PART_SIZE,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    retries: int = DEFAULT_RETRIES,
+    timeout: float = 60,
+    progress: Optional[ProgressCallback] = None,
+    session: Optional[requests.Session] = None,
+    hash_sha256: bool = False,
+) -> DownloadResult:
+    """Download url to dest, resuming a previous partial transfer when possible.
+
+    Raises the underlying ``requests`` exception when the transfer fails after
+    ``retries`` reconnects; the partial file and state are kept for the next call.
+    """
+    t0 = time.perf_counter()
+    own_session = session is None
+    if own_session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(connections, 1))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+    tmp_path = dest + PARTIAL_SUFFIX
+    state_path = dest + STATE_SUFFIX
+    hasher = hashlib.sha256() if hash_sha256 else None
+    try:
+        size, ranged, validator = probe(session, url, timeout=timeout)
+        if not ranged or not size:
+            logger.info("Range requests unsupported for %s, using a single stream", url)
+            size = _stream_single(session, url, tmp_path, chunk_size, timeout, progress, hasher)
+            os.replace(tmp_path, dest)
+            digest = hasher.hexdigest() if hasher else None
+            return DownloadResult(dest, size, False, 0, time.perf_counter() - t0, digest)
+
+        state = _load_state(state_path, tmp_path, url, size, validator, part_size)
+        if state is None:
+            parts = _split(size, part_size)
+            state = {
+                "url": url,
+                "size": size,
+                "validator": validator,
+                "part_size": part_size,
+                "parts": parts,
+                "done": [0] * len(parts),
+            }
+            _preallocate(tmp_path, size)
+        resumed = sum(state["done"])
+        if resumed:
+            logger.info("Resuming %s at %d/%d bytes", url, resumed, size)
+
+        transfer = _RangedTransfer(url, tmp_path, state_path, state, session, chunk_size, retries, timeout, progress)
+        with transfer.lock:
+            transfer.flush_state(force=True)
+        pending = [i for i, (start, end) in enumerate(state["parts"]) if start + state["done"][i] <= end]
+        hash_thread = None
+        if hasher is not None:
+            hash_thread = threading.Thread(target=transfer.hash_in_order, args=(hasher,), daemon=True)
+            hash_thread.start()
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, min(connections, len(pending) or 1))) as pool:
+                futures = [pool.submit(transfer.fetch_part, i) for i in pending]
+                done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+                # Stop queued parts after the first failure; they resume next time
+                for future in not_done:
+                    future.cancel()
+                for future in done:
+                    future.result()
+        except BaseException:
+            transfer.abort()
+            raise
+        finally:
+            with transfer.lock:
+                transfer.flush_state(force=True)
+            if hash_thread is not None:
+                hash_thread.join()
+
+        os.replace(tmp_path, dest)
+        os.remove(state_path)
+        digest = hasher.hexdigest() if hasher else None
+        return DownloadResult(dest, size, True, resumed, time.perf_counter() - t0, digest)
+    finally:
+        if own_session:
+            session.close()
@@ -1,10 +1,54 @@
-"""Placeholder backend for juggernautxl model."""
+"""Juggernaut XL (SDXL) text-to-image backend.
+
+``make_backend()`` returns the ``ModelBackend`` that ``multi_model`` hosts in its
+``ModelRuntime``; the ``JuggernautXL`` class below serves the same model on its own GPU.
+"""
+from pathlib import Path
+from typing import Optional
+
 import modal
 
+MODEL_ID = "RunDiffusion/Juggernaut-XL-v9"
+
 app = modal.App("juggernautxl-backend")
-image = modal.Image.debian_slim(python_version="3.10")
+hf_cache = modal.Volume.from_name("hf-hub-cache", create_if_missing=True)
+image = (
+    modal.Image.debian_slim(python_version="3.10")
+    .pip_install(
+        "torch==2.7.0",
+        "diffusers==0.33.1",
+        "transformers==4.51.3",
+        "accelerate==1.6.0",
+        "huggingface-hub[hf_transfer]==0.30.2",
+        "safetensors==0.5.3",
+    )
+    .env({"HF_HUB_ENABLE_HF_TRANSFER": "1", "HF_HUB_CACHE": "/cache"})
+    .add_local_dir(Path(__file__).resolve().parent, remote_path="/root/backends")
+)
+
+
+def make_backend():
+    # Imported here: at deploy time only the container has backends on its path
+    from backends.model_runtime import DiffusersBackend
+
+    return DiffusersBackend(
+        "juggernautxl", "StableDiffusionXLPipeline", MODEL_ID, dtype="float16", steps=30, guidance_scale=6.0
+    )
+
+
+@app.cls(
+    image=image,
+    gpu="A10G",
+    volumes={"/cache": hf_cache},
+    timeout=600,
+    scaledown_window=300,
+)
+class JuggernautXL:
+    @modal.enter()
+    def load(self):
+        self.backend = make_backend()
+        self.pipe = self.backend.load().to("cuda")
 
-@app.function(image=image, timeout=600)
-def generate(prompt: str) -> dict:
-    """Stub generation endpoint for juggernautxl."""
-    return {"model": "juggernautxl", "prompt": prompt, "status": "not implemented"}
+    @modal.method()
+    def generate(self, prompt: str, seed: Optional[int] = None) -> dict:
+        return self.backend.generate(self.pipe, {"prompt": prompt, "seed": seed})
@@ -0,0 +1,201 @@
+"""Persistent model catalog kept on the shared volume.
+
+The catalog is a compact JSON snapshot (``index.json``) plus a journal of
+small update files. Download paths append a journal file per change, so
+writers in different containers never rewrite the same file and can commit
+the volume independently. Readers merge the snapshot with the journal and
+fold the journal back into the snapshot once it grows past a threshold.
+"""
+import json
+import os
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional
+
+CATALOG_ROOT = "/storage/catalog"
+MODELS_ROOT = "/storage/models"
+# Number of journal files after which readers rewrite the snapshot
+COMPACT_AFTER = 64
+# In-progress download and link artifacts that are not models
+TRANSIENT_SUFFIXES = (".part", ".download.json", ".tmp", ".link")
+
+
+def _key(subdir: str, name: str) -> str:
+    return f"{subdir}/{name}"
+
+
+class ModelCatalog:
+    def __init__(self, root: str = CATALOG_ROOT, models_root: str = MODELS_ROOT):
+        self.root = root
+        self.models_root = models_root
+        self.index_path = os.path.join(root, "index.json")
+        self.journal_dir = os.path.join(root, "journal")
+        self._entries: Optional[Dict[str, Dict]] = None
+        self._sorted_keys: List[str] = []
+        self._loaded_version = None
+        self._merged_journal: List[str] = []
+
+    # -- writers -----------------------------------------------------------
+
+    def _append(self, ops: List[Dict]):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        # Time-ordered, collision-free names keep concurrent writers apart
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex}.json"
+        path = os.path.join(self.journal_dir, name)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(ops, f)
+        os.replace(f"{path}.tmp", path)
+
+    def record(self, subdir: str, name: str, sha256: Optional[str] = None):
+        """Record models/<subdir>/<name> from its current size and mtime."""
+        self.record_many([(subdir, name)], sha256=sha256)
+
+    def record_many(self, items: Iterable, sha256: Optional[str] = None):
+        ops = []
+        for subdir, name in items:
+            st = os.stat(os.path.join(self.models_root, subdir, name))
+            ops.append({
+                "op": "put",
+                "entry": {
+                    "name": name,
+                    "subdir": subdir,
+                    "size": st.st_size,
+                    "mtime": st.st_mtime,
+                    "sha256": sha256,
+                },
+            })
+        if ops:
+            self._append(ops)
+
+    def remove(self, subdir: str, name: str):
+        self._append([{"op": "delete", "subdir": subdir, "name": name}])
+
+    # -- readers -----------------------------------------------------------
+
+    def _journal_files(self) -> List[str]:
+        try:
+            return sorted(f for f in os.listdir(self.journal_dir) if f.endswith(".json"))
+        except FileNotFoundError:
+            return []
+
+    def _version(self, journal: List[str]):
+        try:
+            index_mtime = os.stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            index_mtime = None
+        return index_mtime, tuple(journal)
+
+    def _load(self):
+        journal = self._journal_files()
+        version = self._version(journal)
+        if self._entries is not None and version == self._loaded_version:
+            return
+        if version[0] is None and not journal:
+            self.rebuild()
+            journal = self._journal_files()
+            version = self._version(journal)
+        self._entries = self._read_merged(journal)
+        self._sorted_keys = sorted(self._entries)
+        self._loaded_version = version
+        self._merged_journal = journal
+
+    def _read_merged(self, journal: List[str]) -> Dict[str, Dict]:
+        try:
+            with open(self.index_path) as f:
+                entries = json.load(f)["entries"]
+        except FileNotFoundError:
+            entries = {}
+        for fname in journal:
+            try:
+                with open(os.path.join(self.journal_dir, fname)) as f:
+                    ops = json.load(f)
+            except FileNotFoundError:
+                # Folded into the snapshot by another reader meanwhile
+                continue
+            for op in ops:
+                if op["op"] == "put":
+                    entry = op["entry"]
+                    entries[_key(entry["subdir"], entry["name"])] = entry
+                else:
+                    entries.pop(_key(op["subdir"], op["name"]), None)
+        return entries
+
+    def query(
+        self,
+        subdirs: Optional[Iterable[str]] = None,
+        search: Optional[str] = None,
+        offset: int = 0,
+        limit: Optional[int] = 100,
+    ) -> Dict:
+        """Return {"total", "items"} for models matching the filters, ordered by subdir/name."""
+        self._load()
+        wanted = set(subdirs) if subdirs else None
+        needle = search.lower() if search else None
+        if wanted is None and needle is None:
+            total = len(self._sorted_keys)
+            keys = self._sorted_keys[offset: None if limit is None else offset + limit]
+            return {"total": total, "items": [self._entries[k] for k in keys]}
+        matches = [
+            self._entries[k]
+            for k in self._sorted_keys
+            if (wanted is None or self._entries[k]["subdir"] in wanted)
+            and (needle is None or needle in self._entries[k]["name"].lower())
+        ]
+        end = None if limit is None else offset + limit
+        return {"total": len(matches), "items": matches[offset:end]}
+
+    def needs_compaction(self) -> bool:
+        return len(self._journal_files()) >= COMPACT_AFTER
+
+    def compact(self):
+        """Fold the merged journal into index.json and delete those journal files."""
+        self._load()
+        os.makedirs(self.root, exist_ok=True)
+        with open(f"{self.index_path}.tmp", "w") as f:
+            json.dump({"entries": self._entries}, f, separators=(",", ":"))
+        os.replace(f"{self.index_path}.tmp", self.index_path)
+        for fname in self._merged_journal:
+            try:
+                os.remove(os.path.join(self.journal_dir, fname))
+            except FileNotFoundError:
+                pass
+        self._loaded_version = None
+
+    def rebuild(self):
+        """Recreate the snapshot from a full scan of the model directories.
+
+        Used to bootstrap an empty catalog and to pick up files copied onto the
+        volume outside the download paths. Hashes already known are kept.
+        """
+        journal = self._journal_files()
+        known = self._read_merged(journal)
+        entries = {}
+        if os.path.isdir(self.models_root):
+            for subdir in sorted(os.listdir(self.models_root)):
+                sub_path = os.path.join(self.models_root, subdir)
+                if not os.path.isdir(sub_path):
+                    continue
+                with os.scandir(sub_path) as it:
+                    for item in it:
+                        if not item.is_file() or item.name.endswith(TRANSIENT_SUFFIXES):
+                            continue
+                        st = item.stat()
+                        previous = known.get(_key(subdir, item.name), {})
+                        same_file = previous.get("size") == st.st_size and previous.get("mtime") == st.st_mtime
+                        entries[_key(subdir, item.name)] = {
+                            "name": item.name,
+                            "subdir": subdir,
+                            "size": st.st_size,
+                            "mtime": st.st_mtime,
+                            "sha256": previous.get("sha256") if same_file else None,
+                        }
+        os.makedirs(self.root, exist_ok=True)
+        with open(f"{self.index_path}.tmp", "w") as f:
+            json.dump({"entries": entries}, f, separators=(",", ":"))
+        os.replace(f"{self.index_path}.tmp", self.index_path)
+        for fname in journal:
+            try:
+                os.remove(os.path.join(self.journal_dir, fname))
+            except FileNotFoundError:
+                pass
+        self._loaded_version = None
@@ -0,0 +1,311 @@
+"""Warm the page cache with hot model files while ComfyUI boots.
+
+On a cold container the first workflow pays for reading multi-GB safetensors
+from the network volume. ``prefetch`` reads the files expected to be needed
+first with several threads at once (after a ``POSIX_FADV_WILLNEED`` hint for
+filesystems that honour it), so by the time ComfyUI loads them they come out
+of the page cache.
+
+Which files are hot comes from two places:
+
+* ``PREFETCH_MODELS``: comma-separated paths or globs under the models root,
+  e.g. ``checkpoints/sd_xl_base_1.0.safetensors,loras/*.safetensors``.
+* A usage record on the volume, updated from ComfyUI's prompt history when a
+  container shuts down (``remember_usage``), ranked by how often each model
+  was loaded recently.
+
+Configured files come first; the total is capped at a fraction of the
+container's memory so prefetching never evicts its own earlier reads.
+Prefetching runs on its own thread and never delays the server's readiness.
+"""
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional
+
+from backends.model_store import MODELS_ROOT
+from backends.workflow_models import required_models
+
+logger = logging.getLogger(__name__)
+
+USAGE_ROOT = "/storage/prefetch"
+PREFETCH_MODELS = [p.strip() for p in os.environ.get("PREFETCH_MODELS", "").split(",") if p.strip()]
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", "8"))
+# Share of the container's memory the prefetched files may occupy
+PREFETCH_MEMORY_FRACTION = float(os.environ.get("PREFETCH_MEMORY_FRACTION", "0.5"))
+READ_BLOCK_SIZE = 16 * 1024 * 1024
+# History entries inspected by remember_usage
+USAGE_HISTORY_ITEMS = 1000
+# A model's usage count halves for every half-life since it was last used,
+# and models unused for USAGE_MAX_AGE are forgotten
+USAGE_HALF_LIFE = 3 * 86400
+USAGE_MAX_AGE = 30 * 86400
+# Journal files after which a writer folds them into the snapshot
+USAGE_COMPACT_AFTER = 32
+
+
+def memory_limit() -> int:
+    """Memory available to this container: the cgroup limit, else physical RAM."""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # cgroup v1 reports "no limit" as a huge number
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value)
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+class ModelUsage:
+    """How often each model ("<folder>/<name>") was loaded, kept on the volume.
+
+    Like the model catalog, this is a snapshot (``usage.json``) plus a journal
+    of one file per container shutdown, so containers recording at the same
+    time never rewrite each other's counts. The journal is folded into the
+    snapshot once it passes ``USAGE_COMPACT_AFTER`` files. Counts are not
+    idempotent like catalog entries, so the snapshot records the last journal
+    file it contains and readers skip everything up to it.
+    """
+
+    def __init__(self, root: str = USAGE_ROOT):
+        self.root = root
+        self.snapshot_path = os.path.join(root, "usage.json")
+        self.journal_dir = os.path.join(root, "journal")
+
+    def _journal_files(self) -> List[str]:
+        try:
+            return sorted(f for f in os.listdir(self.journal_dir) if f.endswith(".json"))
+        except FileNotFoundError:
+            return []
+
+    def _snapshot(self) -> Dict[str, Any]:
+        try:
+            with open(self.snapshot_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"through": "", "models": {}}
+
+    def _merge(self, snapshot: Dict[str, Any], journal: List[str]) -> Dict[str, Dict[str, float]]:
+        usage = {model: dict(entry) for model, entry in snapshot["models"].items()}
+        for fname in journal:
+            if fname <= snapshot["through"]:
+                continue
+            try:
+                with open(os.path.join(self.journal_dir, fname)) as f:
+                    update = json.load(f)
+            except (OSError, ValueError):
+                # Folded into the snapshot by another writer meanwhile
+                continue
+            for model, count in update["counts"].items():
+                entry = usage.setdefault(model, {"count": 0, "last_used": 0})
+                # Decay the older count to the update's time before adding
+                entry["count"] = self._decayed(entry, update["time"]) + count
+                entry["last_used"] = max(entry["last_used"], update["time"])
+        cutoff = time.time() - USAGE_MAX_AGE
+        return {model: entry for model, entry in usage.items() if entry["last_used"] >= cutoff}
+
+    @staticmethod
+    def _decayed(entry: Dict[str, float], now: float) -> float:
+        age = max(0.0, now - entry["last_used"])
+        return entry["count"] * 0.5 ** (age / USAGE_HALF_LIFE)
+
+    def load(self) -> Dict[str, Dict[str, float]]:
+        return self._merge(self._snapshot(), self._journal_files())
+
+    def record(self, counts: Dict[str, int]):
+        if not counts:
+            return
+        os.makedirs(self.journal_dir, exist_ok=True)
+        # Time-ordered, collision-free names keep concurrent writers apart
+        path = os.path.join(self.journal_dir, f"{time.time_ns():020d}-{uuid.uuid4().hex}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump({"time": time.time(), "counts": dict(counts)}, f)
+        os.replace(f"{path}.tmp", path)
+        if len(self._journal_files()) >= USAGE_COMPACT_AFTER:
+            self.compact()
+
+    def compact(self):
+        """Fold the journal into the snapshot, dropping models past USAGE_MAX_AGE."""
+        journal = self._journal_files()
+        if not journal:
+            return
+        snapshot = self._snapshot()
+        usage = self._merge(snapshot, journal)
+        through = max(journal[-1], snapshot["through"])
+        tmp = f"{self.snapshot_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"through": through, "models": usage}, f)
+        os.replace(tmp, self.snapshot_path)
+        # Everything up to `through` is in the snapshot (or arrived too late
+        # to count); a concurrent compaction can at worst drop a few counts
+        for fname in journal:
+            try:
+                os.remove(os.path.join(self.journal_dir, fname))
+            except FileNotFoundError:
+                pass
+
+    def ranked(self) -> List[str]:
+        usage = self.load()
+        now = time.time()
+        return sorted(usage, key=lambda m: (self._decayed(usage[m], now), usage[m]["last_used"]), reverse=True)
+
+
+def usage_from_history(history: Dict[str, Any]) -> Counter:
+    """Count the models loaded by the prompts in a ComfyUI /history response."""
+    counts = Counter()
+    for entry in history.values():
+        # History entries keep the queued prompt as [number, id, workflow, ...]
+        prompt = entry.get("prompt") or []
+        if len(prompt) > 2 and isinstance(prompt[2], dict):
+            counts.update(required_models(prompt[2]))
+    return counts
+
+
+async def remember_usage(comfyui_url: str, usage: Optional[ModelUsage] = None) -> int:
+    """Fold the models this ComfyUI instance loaded into the usage record.
+
+    Call before stopping ComfyUI; its history lives in memory and covers
+    exactly this container's lifetime. Returns the number of prompts seen.
+    """
+    import httpx
+
+    async with httpx.AsyncClient(timeout=10.0) as client:
+        response = await client.get(f"{comfyui_url}/history", params={"max_items": USAGE_HISTORY_ITEMS})
+        response.raise_for_status()
+        history = response.json()
+    (usage or ModelUsage()).record(usage_from_history(history))
+    return len(history)
+
+
+def hot_model_files(
+    models_root: str = MODELS_ROOT,
+    configured: Iterable[str] = PREFETCH_MODELS,
+    usage: Optional[ModelUsage] = None,
+    budget: Optional[int] = None,
+) -> List[str]:
+    """Existing model files to prefetch, most important first, within budget bytes."""
+    if budget is None:
+        budget = int(memory_limit() * PREFETCH_MEMORY_FRACTION)
+    candidates = []
+    for pattern in configured:
+        candidates.extend(sorted(glob.glob(os.path.join(models_root, pattern))))
+    candidates.extend(os.path.join(models_root, m) for m in (usage or ModelUsage()).ranked())
+
+    files, seen, total = [], set(), 0
+    for path in candidates:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        # Store links share one blob; read it once
+        if (st.st_dev, st.st_ino) in seen or not os.path.isfile(path):
+            continue
+        seen.add((st.st_dev, st.st_ino))
+        if total + st.st_size > budget:
+            continue
+        files.append(path)
+        total += st.st_size
+    return files
+
+
+def prefetch(paths: List[str], workers: int = PREFETCH_WORKERS) -> List[Dict[str, Any]]:
+    """Read paths into the page cache with parallel readers; report per file.
+
+    Files are cut into READ_BLOCK_SIZE ranges that all workers share, so one
+    large checkpoint is read over several connections to the volume instead of
+    one sequential stream.
+    """
+    buffers = threading.local()
+    files = []
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            logger.warning("Cannot prefetch %s: %s", path, e)
+            continue
+        size = os.fstat(fd).st_size
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+        files.append({"path": path, "fd": fd, "size": size, "read": 0, "started": None, "finished": None,
+                      "pending": max(1, -(-size // READ_BLOCK_SIZE))})
+    lock = threading.Lock()
+
+    def read_range(record, offset):
+        if not hasattr(buffers, "block"):
+            buffers.block = bytearray(READ_BLOCK_SIZE)
+        now = time.perf_counter()
+        with lock:
+            if record["started"] is None:
+                record["started"] = now
+        view = memoryview(buffers.block)
+        end = min(offset + READ_BLOCK_SIZE, record["size"])
+        done = 0
+        try:
+            while offset + done < end:
+                n = os.preadv(record["fd"], [view[: end - offset - done]], offset + done)
+                if n == 0:
+                    break
+                done += n
+        except OSError as e:
+            # A short read only costs a slower first load; keep going
+            logger.warning("Prefetch read of %s at %d failed: %s", record["path"], offset, e)
+        with lock:
+            record["read"] += done
+            record["pending"] -= 1
+            if record["pending"] == 0:
+                record["finished"] = time.perf_counter()
+
+    t0 = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            # Ranges go in file order, so the hottest file is complete first
+            for record in files:
+                for offset in range(0, max(record["size"], 1), READ_BLOCK_SIZE):
+                    pool.submit(read_range, record, offset)
+    finally:
+        for record in files:
+            os.close(record["fd"])
+
+    report = []
+    for record in files:
+        seconds = (record["finished"] or t0) - (record["started"] or t0)
+        report.append({
+            "path": record["path"],
+            "bytes": record["read"],
+            "seconds": round(seconds, 3),
+            "mb_s": round(record["read"] / 1e6 / seconds, 1) if seconds > 0 else None,
+        })
+    total = sum(r["bytes"] for r in report)
+    elapsed = time.perf_counter() - t0
+    logger.info("Prefetched %d files, %.1f GB in %.1fs", len(report), total / 1e9, elapsed)
+    return report
+
+
+def prefetch_hot_models(models_root: str = MODELS_ROOT, workers: int = PREFETCH_WORKERS) -> List[Dict[str, Any]]:
+    """Pick the hot model files and prefetch them, logging one line per file."""
+    report = prefetch(hot_model_files(models_root), workers=workers)
+    for r in report:
+        logger.info("Prefetched %s: %.1f MB in %.2fs", r["path"], r["bytes"] / 1e6, r["seconds"])
+    return report
+
+
+def start_prefetch(models_root: str = MODELS_ROOT) -> threading.Thread:
+    """Prefetch the hot model files on a background thread and return it."""
+
+    def run():
+        try:
+            prefetch_hot_models(models_root)
+        except Exception as e:
+            logger.warning("Prefetch failed: %r", e)
+
+    thread = threading.Thread(target=run, name="model-prefetch", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,347 @@
+"""One GPU runtime hosting several model backends with LRU residency.
+
+A ``ModelBackend`` builds its model on the CPU in ``load()`` and runs a request
+against the loaded model in ``generate()``; ``DiffusersBackend`` does both for a
+text-to-image diffusers pipeline (see ``flux_dev`` and ``juggernautxl``). ``ModelRuntime`` hosts any number of them
+in one container, keeps at most ``max_resident`` on the GPU and parks the rest
+in pinned CPU memory. Parked weights stay in place, so evicting a model is a
+pointer swap and bringing it back is one host-to-device copy per tensor; the
+least recently used model that is not running a request is evicted first.
+
+Everything works on the CPU as well (there is nothing to pin and "moving" is a
+no-op), so the bookkeeping can be exercised with tiny dummy models::
+
+    python -m backends.model_runtime --models 4 --resident 2 --requests 50
+"""
+import abc
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Models kept on the GPU at once; the rest are parked in pinned CPU memory
+MAX_RESIDENT_MODELS = int(os.environ.get("MAX_RESIDENT_MODELS", "2"))
+
+
+class ModelBackend(abc.ABC):
+    """A model the runtime can host. Subclasses set ``name`` and implement both methods."""
+
+    name = "model"
+
+    @abc.abstractmethod
+    def load(self) -> Any:
+        """Build the model on the CPU: an nn.Module, a diffusers pipeline or None."""
+
+    @abc.abstractmethod
+    def generate(self, model: Any, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Run one request against the model returned by load(), now on the runtime's device."""
+
+
+def _torch_modules(model: Any) -> List[Any]:
+    """The nn.Modules holding a model's weights (pipelines keep several)."""
+    if model is None:
+        return []
+    import torch
+
+    if isinstance(model, torch.nn.Module):
+        return [model]
+    components = getattr(model, "components", None) or {}
+    return [c for c in components.values() if isinstance(c, torch.nn.Module)]
+
+
+class HostedModel:
+    def __init__(self, backend: ModelBackend, pin: bool):
+        self.backend = backend
+        self.model = None
+        # (tensor, parked CPU copy); tensor.data is swapped between copies
+        self.tensors: List[tuple] = []
+        self.pin = pin
+        self.nbytes = 0
+        self.resident = False
+        self.in_use = 0
+        self.loads = 0
+        self.swap_ins = 0
+        self.evictions = 0
+        self.requests = 0
+        self.swap_seconds = 0.0
+        self.last_swap_seconds = 0.0
+        self.last_used = 0.0
+
+    def materialize(self):
+        """Load the model once and park its weights (pinned when a GPU is present)."""
+        if self.model is not None or self.loads:
+            return
+        self.model = self.backend.load()
+        self.loads += 1
+        seen = set()
+        for module in _torch_modules(self.model):
+            for tensor in (*module.parameters(), *module.buffers()):
+                # Tied weights appear more than once
+                if id(tensor) in seen:
+                    continue
+                seen.add(id(tensor))
+                parked = tensor.data.cpu()
+                if self.pin:
+                    parked = parked.pin_memory()
+                tensor.data = parked
+                self.tensors.append((tensor, parked))
+                self.nbytes += parked.numel() * parked.element_size()
+
+    def to_device(self, device: str):
+        for tensor, parked in self.tensors:
+            tensor.data = parked.to(device, non_blocking=self.pin)
+
+    def park(self):
+        # The parked copy was never modified, so nothing needs copying back
+        for tensor, parked in self.tensors:
+            tensor.data = parked
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "resident": self.resident,
+            "in_use": self.in_use,
+            "bytes": self.nbytes,
+            "requests": self.requests,
+            "swap_ins": self.swap_ins,
+            "evictions": self.evictions,
+            "swap_seconds": round(self.swap_seconds, 4),
+            "last_swap_seconds": round(self.last_swap_seconds, 4),
+        }
+
+
+class ModelRuntime:
+    def __init__(
+        self,
+        backends: Iterable[ModelBackend],
+        max_resident: int = MAX_RESIDENT_MODELS,
+        device: Optional[str] = None,
+    ):
+        import torch
+
+        if max_resident < 1:
+            raise ValueError("max_resident must be at least 1")
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.on_gpu = self.device.startswith("cuda")
+        self.models: Dict[str, HostedModel] = {}
+        for backend in backends:
+            if backend.name in self.models:
+                raise ValueError(f"Duplicate backend name: {backend.name}")
+            self.models[backend.name] = HostedModel(backend, pin=self.on_gpu)
+        self.max_resident = max_resident
+        # Resident model names, least recently used first
+        self.resident: "OrderedDict[str, None]" = OrderedDict()
+        self.changed = threading.Condition()
+        # One swap at a time, so two models never race for the same free slot
+        self.swap_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _evictable(self) -> Optional[str]:
+        for name in self.resident:
+            if self.models[name].in_use == 0:
+                return name
+        return None
+
+    def _swap_in(self, hosted: HostedModel):
+        t0 = time.perf_counter()
+        hosted.materialize()
+        hosted.to_device(self.device)
+        if self.on_gpu:
+            import torch
+
+            torch.cuda.synchronize()
+        hosted.last_swap_seconds = time.perf_counter() - t0
+        hosted.swap_seconds += hosted.last_swap_seconds
+        hosted.swap_ins += 1
+        logger.info("Swapped in %s (%.1f MB) in %.3fs", hosted.backend.name, hosted.nbytes / 1e6, hosted.last_swap_seconds)
+
+    def _evict(self, name: str):
+        hosted = self.models[name]
+        hosted.park()
+        hosted.resident = False
+        hosted.evictions += 1
+        del self.resident[name]
+        logger.info("Parked %s in CPU memory", name)
+
+    def _reserve(self, name: str) -> HostedModel:
+        """Claim a slot for name, evicting or waiting as needed; swap_lock must be held."""
+        hosted = self.models[name]
+        with self.changed:
+            if hosted.resident:
+                self.hits += 1
+                hosted.in_use += 1
+                return hosted
+            self.misses += 1
+            while len(self.resident) >= self.max_resident:
+                victim = self._evictable()
+                if victim is not None:
+                    self._evict(victim)
+                else:
+                    # Every resident model is running a request; wait for one to finish
+                    self.changed.wait()
+            self.resident[name] = None
+            hosted.in_use += 1
+        try:
+            self._swap_in(hosted)
+        except Exception:
+            with self.changed:
+                del self.resident[name]
+                hosted.in_use -= 1
+                self.changed.notify_all()
+            raise
+        hosted.resident = True
+        return hosted
+
+    @contextmanager
+    def acquire(self, name: str) -> Iterator[Any]:
+        """Make a model resident and hold it there for the duration of the block."""
+        if name not in self.models:
+            raise KeyError(f"Unknown model: {name}")
+        hosted = self.models[name]
+        with self.changed:
+            # Resident models are used without queueing behind a swap
+            fast = hosted.resident
+            if fast:
+                self.hits += 1
+                hosted.in_use += 1
+        if not fast:
+            # Only callers that hold this lock can evict, and models are
+            # marked in use only once they have a slot, so waiting in
+            # _reserve cannot block on a caller still queued here
+            with self.swap_lock:
+                self._reserve(name)
+        try:
+            with self.changed:
+                self.resident.move_to_end(name)
+            hosted.requests += 1
+            hosted.last_used = time.time()
+            yield hosted.model
+        finally:
+            with self.changed:
+                hosted.in_use -= 1
+                self.changed.notify_all()
+
+    def generate(self, name: str, request: Dict[str, Any]) -> Dict[str, Any]:
+        with self.acquire(name) as model:
+            return self.models[name].backend.generate(model, request)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.changed:
+            return {
+                "device": self.device,
+                "max_resident": self.max_resident,
+                "resident": list(self.resident),
+                "hits": self.hits,
+                "misses": self.misses,
+                "resident_bytes": sum(self.models[n].nbytes for n in self.resident),
+                "models": {name: hosted.stats() for name, hosted in self.models.items()},
+            }
+
+
+class DiffusersBackend(ModelBackend):
+    """A text-to-image diffusers pipeline, loaded by class name from the Hub.
+
+    Requests are ``{"prompt", "seed", "height", "width", "steps", "guidance_scale"}``
+    (all but the prompt optional); the answer carries the image as base64 PNG.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        pipeline: str,
+        model_id: str,
+        dtype: str = "bfloat16",
+        steps: int = 28,
+        guidance_scale: float = 3.5,
+    ):
+        self.name = name
+        self.pipeline = pipeline
+        self.model_id = model_id
+        self.dtype = dtype
+        self.steps = steps
+        self.guidance_scale = guidance_scale
+
+    def load(self):
+        import diffusers
+        import torch
+
+        pipeline_class = getattr(diffusers, self.pipeline)
+        return pipeline_class.from_pretrained(self.model_id, torch_dtype=getattr(torch, self.dtype))
+
+    def generate(self, model, request):
+        import base64
+        import io
+
+        import torch
+
+        seed = request.get("seed")
+        # A CPU generator gives the same noise whichever device the model is on
+        generator = torch.Generator().manual_seed(int(seed)) if seed is not None else None
+        with torch.inference_mode():
+            image = model(
+                request["prompt"],
+                height=int(request.get("height", 1024)),
+                width=int(request.get("width", 1024)),
+                num_inference_steps=int(request.get("steps", self.steps)),
+                guidance_scale=float(request.get("guidance_scale", self.guidance_scale)),
+                generator=generator,
+            ).images[0]
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return {"model": self.name, "seed": seed, "image_png_base64": base64.b64encode(buffer.getvalue()).decode()}
+
+
+class DummyBackend(ModelBackend):
+    """A few-layer MLP standing in for a real model when trying the runtime on CPU."""
+
+    def __init__(self, name: str, width: int = 256, depth: int = 4):
+        self.name = name
+        self.width = width
+        self.depth = depth
+
+    def load(self):
+        import torch
+
+        layers = []
+        for _ in range(self.depth):
+            layers += [torch.nn.Linear(self.width, self.width), torch.nn.GELU()]
+        return torch.nn.Sequential(*layers).eval()
+
+    def generate(self, model, request):
+        import torch
+
+        device = next(model.parameters()).device
+        with torch.inference_mode():
+            out = model(torch.randn(int(request.get("batch", 1)), self.width, device=device))
+        return {"model": self.name, "device": str(device), "mean": float(out.mean())}
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+
+    parser = argparse.ArgumentParser(description="Exercise ModelRuntime with tiny dummy models.")
+    parser.add_argument("--models", type=int, default=4)
+    parser.add_argument("--resident", type=int, default=2)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--device", help="Default: cuda when available, else cpu")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    runtime = ModelRuntime(
+        [DummyBackend(f"dummy{i}") for i in range(args.models)], max_resident=args.resident, device=args.device
+    )
+    # Skewed traffic, as real model popularity is
+    weights = [1 / (i + 1) for i in range(args.models)]
+    names = random.choices(list(runtime.models), weights=weights, k=args.requests)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(lambda name: runtime.generate(name, {"batch": 2}), names))
+    print(json.dumps(runtime.stats(), indent=2))
@@ -0,0 +1,137 @@
+"""Content-addressed model store on the shared volume.
+
+Each downloaded file is stored once under ``blobs/sha256/<aa>/<digest>`` and
+linked into every model subdirectory that asked for it, so the same checkpoint
+requested as both ``lora`` and ``loras`` (or ``unet`` and ``diffusion_models``)
+only costs one download and one copy on the volume. A small ``by-url`` index
+lets a repeat request for a known URL finish without touching the network;
+pass ``refresh=True`` when the content behind a URL may have changed (a
+re-uploaded checkpoint at the same link).
+"""
+import hashlib
+import logging
+import os
+from typing import Dict, Iterable, List, Optional
+
+from backends.downloader import download
+from backends.model_catalog import ModelCatalog
+
+logger = logging.getLogger(__name__)
+
+STORE_ROOT = "/storage/blobs"
+MODELS_ROOT = "/storage/models"
+
+
+class ModelStore:
+    def __init__(
+        self,
+        root: str = STORE_ROOT,
+        models_root: str = MODELS_ROOT,
+        catalog: Optional[ModelCatalog] = None,
+    ):
+        self.root = root
+        self.models_root = models_root
+        self.catalog = catalog
+        self.blob_dir = os.path.join(root, "sha256")
+        self.staging_dir = os.path.join(root, "staging")
+        self.url_index_dir = os.path.join(root, "by-url")
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def has_blob(self, digest: str) -> bool:
+        return os.path.isfile(self.blob_path(digest))
+
+    def _url_key(self, url: str) -> str:
+        return hashlib.sha1(url.encode()).hexdigest()
+
+    def digest_for_url(self, url: str) -> Optional[str]:
+        """Return the digest previously stored for url, if its blob still exists."""
+        try:
+            with open(os.path.join(self.url_index_dir, self._url_key(url))) as f:
+                digest = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return digest if digest and self.has_blob(digest) else None
+
+    def _remember_url(self, url: str, digest: str):
+        os.makedirs(self.url_index_dir, exist_ok=True)
+        path = os.path.join(self.url_index_dir, self._url_key(url))
+        with open(f"{path}.tmp", "w") as f:
+            f.write(digest)
+        os.replace(f"{path}.tmp", path)
+
+    def link(self, digest: str, subdir: str, filename: str) -> str:
+        """Expose a blob as models/<subdir>/<filename>, replacing any existing file."""
+        blob = self.blob_path(digest)
+        full_dir = os.path.join(self.models_root, subdir)
+        os.makedirs(full_dir, exist_ok=True)
+        dest = os.path.join(full_dir, filename)
+        if os.path.exists(dest) and os.path.samefile(dest, blob):
+            return dest
+        tmp = f"{dest}.link"
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            # Volumes without hardlink support get a symlink instead
+            os.symlink(blob, tmp)
+        os.replace(tmp, dest)
+        return dest
+
+    def ingest(
+        self,
+        url: str,
+        filename: str,
+        subdirs: Iterable[str],
+        sha256: Optional[str] = None,
+        refresh: bool = False,
+        **download_kwargs,
+    ) -> Dict:
+        """Make url available as <subdir>/<filename> for every subdir.
+
+        The network is skipped when ``sha256`` (or the digest recorded for a
+        previous download of the same url) is already in the store. With
+        ``refresh`` the by-url index is ignored and the url is fetched again;
+        a matching ``sha256`` still skips the network, since the content is
+        pinned. Raises ValueError when the downloaded content does not match
+        ``sha256``.
+        """
+        subdirs = list(dict.fromkeys(subdirs))
+        expected = sha256.lower() if sha256 else None
+        digest = expected if expected and self.has_blob(expected) else None
+        if digest is None and expected is None and not refresh:
+            digest = self.digest_for_url(url)
+
+        result = None
+        if digest is None:
+            os.makedirs(self.staging_dir, exist_ok=True)
+            # Named after the url so an interrupted download resumes on retry
+            staging = os.path.join(self.staging_dir, self._url_key(url))
+            result = download(url, staging, hash_sha256=True, **download_kwargs)
+            digest = result.sha256
+            if expected and digest != expected:
+                os.remove(staging)
+                raise ValueError(f"SHA-256 mismatch for {url}: expected {expected}, got {digest}")
+            blob = self.blob_path(digest)
+            if os.path.exists(blob):
+                logger.info("Blob %s already stored, dropping duplicate download of %s", digest, url)
+                os.remove(staging)
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.replace(staging, blob)
+        else:
+            logger.info("Blob %s already stored, skipping download of %s", digest, url)
+        self._remember_url(url, digest)
+
+        paths: List[str] = [self.link(digest, subdir, filename) for subdir in subdirs]
+        if self.catalog is not None:
+            self.catalog.record_many([(subdir, filename) for subdir in subdirs], sha256=digest)
+        return {
+            "sha256": digest,
+            "size": os.path.getsize(self.blob_path(digest)),
+            "paths": paths,
+            "cached": result is None,
+            "throughput": result.throughput if result else None,
+        }
@@ -0,0 +1,57 @@
+"""Serve several model backends from one GPU container.
+
+Instead of one mostly idle GPU container per model, ``MultiModelBackend`` hosts
+the diffusers backends (``flux_dev``, ``juggernautxl``) in a ``ModelRuntime``:
+``MAX_RESIDENT_MODELS`` of them stay on the GPU and the rest wait in pinned CPU
+memory until a request swaps them in.
+"""
+from pathlib import Path
+from typing import Optional
+
+import modal
+
+app = modal.App("multi-model-backend")
+hf_cache = modal.Volume.from_name("hf-hub-cache", create_if_missing=True)
+image = (
+    modal.Image.debian_slim(python_version="3.10")
+    .pip_install(
+        "torch==2.7.0",
+        "diffusers==0.33.1",
+        "transformers==4.51.3",
+        "accelerate==1.6.0",
+        "sentencepiece==0.2.0",
+        "protobuf",
+        "huggingface-hub[hf_transfer]==0.30.2",
+        "safetensors==0.5.3",
+    )
+    .env({"HF_HUB_ENABLE_HF_TRANSFER": "1", "HF_HUB_CACHE": "/cache"})
+    .add_local_dir(Path(__file__).resolve().parent, remote_path="/root/backends")
+)
+
+
+# FLUX.1-dev (~33 GB in bf16) and Juggernaut XL (~7 GB in fp16) fit side by side
+@app.cls(
+    image=image,
+    gpu="A100-80GB",
+    memory=65536,
+    volumes={"/cache": hf_cache},
+    secrets=[modal.Secret.from_name("huggingface-secret")],
+    timeout=600,
+    scaledown_window=300,
+)
+class MultiModelBackend:
+    @modal.enter()
+    def setup(self):
+        from backends import flux_dev, juggernautxl
+        from backends.model_runtime import ModelRuntime
+
+        self.runtime = ModelRuntime(m.make_backend() for m in (flux_dev, juggernautxl))
+
+    @modal.method()
+    def generate(self, model: str, prompt: str, seed: Optional[int] = None) -> dict:
+        return self.runtime.generate(model, {"prompt": prompt, "seed": seed})
+
+    @modal.method()
+    def stats(self) -> dict:
+        """Residency, hit/miss counts and swap times per model."""
+        return self.runtime.stats()
@@ -0,0 +1,300 @@
+"""Push finished ComfyUI outputs to R2 and hand out presigned URLs.
+
+Outputs otherwise live on the shared volume forever and every download goes
+through the GPU container's proxy. ``OutputOffloader.watch`` polls ComfyUI's
+``/history`` for newly completed prompts and uploads their output files to the
+R2 bucket from a thread pool, off the request path. Each prompt's object keys
+are recorded in ``records`` (a ``modal.Dict`` shared by all containers), so
+``urls(prompt_id)`` can presign fresh links from any container. Files that fail
+to upload are retried on later polls, up to ``UPLOAD_ATTEMPTS`` times per prompt.
+
+With ``OUTPUT_MAX_AGE_SECONDS`` or ``OUTPUT_MAX_BYTES`` set, local copies that
+are already in the bucket are deleted oldest first once they are older than the
+age limit or the output folder is over the size budget. Files that have not
+been uploaded are never pruned. Records older than ``OUTPUT_RECORD_TTL`` are
+swept from ``records`` so the shared Dict does not grow forever.
+
+Offloading is optional: the apps only attach the R2 secret when deployed with
+``OUTPUT_OFFLOAD=1``, and without credentials ``output_offloader`` returns None.
+"""
+import asyncio
+import logging
+import mimetypes
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_DIR = "/storage/output"
+# Same Cloudflare R2 bucket as scripts/modal/flux_endpoint.py
+CLOUD_BUCKET_ACCOUNT_ID = os.environ.get("R2_ACCOUNT_ID", "4aa30f66ab0905858439168cc51561d1")
+CLOUD_BUCKET_NAME = os.environ.get("R2_BUCKET", "modalflux")
+KEY_PREFIX = "comfyui"
+UPLOAD_WORKERS = 8
+# Offload passes per prompt before files that keep failing are given up on
+UPLOAD_ATTEMPTS = 5
+PRESIGNED_URL_EXPIRY = 86400  # 24 hours
+POLL_INTERVAL = 2.0
+# Completed prompts looked at per /history poll
+HISTORY_ITEMS = 64
+# Prompt ids remembered as offloaded by this container
+MAX_TRACKED_PROMPTS = 10000
+# Local pruning, off unless one of the limits is set
+OUTPUT_MAX_AGE = float(os.environ.get("OUTPUT_MAX_AGE_SECONDS", "0"))
+OUTPUT_MAX_BYTES = int(os.environ.get("OUTPUT_MAX_BYTES", "0"))
+PRUNE_INTERVAL = 300.0
+# Prompt records (and upload markers) older than this are deleted; presigned
+# URLs can no longer be requested for them
+OUTPUT_RECORD_TTL = float(os.environ.get("OUTPUT_RECORD_TTL_SECONDS", str(7 * 86400)))
+RECORD_SWEEP_INTERVAL = 3600.0
+
+
+def offload_configured() -> bool:
+    """True when the R2 secret is attached (see OUTPUT_OFFLOAD in the apps)."""
+    return "AWS_ACCESS_KEY_ID" in os.environ and "AWS_SECRET_ACCESS_KEY" in os.environ
+
+
+def r2_client():
+    import boto3
+    from botocore.config import Config as BotoConfig
+
+    return boto3.client(
+        service_name="s3",
+        endpoint_url=f"https://{CLOUD_BUCKET_ACCOUNT_ID}.r2.cloudflarestorage.com",
+        aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
+        aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
+        region_name="auto",
+        # one pooled connection per upload thread
+        config=BotoConfig(max_pool_connections=UPLOAD_WORKERS),
+    )
+
+
+def output_items(outputs: Dict[str, Any]) -> List[Dict[str, str]]:
+    """Files a prompt saved to the output folder, from its /history outputs."""
+    items = []
+    for node_output in outputs.values():
+        for value in node_output.values():
+            if not isinstance(value, list):
+                continue
+            for item in value:
+                # Previews and inputs are temporary or not ours to move
+                if isinstance(item, dict) and "filename" in item and item.get("type", "output") == "output":
+                    items.append({"filename": item["filename"], "subfolder": item.get("subfolder", "")})
+    return items
+
+
+class OutputOffloader:
+    def __init__(
+        self,
+        client,
+        records,
+        bucket: str = CLOUD_BUCKET_NAME,
+        output_dir: str = OUTPUT_DIR,
+        max_age: float = OUTPUT_MAX_AGE,
+        max_bytes: int = OUTPUT_MAX_BYTES,
+        record_ttl: float = OUTPUT_RECORD_TTL,
+    ):
+        self.client = client
+        # Mapping with blocking get/__setitem__, e.g. modal.Dict; only touched from threads
+        self.records = records
+        self.bucket = bucket
+        self.output_dir = output_dir
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.record_ttl = record_ttl
+        # Upload threads update the counters concurrently
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="output-upload")
+        self.tasks: "OrderedDict[str, asyncio.Task]" = OrderedDict()
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.failed = 0
+        self.pruned = 0
+        self.pruned_bytes = 0
+
+    def presign(self, key: str) -> str:
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=PRESIGNED_URL_EXPIRY,
+        )
+
+    def _upload(self, prompt_id: str, item: Dict[str, str]) -> Dict[str, Any]:
+        rel = os.path.join(item["subfolder"], item["filename"])
+        path = os.path.join(self.output_dir, rel)
+        st = os.stat(path)
+        key = f"{KEY_PREFIX}/{prompt_id}/{rel}"
+        content_type = mimetypes.guess_type(item["filename"])[0] or "application/octet-stream"
+        self.client.upload_file(path, self.bucket, key, ExtraArgs={"ContentType": content_type})
+        if self.max_age or self.max_bytes:
+            # Lets prune() tell an uploaded file from a newer one with the same
+            # name; removed again when the file is pruned
+            self.records[f"file:{rel}"] = {
+                "key": key, "size": st.st_size, "mtime": st.st_mtime, "uploaded_at": time.time(),
+            }
+        with self.lock:
+            self.uploaded += 1
+            self.uploaded_bytes += st.st_size
+        return {**item, "key": key, "size": st.st_size}
+
+    async def _offload(self, prompt_id: str, outputs: Dict[str, Any]) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        items = output_items(outputs)
+        # A retry only uploads the files an earlier pass failed on
+        previous = await loop.run_in_executor(self.pool, self.records.get, prompt_id) or {}
+        done = {(f["subfolder"], f["filename"]): f for f in previous.get("files", []) if "key" in f}
+        todo = [item for item in items if (item["subfolder"], item["filename"]) not in done]
+        results = await asyncio.gather(
+            *(loop.run_in_executor(self.pool, self._upload, prompt_id, item) for item in todo),
+            return_exceptions=True,
+        )
+        uploads = {(item["subfolder"], item["filename"]): result for item, result in zip(todo, results)}
+        files = []
+        failed = 0
+        for item in items:
+            result = done.get((item["subfolder"], item["filename"])) or uploads[(item["subfolder"], item["filename"])]
+            if isinstance(result, BaseException):
+                failed += 1
+                logger.warning("Offloading %s of prompt %s failed: %r", item["filename"], prompt_id, result)
+                files.append({**item, "error": repr(result)})
+            else:
+                files.append(result)
+        attempts = previous.get("attempts", 0) + 1
+        record = {"prompt_id": prompt_id, "files": files, "attempts": attempts, "uploaded_at": time.time()}
+        await loop.run_in_executor(self.pool, self.records.__setitem__, prompt_id, record)
+        if failed:
+            with self.lock:
+                self.failed += failed
+            if attempts < UPLOAD_ATTEMPTS:
+                # Forgetting the prompt lets the next watch() poll pick it up again
+                self.tasks.pop(prompt_id, None)
+        return record
+
+    async def offload(self, prompt_id: str, outputs: Dict[str, Any]) -> Dict[str, Any]:
+        """Upload a finished prompt's outputs once; concurrent callers share the work."""
+        task = self.tasks.get(prompt_id)
+        if task is None or (task.done() and task.exception() is not None):
+            task = asyncio.ensure_future(self._offload(prompt_id, outputs))
+            self.tasks[prompt_id] = task
+            while len(self.tasks) > MAX_TRACKED_PROMPTS:
+                self.tasks.popitem(last=False)
+        return await asyncio.shield(task)
+
+    def with_urls(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        files = [{**f, "url": self.presign(f["key"])} if "key" in f else f for f in record["files"]]
+        return {**record, "files": files, "expires_in": PRESIGNED_URL_EXPIRY}
+
+    async def urls(self, prompt_id: str) -> Optional[Dict[str, Any]]:
+        """The prompt's offloaded files with freshly presigned URLs, or None."""
+        record = await asyncio.get_running_loop().run_in_executor(self.pool, self.records.get, prompt_id)
+        return self.with_urls(record) if record else None
+
+    def prune(self) -> int:
+        """Delete uploaded local outputs past the age limit or size budget."""
+        if not (self.max_age or self.max_bytes):
+            return 0
+        entries = []
+        for root, _, names in os.walk(self.output_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        removed = 0
+        for mtime, size, path in entries:
+            over_age = self.max_age and now - mtime > self.max_age
+            over_budget = self.max_bytes and total > self.max_bytes
+            if not (over_age or over_budget):
+                continue
+            rel = os.path.relpath(path, self.output_dir)
+            uploaded = self.records.get(f"file:{rel}")
+            if not uploaded or uploaded["size"] != size or uploaded["mtime"] != mtime:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._forget(f"file:{rel}")
+            total -= size
+            removed += 1
+            with self.lock:
+                self.pruned += 1
+                self.pruned_bytes += size
+        if removed:
+            logger.info("Pruned %d offloaded outputs, %.1f MB left locally", removed, total / 1e6)
+        return removed
+
+    def _forget(self, key: str):
+        try:
+            self.records.pop(key)
+        except KeyError:
+            pass
+
+    def sweep_records(self) -> int:
+        """Delete prompt records and upload markers older than the record TTL."""
+        cutoff = time.time() - self.record_ttl
+        stale = [key for key, value in self.records.items() if value.get("uploaded_at", 0) < cutoff]
+        for key in stale:
+            self._forget(key)
+        if stale:
+            logger.info("Swept %d expired output records", len(stale))
+        return len(stale)
+
+    async def watch(self, comfyui_url: str, poll_interval: float = POLL_INTERVAL):
+        """Offload every prompt that completes on the ComfyUI server at comfyui_url."""
+        import httpx
+
+        last_prune = last_sweep = time.monotonic()
+        async with httpx.AsyncClient(base_url=comfyui_url, timeout=30.0) as http:
+            while True:
+                await asyncio.sleep(poll_interval)
+                try:
+                    response = await http.get("/history", params={"max_items": HISTORY_ITEMS})
+                    response.raise_for_status()
+                    history = response.json()
+                except Exception as e:
+                    # ComfyUI still starting or busy; try again next round
+                    logger.debug("History poll failed: %r", e)
+                    continue
+                for prompt_id, entry in history.items():
+                    if prompt_id in self.tasks or not (entry.get("status") or {}).get("completed"):
+                        continue
+                    self.offload_in_background(prompt_id, entry.get("outputs") or {})
+                if time.monotonic() - last_prune > PRUNE_INTERVAL:
+                    last_prune = time.monotonic()
+                    await asyncio.get_running_loop().run_in_executor(self.pool, self.prune)
+                if time.monotonic() - last_sweep > RECORD_SWEEP_INTERVAL:
+                    last_sweep = time.monotonic()
+                    await asyncio.get_running_loop().run_in_executor(self.pool, self.sweep_records)
+
+    def offload_in_background(self, prompt_id: str, outputs: Dict[str, Any]):
+        task = asyncio.ensure_future(self.offload(prompt_id, outputs))
+        # Failures are logged per file in _offload; don't warn about unretrieved results
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "uploaded": self.uploaded,
+                "uploaded_bytes": self.uploaded_bytes,
+                "failed": self.failed,
+                "pruned": self.pruned,
+                "pruned_bytes": self.pruned_bytes,
+                "prompts": len(self.tasks),
+            }
+
+
+def output_offloader(records) -> Optional[OutputOffloader]:
+    """An offloader for this container, or None when R2 isn't configured."""
+    if not offload_configured():
+        return None
+    return OutputOffloader(r2_client(), records)
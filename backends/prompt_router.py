@@ -0,0 +1,373 @@
+"""Route ComfyUI prompts across several GPU containers by model affinity.
+
+Every ComfyUI instance keeps recently used checkpoints, LoRAs and VAEs in
+memory, so the cheapest place to run a prompt is a container that already has
+its models loaded. The router remembers which models each worker was last
+asked to run and scores workers by::
+
+    RELOAD_COST * (models the worker would have to load) + queue depth
+
+so a prompt stays with the worker that has its models until that worker's
+queue is ``RELOAD_COST`` prompts longer than the alternative, and only then
+spills to the least-loaded worker. Queue depth comes from polling each
+worker's ``GET /prompt`` plus what the router sent since the last poll.
+
+Workers are plain base URLs (ComfyUI itself, the comfy_app proxy or
+comfyui_backend deployments). ``POST /run`` only exists on the comfy_app proxy,
+so route /run traffic to comfy_app workers; ``/prompt`` works with all of them.
+Run locally against any ComfyUI-compatible servers with::
+
+    python -m backends.prompt_router --worker http://127.0.0.1:8188 --worker http://127.0.0.1:8189
+
+or against stand-in workers with ``scripts/local/router_harness.py``.
+"""
+import asyncio
+import logging
+import re
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Set
+
+from backends.workflow_models import required_models
+
+logger = logging.getLogger(__name__)
+
+# Queued prompts a worker may be ahead by before a model reload is preferred
+RELOAD_COST = 3.0
+# Distinct models assumed to stay resident per worker (oldest forgotten first)
+MAX_RESIDENT_MODELS = 8
+POLL_INTERVAL = 2.0
+# Prompt ids remembered for /history lookups
+MAX_TRACKED_PROMPTS = 10000
+# Response headers passed through from a worker
+PASSTHROUGH_HEADERS = ("content-type", "content-length", "content-encoding", "etag", "last-modified", "cache-control")
+# Bytes of a /run answer searched for its prompt_id before streaming it on
+RUN_HEAD_BYTES = 4096
+PROMPT_ID_PATTERN = re.compile(rb'"prompt_id"\s*:\s*"([^"]+)"')
+
+
+class Worker:
+    """A ComfyUI base URL as the router sees it.
+
+    ``loaded`` is the router's guess at the worker's resident models, built from
+    the prompts the worker accepted; it is not read from the worker, whose real
+    cache also depends on other clients and on ComfyUI's own eviction.
+    ``pending`` counts the models of requests still in flight to the worker, so
+    concurrent prompts already score them as loaded until the answer comes back.
+    """
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.loaded: "OrderedDict[str, float]" = OrderedDict()
+        self.pending: Dict[str, int] = {}
+        self.queue_remaining = 0
+        self.sent_since_poll = 0
+        self.running = 0
+        self.healthy = True
+        self.routed = 0
+        self.reloads = 0
+
+    @property
+    def load(self) -> int:
+        return self.queue_remaining + self.sent_since_poll + self.running
+
+    def missing(self, models: Iterable[str]) -> int:
+        return sum(1 for m in models if m not in self.loaded and m not in self.pending)
+
+    def begin(self, models: Iterable[str]):
+        for model in models:
+            self.pending[model] = self.pending.get(model, 0) + 1
+
+    def end(self, models: Iterable[str]):
+        for model in models:
+            if self.pending.get(model, 0) <= 1:
+                self.pending.pop(model, None)
+            else:
+                self.pending[model] -= 1
+
+    def mark_loaded(self, models: Iterable[str]):
+        now = time.time()
+        for model in models:
+            self.loaded.pop(model, None)
+            self.loaded[model] = now
+        while len(self.loaded) > MAX_RESIDENT_MODELS:
+            self.loaded.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "load": self.load,
+            "queue_remaining": self.queue_remaining,
+            "routed": self.routed,
+            "reloads": self.reloads,
+            "loaded": list(self.loaded),
+        }
+
+
+class PromptRouter:
+    def __init__(self, urls: Iterable[str], reload_cost: float = RELOAD_COST):
+        self.workers = [Worker(url) for url in urls]
+        if not self.workers:
+            raise ValueError("PromptRouter needs at least one worker")
+        self.reload_cost = reload_cost
+        self.prompts: "OrderedDict[str, Worker]" = OrderedDict()
+        self.affinity_hits = 0
+        self.spills = 0
+
+    def choose(self, models: Set[str], exclude: Iterable[Worker] = ()) -> Worker:
+        """Pick the worker where models are cheapest to run right now, skipping ``exclude``."""
+        remaining = [w for w in self.workers if w not in exclude]
+        if not remaining:
+            raise LookupError("Every worker has been tried")
+        candidates = [w for w in remaining if w.healthy] or remaining
+        best = min(
+            candidates,
+            key=lambda w: (self.reload_cost * w.missing(models) + w.load, w.missing(models), w.load),
+        )
+        if models:
+            if best.missing(models) == 0:
+                self.affinity_hits += 1
+            elif any(w.missing(models) == 0 for w in candidates):
+                # A worker had everything loaded but its queue was too long
+                self.spills += 1
+        return best
+
+    def record(self, worker: Worker, models: Set[str], prompt_id: Optional[str] = None):
+        """Note that worker accepted a prompt needing models; call only after it did."""
+        if any(m not in worker.loaded for m in models):
+            worker.reloads += 1
+        worker.mark_loaded(models)
+        worker.routed += 1
+        if prompt_id:
+            self.prompts[prompt_id] = worker
+            while len(self.prompts) > MAX_TRACKED_PROMPTS:
+                self.prompts.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        routed = sum(w.routed for w in self.workers)
+        return {
+            "routed": routed,
+            "affinity_hits": self.affinity_hits,
+            "spills": self.spills,
+            "reloads": sum(w.reloads for w in self.workers),
+            "workers": [w.stats() for w in self.workers],
+        }
+
+
+async def tag_json_object(
+    chunks: AsyncIterator[bytes], worker: int, on_prompt_id: Callable[[str], None]
+) -> AsyncIterator[bytes]:
+    """Stream a JSON object with a "worker" field added, reporting its prompt_id.
+
+    Only the head of the body is held back (until the prompt_id shows up or
+    RUN_HEAD_BYTES have arrived), so inline image data is never buffered whole.
+    Bodies that are not JSON objects pass through unchanged.
+    """
+    head = b""
+    async for chunk in chunks:
+        if head is None:
+            yield chunk
+            continue
+        head += chunk
+        match = PROMPT_ID_PATTERN.search(head)
+        if not head.strip() or (match is None and len(head) < RUN_HEAD_BYTES):
+            continue
+        yield _tag_head(head, worker, match, on_prompt_id)
+        head = None
+    if head:
+        yield _tag_head(head, worker, PROMPT_ID_PATTERN.search(head), on_prompt_id)
+
+
+def _tag_head(head: bytes, worker: int, match, on_prompt_id: Callable[[str], None]) -> bytes:
+    body = head.lstrip()
+    if not body.startswith(b"{"):
+        return head
+    if match is not None:
+        on_prompt_id(match.group(1).decode())
+    rest = body[1:]
+    separator = b"" if rest.lstrip().startswith(b"}") else b","
+    return b'{"worker": %d%s%s' % (worker, separator, rest)
+
+
+def create_router_app(worker_urls: List[str], poll_interval: float = POLL_INTERVAL):
+    """FastAPI app that accepts ComfyUI submissions and forwards each to a worker.
+
+    ``POST /prompt`` and ``POST /run`` (comfy_app workers) are routed by model
+    affinity; ``GET /history/{prompt_id}`` goes to the worker that ran the
+    prompt, and ``/workers/{index}/{path}`` reaches a worker directly, e.g. for
+    ``/view`` downloads. ``GET /router/stats`` reports placement decisions.
+    /run answers and passthrough bodies are streamed, not buffered.
+    """
+    import httpx
+    from fastapi import FastAPI, HTTPException, Request, Response
+    from fastapi.responses import JSONResponse, StreamingResponse
+    from starlette.background import BackgroundTask
+
+    router = PromptRouter(worker_urls)
+    app = FastAPI()
+    client = httpx.AsyncClient(timeout=httpx.Timeout(600.0, connect=10.0))
+
+    async def poll(worker: Worker):
+        try:
+            response = await client.get(f"{worker.url}/prompt", timeout=5.0)
+            response.raise_for_status()
+            worker.queue_remaining = int(response.json().get("exec_info", {}).get("queue_remaining", 0))
+            worker.sent_since_poll = 0
+            if not worker.healthy:
+                logger.info("Worker %s is back", worker.url)
+            worker.healthy = True
+        except Exception as e:
+            if worker.healthy:
+                logger.warning("Worker %s unreachable: %r", worker.url, e)
+            worker.healthy = False
+
+    async def poll_forever():
+        while True:
+            await asyncio.gather(*(poll(w) for w in router.workers))
+            await asyncio.sleep(poll_interval)
+
+    @app.on_event("startup")
+    async def start_polling():
+        app.state.poller = asyncio.create_task(poll_forever())
+
+    @app.on_event("shutdown")
+    async def stop_polling():
+        app.state.poller.cancel()
+        await client.aclose()
+
+    def workflow_of(body: Dict[str, Any]) -> Dict[str, Any]:
+        return body["prompt"] if isinstance(body.get("prompt"), dict) else body
+
+    async def send_to_worker(models: Set[str], send: Callable[[Worker], Any]):
+        """Send to the best worker; one that cannot be reached is marked unhealthy and the next is tried."""
+        tried: List[Worker] = []
+        while True:
+            try:
+                worker = router.choose(models, exclude=tried)
+            except LookupError:
+                raise HTTPException(status_code=502, detail="No worker could be reached")
+            worker.begin(models)
+            try:
+                return worker, await send(worker)
+            except httpx.TransportError as e:
+                logger.warning("Worker %s failed: %r; trying another", worker.url, e)
+                # The poller marks it healthy again once it answers
+                worker.healthy = False
+                tried.append(worker)
+            finally:
+                worker.end(models)
+
+    @app.post("/prompt")
+    async def submit_prompt(request: Request):
+        body = await request.json()
+        if not isinstance(body.get("prompt"), dict):
+            raise HTTPException(status_code=400, detail='Expected {"prompt": <API-format workflow>}')
+        models = required_models(body["prompt"])
+        # Choosing the id here lets /history find the worker even if the
+        # response is lost; ComfyUI versions that ignore it return their own
+        body.setdefault("prompt_id", uuid.uuid4().hex)
+        worker, response = await send_to_worker(models, lambda w: client.post(f"{w.url}/prompt", json=body))
+        try:
+            payload = response.json()
+        except ValueError:
+            return Response(content=response.content, status_code=response.status_code)
+        if response.status_code == 200:
+            worker.sent_since_poll += 1
+            router.record(worker, models, payload.get("prompt_id", body["prompt_id"]))
+            payload["worker"] = router.workers.index(worker)
+        return JSONResponse(status_code=response.status_code, content=payload)
+
+    @app.post("/run")
+    async def run_workflow(request: Request):
+        body = await request.json()
+        models = required_models(workflow_of(body))
+
+        async def run_on(worker: Worker):
+            worker.running += 1
+            try:
+                # /run answers once the prompt has finished, so headers arriving
+                # means the worker is done with it
+                return await client.send(
+                    client.build_request("POST", f"{worker.url}/run", params=request.query_params, json=body),
+                    stream=True,
+                )
+            finally:
+                worker.running -= 1
+
+        worker, response = await send_to_worker(models, run_on)
+        if response.status_code == 200:
+            router.record(worker, models)
+        index = router.workers.index(worker)
+        headers = {k: v for k, v in response.headers.items() if k.lower() in ("content-type", "cache-control")}
+        if not response.headers.get("content-type", "").startswith("application/json"):
+            return StreamingResponse(
+                response.aiter_bytes(),
+                status_code=response.status_code,
+                headers=headers,
+                background=BackgroundTask(response.aclose),
+            )
+
+        def remember(prompt_id: str):
+            router.prompts[prompt_id] = worker
+
+        # Decoded bytes, since the body is edited; length and encoding change
+        return StreamingResponse(
+            tag_json_object(response.aiter_bytes(), index, remember),
+            status_code=response.status_code,
+            headers=headers,
+            background=BackgroundTask(response.aclose),
+        )
+
+    @app.get("/history/{prompt_id}")
+    async def history(prompt_id: str):
+        worker = router.prompts.get(prompt_id)
+        if worker is None:
+            raise HTTPException(status_code=404, detail="Unknown prompt id")
+        response = await client.get(f"{worker.url}/history/{prompt_id}")
+        return Response(content=response.content, status_code=response.status_code, media_type="application/json")
+
+    @app.get("/router/stats")
+    async def stats():
+        return router.stats()
+
+    @app.api_route("/workers/{index}/{path:path}", methods=["GET", "POST"])
+    async def worker_passthrough(index: int, path: str, request: Request):
+        if not 0 <= index < len(router.workers):
+            raise HTTPException(status_code=404, detail="Unknown worker")
+        # Only stream a request body when the client actually sent one, so plain
+        # GETs are not turned into chunked uploads.
+        has_body = "content-length" in request.headers or "transfer-encoding" in request.headers
+        upstream_request = client.build_request(
+            request.method,
+            f"{router.workers[index].url}/{path}",
+            params=request.query_params,
+            content=request.stream() if has_body else None,
+            headers={k: v for k, v in request.headers.items() if k.lower() in ("content-type", "content-length", "accept")},
+        )
+        response = await client.send(upstream_request, stream=True)
+        # Raw bytes keep the upstream Content-Encoding/Content-Length valid
+        headers = {k: v for k, v in response.headers.items() if k.lower() in PASSTHROUGH_HEADERS}
+        return StreamingResponse(
+            response.aiter_raw(),
+            status_code=response.status_code,
+            headers=headers,
+            background=BackgroundTask(response.aclose),
+        )
+
+    app.state.router = router
+    return app
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Route ComfyUI prompts across workers by model affinity.")
+    parser.add_argument("--worker", action="append", required=True, help="Worker base URL (repeatable)")
+    parser.add_argument("--port", type=int, default=8190)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    uvicorn.run(create_router_app(args.worker), host="127.0.0.1", port=args.port)
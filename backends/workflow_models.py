@@ -0,0 +1,34 @@
+"""Which model files a ComfyUI workflow loads.
+
+Shared by the prompt router, which places prompts by the models they need, and
+the model prefetch, which counts model use in /history to decide what to warm.
+"""
+from typing import Any, Dict, Set
+
+# Node inputs that name a model file, by the ComfyUI model folder they load from
+MODEL_INPUTS = {
+    "ckpt_name": "checkpoints",
+    "unet_name": "diffusion_models",
+    "lora_name": "loras",
+    "vae_name": "vae",
+    "clip_name": "text_encoders",
+    "clip_name1": "text_encoders",
+    "clip_name2": "text_encoders",
+    "clip_name3": "text_encoders",
+    "control_net_name": "controlnet",
+    "upscale_model_name": "upscale_models",
+    "model_name": "models",
+}
+
+
+def required_models(workflow: Dict[str, Any]) -> Set[str]:
+    """Model files an API-format workflow loads, as "<folder>/<name>"."""
+    models = set()
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        for key, value in (node.get("inputs") or {}).items():
+            # Linked inputs are [node_id, slot] lists; only literal names count
+            if key in MODEL_INPUTS and isinstance(value, str) and value.lower() != "none":
+                models.add(f"{MODEL_INPUTS[key]}/{value}")
+    return models
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""Benchmark the model download paths against a local large-file server.
+
+A local aiohttp server serves sparse files of any size (they take no disk
+space and read back as zeros) with optional per-connection throttling, Range
+support that can be switched off, and injected connection drops. Every
+selected strategy downloads the same files from it; the results report MB/s,
+CPU seconds spent by this process and its children, and how the strategy coped
+with the drops.
+
+Strategies:
+    store       ModelStore.ingest() with a catalog: the ranged, hashing path
+                behind putfile() and model_downloader's /download jobs
+    ranged      backends.downloader.download() alone, without hashing or linking
+    sequential  wget, one file after another, as download_files_sequential runs
+    parallel    wget, files split over --workers concurrent workers, as
+                download_files_parallel_worker runs across containers
+
+Requires: pip install aiohttp requests (and wget for the wget strategies)
+
+Usage:
+    python download_benchmark.py [--size-gb 2] [--files 1] [--strategies store,ranged,sequential]
+        [--conn-mbps 0] [--no-range] [--drop-after-mb 0] [--max-drops 0] [-o results.json]
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+STRATEGIES = ("store", "ranged", "sequential", "parallel")
+SERVE_CHUNK_SIZE = 1024 * 1024
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark model download strategies against a local server.")
+    parser.add_argument("--size-gb", type=float, default=2.0, help="Size of each served file")
+    parser.add_argument("--files", type=int, default=1, help="Number of files each strategy downloads")
+    parser.add_argument("--strategies", default="store,ranged,sequential,parallel", help=f"Comma-separated, from: {', '.join(STRATEGIES)}")
+    parser.add_argument("--connections", type=int, default=8, help="Connections per file for the ranged strategies")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent workers for the parallel strategy")
+    parser.add_argument("--conn-mbps", type=float, default=0, help="Throttle each server connection to this many MB/s (0: off)")
+    parser.add_argument("--no-range", action="store_true", help="Ignore Range headers and always send the whole file")
+    parser.add_argument("--drop-after-mb", type=float, default=0, help="Cut each response after this many MB (0: never)")
+    parser.add_argument("--max-drops", type=int, default=0, help="Stop injecting drops after this many (0: unlimited)")
+    parser.add_argument("--port", type=int, default=8399)
+    parser.add_argument("--workdir", help="Where downloads are written (default: a temp dir)")
+    parser.add_argument("--no-verify", action="store_true", help="Skip the SHA-256 check of downloaded files")
+    parser.add_argument("-o", "--output", help="Also write the JSON results to this file")
+    return parser.parse_args()
+
+
+# -- file server -------------------------------------------------------------
+
+def run_server(port: int, files: Dict[str, str], conn_mbps: float, ranges: bool,
+               drop_after: int, max_drops: int, counters):
+    import asyncio
+
+    from aiohttp import web
+
+    def parse_range(header: str, size: int):
+        unit, _, spec = header.partition("=")
+        start, _, end = spec.split(",")[0].strip().partition("-")
+        if unit.strip() != "bytes" or not start:
+            return None
+        return int(start), min(int(end) if end else size - 1, size - 1)
+
+    async def serve(request):
+        path = files.get(request.match_info["name"])
+        if path is None:
+            raise web.HTTPNotFound()
+        st = os.stat(path)
+        size = st.st_size
+        headers = {"ETag": f'"{size:x}-{int(st.st_mtime):x}"', "Content-Type": "application/octet-stream"}
+        start, end, status = 0, size - 1, 200
+        if ranges:
+            headers["Accept-Ranges"] = "bytes"
+            requested = parse_range(request.headers.get("Range", ""), size)
+            if requested:
+                start, end = requested
+                status = 206
+                headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        length = end - start + 1
+        headers["Content-Length"] = str(length)
+        counters["requests"].value += 1
+
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        if request.method == "HEAD":
+            return response
+        rate = conn_mbps * 1e6
+        t0 = time.monotonic()
+        sent = 0
+        with open(path, "rb") as f:
+            f.seek(start)
+            while sent < length:
+                chunk = f.read(min(SERVE_CHUNK_SIZE, length - sent))
+                if drop_after and sent + len(chunk) > drop_after:
+                    with counters["drops"].get_lock():
+                        allowed = not max_drops or counters["drops"].value < max_drops
+                        if allowed:
+                            counters["drops"].value += 1
+                    if allowed:
+                        await response.write(chunk[: drop_after - sent])
+                        request.transport.close()
+                        return response
+                await response.write(chunk)
+                sent += len(chunk)
+                if rate:
+                    ahead = sent / rate - (time.monotonic() - t0)
+                    if ahead > 0:
+                        await asyncio.sleep(ahead)
+        return response
+
+    app = web.Application()
+    app.router.add_route("GET", "/files/{name}", serve)
+    app.router.add_route("HEAD", "/files/{name}", serve)
+    web.run_app(app, host="127.0.0.1", port=port, print=None)
+
+
+def wait_until_up(url: str, timeout: float = 30.0):
+    import requests
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.head(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+
+# -- strategies --------------------------------------------------------------
+
+def run_store(urls: List[str], dest: str, args) -> List[Dict]:
+    from backends.model_catalog import ModelCatalog
+    from backends.model_store import ModelStore
+
+    store = ModelStore(
+        root=os.path.join(dest, "blobs"),
+        models_root=os.path.join(dest, "models"),
+        catalog=ModelCatalog(root=os.path.join(dest, "catalog"), models_root=os.path.join(dest, "models")),
+    )
+    results = []
+    for i, url in enumerate(urls):
+        info = store.ingest(url, f"model_{i}.safetensors", ["checkpoints"], connections=args.connections)
+        results.append({"path": info["paths"][0], "sha256": info["sha256"]})
+    return results
+
+
+def run_ranged(urls: List[str], dest: str, args) -> List[Dict]:
+    from backends.downloader import download
+
+    results = []
+    for i, url in enumerate(urls):
+        result = download(url, os.path.join(dest, f"model_{i}.safetensors"), connections=args.connections)
+        results.append({"path": result.path, "resumed_bytes": result.resumed_bytes, "ranged": result.ranged})
+    return results
+
+
+def wget(url: str, path: str) -> Dict:
+    # Same invocation as scripts/modal/model_downloader.py
+    completed = subprocess.run(
+        ["wget", "-O", path, url, "--progress=bar", "--timeout=300"],
+        capture_output=True, text=True,
+    )
+    return {"path": path, "returncode": completed.returncode, "retries": completed.stderr.count("Retrying")}
+
+
+def run_sequential(urls: List[str], dest: str, args) -> List[Dict]:
+    return [wget(url, os.path.join(dest, f"model_{i}.safetensors")) for i, url in enumerate(urls)]
+
+
+def run_parallel(urls: List[str], dest: str, args) -> List[Dict]:
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        return list(pool.map(lambda item: wget(item[1], os.path.join(dest, f"model_{item[0]}.safetensors")), enumerate(urls)))
+
+
+RUNNERS = {"store": run_store, "ranged": run_ranged, "sequential": run_sequential, "parallel": run_parallel}
+
+
+def cpu_seconds() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(8 * 1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def benchmark(name: str, urls: List[str], workdir: str, expected: str, args, counters) -> Dict:
+    dest = os.path.join(workdir, name)
+    shutil.rmtree(dest, ignore_errors=True)
+    os.makedirs(dest)
+    requests_before, drops_before = counters["requests"].value, counters["drops"].value
+    cpu_before = cpu_seconds()
+    t0 = time.perf_counter()
+    error = None
+    try:
+        files = RUNNERS[name](urls, dest, args)
+    except Exception as e:
+        files, error = [], repr(e)
+    seconds = time.perf_counter() - t0
+    cpu = cpu_seconds() - cpu_before
+
+    complete = [f for f in files if os.path.isfile(f["path"]) and f.get("returncode", 0) == 0]
+    nbytes = sum(os.path.getsize(f["path"]) for f in complete)
+    verified = None
+    if expected and complete and not args.no_verify:
+        verified = all((f.get("sha256") or file_sha256(f["path"])) == expected for f in complete)
+    shutil.rmtree(dest, ignore_errors=True)
+    return {
+        "strategy": name,
+        "files_completed": len(complete),
+        "files_requested": len(urls),
+        "bytes": nbytes,
+        "seconds": round(seconds, 3),
+        "mb_s": round(nbytes / 1e6 / seconds, 2) if seconds else None,
+        "cpu_seconds": round(cpu, 3),
+        "cpu_percent": round(100 * cpu / seconds, 1) if seconds else None,
+        "http_requests": counters["requests"].value - requests_before,
+        "drops_injected": counters["drops"].value - drops_before,
+        "recovered": error is None and len(complete) == len(urls),
+        "verified": verified,
+        "error": error,
+        "details": [{k: v for k, v in f.items() if k not in ("path", "sha256")} for f in files],
+    }
+
+
+def main():
+    args = parse_args()
+    strategies = [s.strip() for s in args.strategies.split(",") if s.strip()]
+    for name in strategies:
+        if name not in RUNNERS:
+            raise SystemExit(f"Unknown strategy: {name}")
+    if any(s in ("sequential", "parallel") for s in strategies) and not shutil.which("wget"):
+        print("wget not found, skipping the wget strategies", file=sys.stderr)
+        strategies = [s for s in strategies if s not in ("sequential", "parallel")]
+    sys.path.insert(0, REPO_ROOT)
+
+    source_dir = tempfile.mkdtemp(prefix="dl-bench-src-")
+    workdir = args.workdir or tempfile.mkdtemp(prefix="dl-bench-")
+    size = int(args.size_gb * 1024 ** 3)
+    files = {}
+    for i in range(args.files):
+        path = os.path.join(source_dir, f"model_{i}.bin")
+        with open(path, "wb") as f:
+            f.truncate(size)  # sparse: no disk blocks are allocated
+        files[f"model_{i}.bin"] = path
+    urls = [f"http://127.0.0.1:{args.port}/files/{name}" for name in files]
+
+    ctx = multiprocessing.get_context("spawn")
+    counters = {"requests": ctx.Value("q", 0), "drops": ctx.Value("q", 0)}
+    server = ctx.Process(
+        target=run_server,
+        args=(args.port, files, args.conn_mbps, not args.no_range,
+              int(args.drop_after_mb * 1e6), args.max_drops, counters),
+        daemon=True,
+    )
+    server.start()
+    try:
+        wait_until_up(urls[0])
+        # All served files are zeros of the same size, so one digest covers them
+        expected = None if args.no_verify else file_sha256(files["model_0.bin"])
+        results = [benchmark(name, urls, workdir, expected, args, counters) for name in strategies]
+    finally:
+        server.terminate()
+        server.join(timeout=10)
+        shutil.rmtree(source_dir, ignore_errors=True)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps({
+        "config": {
+            "size_gb": args.size_gb,
+            "files": args.files,
+            "connections": args.connections,
+            "workers": args.workers,
+            "conn_mbps": args.conn_mbps,
+            "ranges": not args.no_range,
+            "drop_after_mb": args.drop_after_mb,
+            "max_drops": args.max_drops,
+        },
+        "results": results,
+    }, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
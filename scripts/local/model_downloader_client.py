@@ -2,7 +2,7 @@
 """CLI helper for triggering the Modal ``model_downloader`` endpoint.
 
 Usage:
-    python model_downloader_client.py -u <model_url> -n <filename> -s <subdir>
+    python model_downloader_client.py -u <model_url> -n <filename> -s <subdir> [--wait]
 
 Environment variables:
     DOWNLOADER_URL   Base URL of the model_downloader service, e.g.
@@ -20,6 +20,7 @@ import argparse
 import json
 import os
 import sys
+import time
 from typing import Any
 
 try:
@@ -40,24 +41,49 @@ def parse_args() -> argparse.Namespace:
         choices=["unet", "lora", "text_encoders", "vae", "diffusion_models"],
         help="Model subdirectory",
     )
+    parser.add_argument(
+        "-r",
+        "--refresh",
+        action="store_true",
+        help="Download the URL again even if it was fetched before (content changed upstream)",
+    )
+    parser.add_argument(
+        "-w",
+        "--wait",
+        action="store_true",
+        help="Poll the queued job and print progress until it finishes",
+    )
     return parser.parse_args()
 
 
-def post_json(endpoint: str, payload: dict[str, Any]) -> None:
+def request_json(method: str, endpoint: str, payload: dict[str, Any] | None = None) -> dict[str, Any]:
     try:
-        r = requests.post(endpoint, json=payload, timeout=30)
+        r = requests.request(method, endpoint, json=payload, timeout=30)
         r.raise_for_status()
     except requests.exceptions.RequestException as e:  # pragma: no cover
         sys.stderr.write(f"[ERROR] HTTP request failed: {e}\n")
         sys.exit(1)
 
     try:
-        data = r.json()
+        return r.json()
     except ValueError:  # pragma: no cover
         sys.stderr.write("[ERROR] Non-JSON response received:\n" + r.text + "\n")
         sys.exit(1)
 
-    print(json.dumps(data, indent=2))
+
+def wait_for_job(base_url: str, job_id: str, interval: float = 2.0) -> dict[str, Any]:
+    while True:
+        job = request_json("GET", f"{base_url}/jobs/{job_id}")
+        if job["status"] in ("completed", "failed"):
+            sys.stderr.write("\n")
+            return job
+        done_mb = job["bytes_done"] / 1e6
+        total_mb = f"{job['total_bytes'] / 1e6:.0f}" if job["total_bytes"] else "?"
+        eta = f"{job['eta_seconds']:.0f}s" if job["eta_seconds"] is not None else "?"
+        sys.stderr.write(
+            f"\r[{job['status']}] {done_mb:.0f}/{total_mb} MB  {job['throughput'] / 1e6:.1f} MB/s  ETA {eta}   "
+        )
+        time.sleep(interval)
 
 
 def main() -> None:
@@ -67,13 +93,19 @@ def main() -> None:
         sys.stderr.write("[ERROR] Please export DOWNLOADER_URL env-var first. See script header.\n")
         sys.exit(1)
 
-    endpoint = f"{base_url.rstrip('/')}/download"
+    base_url = base_url.rstrip("/")
     payload = {
         "url": args.url,
         "filename": args.name,
         "subdir": args.subdir,
+        "refresh": args.refresh,
     }
-    post_json(endpoint, payload)
+    job = request_json("POST", f"{base_url}/download", payload)
+    if args.wait:
+        job = wait_for_job(base_url, job["id"])
+    print(json.dumps(job, indent=2))
+    if job["status"] == "failed":
+        sys.exit(1)
 
 
 if __name__ == "__main__":
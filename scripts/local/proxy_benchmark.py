@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""Load-test the ComfyUI proxies against a local stand-in ComfyUI.
+
+A fake ComfyUI (aiohttp) serving ``/``, ``/prompt``, ``/view``,
+``/object_info`` and ``/ws`` is started in place of the real server, and the
+FastAPI proxy app from ``scripts/modal/comfy_app.py`` or
+``backends/comfy_backend.py`` is served in front of it with uvicorn. Each runs
+in its own process so the numbers are not mixed with the load generator. The
+driver then runs a weighted mix of concurrent HTTP requests plus a number of
+WebSocket sessions through the proxy and prints the results as JSON.
+
+Requires: pip install modal fastapi httpx websockets aiohttp uvicorn
+
+Usage:
+    python proxy_benchmark.py [--target comfy_app|comfy_backend] [--duration 30]
+        [--concurrency 32] [--mix view=4,object_info=1,prompt=2,index=1]
+        [--ws-clients 8] [-o results.json]
+
+Compare runs by diffing the JSON output, e.g. before and after a proxy change.
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import aiohttp
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+TARGETS = {
+    "comfy_app": os.path.join(REPO_ROOT, "scripts", "modal", "comfy_app.py"),
+    "comfy_backend": os.path.join(REPO_ROOT, "backends", "comfy_backend.py"),
+}
+ROUTES = {
+    "index": ("GET", "/"),
+    "object_info": ("GET", "/object_info"),
+    "view": ("GET", "/view?filename=ComfyUI_00001_.png&type=output"),
+    "prompt": ("POST", "/prompt"),
+    "queue": ("GET", "/prompt"),
+}
+DEFAULT_MIX = "view=4,object_info=1,prompt=2,queue=2,index=1"
+PREVIEW_EVENT = 1  # ComfyUI binary event type for preview images
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load-test a ComfyUI proxy against a local fake ComfyUI.")
+    parser.add_argument("--target", choices=sorted(TARGETS), default="comfy_app", help="Proxy implementation to test")
+    parser.add_argument("--duration", type=float, default=30.0, help="Measured seconds of load")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Seconds of load before measuring")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent HTTP clients")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Weighted routes, from: {', '.join(ROUTES)}")
+    parser.add_argument("--ws-clients", type=int, default=8, help="Concurrent WebSocket sessions (comfy_app only)")
+    parser.add_argument("--ws-fps", type=float, default=20.0, help="Preview frames per second sent to each session")
+    parser.add_argument("--view-kb", type=int, default=512, help="Size of /view responses")
+    parser.add_argument("--object-info-kb", type=int, default=2048, help="Size of the /object_info document")
+    parser.add_argument("--preview-kb", type=int, default=48, help="Size of each binary preview frame")
+    parser.add_argument("--comfyui-port", type=int, default=8188)
+    parser.add_argument("--proxy-port", type=int, default=8288)
+    parser.add_argument("-o", "--output", help="Also write the JSON results to this file")
+    return parser.parse_args()
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, weight = item.partition("=")
+        if name not in ROUTES:
+            raise SystemExit(f"Unknown route in --mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+# -- stand-in ComfyUI --------------------------------------------------------
+
+def make_fake_comfyui(view_bytes: int, object_info_bytes: int, preview_bytes: int, ws_fps: float):
+    from aiohttp import web
+
+    index_html = b"<!doctype html><html><head><title>ComfyUI</title></head><body>" + b"x" * 16384 + b"</body></html>"
+    # One node definition repeated until the document reaches the requested size
+    node = {
+        "input": {"required": {"ckpt_name": [["model.safetensors"]]}},
+        "output": ["MODEL", "CLIP", "VAE"],
+        "category": "loaders",
+        "description": "d" * 512,
+    }
+    node_size = len(json.dumps(node)) + 16
+    object_info = json.dumps(
+        {f"Node{i}": node for i in range(max(1, object_info_bytes // node_size))}
+    ).encode()
+    view_body = os.urandom(view_bytes)
+    preview_frame = struct.pack(">II", PREVIEW_EVENT, 2) + os.urandom(preview_bytes)
+    state = {"prompts": 0}
+
+    async def index(request):
+        return web.Response(body=index_html, content_type="text/html")
+
+    async def get_object_info(request):
+        return web.Response(body=object_info, content_type="application/json")
+
+    async def view(request):
+        return web.Response(body=view_body, content_type="image/png")
+
+    async def post_prompt(request):
+        await request.json()
+        state["prompts"] += 1
+        return web.json_response({"prompt_id": str(uuid.uuid4()), "number": state["prompts"], "node_errors": {}})
+
+    async def get_prompt(request):
+        return web.json_response({"exec_info": {"queue_remaining": 0}})
+
+    async def ws(request):
+        socket = web.WebSocketResponse(max_msg_size=0)
+        await socket.prepare(request)
+        client_id = request.query.get("clientId", "")
+        await socket.send_json({"type": "status", "data": {"status": {"exec_info": {"queue_remaining": 0}}, "sid": client_id}})
+        step = 0
+        try:
+            while not socket.closed:
+                step += 1
+                await socket.send_json({"type": "progress", "data": {"value": step % 20 + 1, "max": 20}})
+                await socket.send_bytes(preview_frame)
+                await asyncio.sleep(1 / ws_fps)
+        except (ConnectionResetError, RuntimeError):
+            pass
+        return socket
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_get("/", index)
+    app.router.add_get("/object_info", get_object_info)
+    app.router.add_get("/view", view)
+    app.router.add_post("/prompt", post_prompt)
+    app.router.add_get("/prompt", get_prompt)
+    app.router.add_get("/ws", ws)
+    return app
+
+
+def run_fake_comfyui(port: int, view_bytes: int, object_info_bytes: int, preview_bytes: int, ws_fps: float):
+    from aiohttp import web
+
+    web.run_app(
+        make_fake_comfyui(view_bytes, object_info_bytes, preview_bytes, ws_fps),
+        host="127.0.0.1", port=port, print=None,
+    )
+
+
+# -- proxy under test --------------------------------------------------------
+
+def run_proxy(target: str, port: int, comfyui_url: str):
+    import uvicorn
+
+    sys.path.insert(0, REPO_ROOT)
+    if target == "comfy_backend":
+        from backends.comfy_backend import create_proxy_app
+    else:
+        spec = importlib.util.spec_from_file_location("comfy_app", TARGETS[target])
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        create_proxy_app = module.create_proxy_app
+    uvicorn.run(create_proxy_app(comfyui_url), host="127.0.0.1", port=port, log_level="warning")
+
+
+def peak_rss_mb(pid: int) -> Optional[float]:
+    """High-water resident set size of a process (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+async def wait_until_up(url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    return
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+
+# -- load generation ---------------------------------------------------------
+
+def percentiles(samples: List[float]) -> Dict[str, Optional[float]]:
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1] * 1000, 3)}
+
+
+async def http_worker(session, base_url: str, mix: Dict[str, float], measure_from: float, stop_at: float, results: List):
+    names, weights = list(mix), list(mix.values())
+    payload = {"prompt": {"3": {"class_type": "KSampler", "inputs": {"seed": 0}}}, "client_id": "bench"}
+    while time.monotonic() < stop_at:
+        name = random.choices(names, weights)[0]
+        method, path = ROUTES[name]
+        t0 = time.monotonic()
+        try:
+            async with session.request(method, base_url + path, json=payload if method == "POST" else None) as response:
+                body = await response.read()
+                ok, nbytes = response.status < 400, len(body)
+        except aiohttp.ClientError:
+            ok, nbytes = False, 0
+        t1 = time.monotonic()
+        if t0 >= measure_from:
+            results.append((name, t1 - t0, ok, nbytes))
+
+
+async def ws_worker(ws_url: str, measure_from: float, stop_at: float, results: List):
+    stats = {"connect_seconds": None, "text_frames": 0, "binary_frames": 0, "bytes": 0, "error": None}
+    try:
+        async with aiohttp.ClientSession() as session:
+            t0 = time.monotonic()
+            async with session.ws_connect(f"{ws_url}?clientId={uuid.uuid4().hex}", max_msg_size=0) as socket:
+                stats["connect_seconds"] = time.monotonic() - t0
+                while time.monotonic() < stop_at:
+                    try:
+                        message = await socket.receive(timeout=max(0.01, stop_at - time.monotonic()))
+                    except asyncio.TimeoutError:
+                        break
+                    if message.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                        stats["error"] = "closed early"
+                        break
+                    if time.monotonic() < measure_from:
+                        continue
+                    if message.type == aiohttp.WSMsgType.BINARY:
+                        stats["binary_frames"] += 1
+                        stats["bytes"] += len(message.data)
+                    elif message.type == aiohttp.WSMsgType.TEXT:
+                        stats["text_frames"] += 1
+                        stats["bytes"] += len(message.data)
+    except (aiohttp.ClientError, OSError) as e:
+        stats["error"] = repr(e)
+    results.append(stats)
+
+
+async def drive(args, mix: Dict[str, float]) -> Dict:
+    base_url = f"http://127.0.0.1:{args.proxy_port}"
+    ws_clients = args.ws_clients if args.target == "comfy_app" else 0
+    start = time.monotonic()
+    measure_from = start + args.warmup
+    stop_at = measure_from + args.duration
+
+    http_results, ws_results = [], []
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(
+            *(http_worker(session, base_url, mix, measure_from, stop_at, http_results) for _ in range(args.concurrency)),
+            *(ws_worker(f"ws://127.0.0.1:{args.proxy_port}/ws", measure_from, stop_at, ws_results) for _ in range(ws_clients)),
+        )
+    elapsed = time.monotonic() - measure_from
+
+    routes = {}
+    for name in mix:
+        samples = [r for r in http_results if r[0] == name]
+        routes[name] = {
+            "requests": len(samples),
+            "errors": sum(1 for r in samples if not r[2]),
+            "latency_ms": percentiles([r[1] for r in samples]),
+        }
+    total_bytes = sum(r[3] for r in http_results)
+    ws_frames = sum(s["text_frames"] + s["binary_frames"] for s in ws_results)
+    return {
+        "http": {
+            "requests": len(http_results),
+            "errors": sum(1 for r in http_results if not r[2]),
+            "throughput_rps": round(len(http_results) / elapsed, 2),
+            "throughput_mb_s": round(total_bytes / 1e6 / elapsed, 2),
+            "latency_ms": percentiles([r[1] for r in http_results]),
+            "routes": routes,
+        },
+        "ws": {
+            "sessions": ws_clients,
+            "failed_sessions": sum(1 for s in ws_results if s["error"]),
+            "frames_per_second": round(ws_frames / elapsed, 2),
+            "binary_frames": sum(s["binary_frames"] for s in ws_results),
+            "mb_s": round(sum(s["bytes"] for s in ws_results) / 1e6 / elapsed, 2),
+            "connect_ms": percentiles([s["connect_seconds"] for s in ws_results if s["connect_seconds"] is not None]),
+        },
+        "measured_seconds": round(elapsed, 2),
+    }
+
+
+def main():
+    args = parse_args()
+    mix = parse_mix(args.mix)
+    comfyui_url = f"http://127.0.0.1:{args.comfyui_port}"
+
+    ctx = multiprocessing.get_context("spawn")
+    comfyui = ctx.Process(
+        target=run_fake_comfyui,
+        args=(args.comfyui_port, args.view_kb * 1024, args.object_info_kb * 1024, args.preview_kb * 1024, args.ws_fps),
+        daemon=True,
+    )
+    proxy = ctx.Process(target=run_proxy, args=(args.target, args.proxy_port, comfyui_url), daemon=True)
+    comfyui.start()
+    proxy.start()
+    try:
+        asyncio.run(wait_until_up(f"{comfyui_url}/prompt"))
+        asyncio.run(wait_until_up(f"http://127.0.0.1:{args.proxy_port}/prompt"))
+        results = asyncio.run(drive(args, mix))
+        results.update({
+            "target": args.target,
+            "config": {
+                "duration": args.duration,
+                "concurrency": args.concurrency,
+                "mix": mix,
+                "ws_clients": args.ws_clients if args.target == "comfy_app" else 0,
+                "ws_fps": args.ws_fps,
+                "view_kb": args.view_kb,
+                "object_info_kb": args.object_info_kb,
+                "preview_kb": args.preview_kb,
+            },
+            "proxy_peak_rss_mb": peak_rss_mb(proxy.pid),
+        })
+    finally:
+        for process in (proxy, comfyui):
+            process.terminate()
+            process.join(timeout=10)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
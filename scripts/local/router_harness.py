@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""Exercise backends/prompt_router.py against local stand-in ComfyUI workers.
+
+Each fake worker (aiohttp) runs one prompt at a time and keeps the last few
+models it ran "loaded"; a prompt that needs a model the worker does not have
+pays ``--reload-ms`` per missing model on top of ``--run-ms``. The router is
+served with uvicorn in front of the workers and the driver sends a skewed mix
+of ``/run`` workflows through it, then checks that answers carry their worker,
+that ``/history`` finds the worker that ran a prompt and that ``/workers/N/view``
+streams the worker's file intact. Every process runs on its own so the numbers
+are not mixed with the load generator.
+
+With ``--baseline`` the same workflows are also sent round-robin straight to
+the workers, so the reload counts and latencies can be compared with the
+router's affinity placement.
+
+Requires: pip install fastapi httpx aiohttp uvicorn
+
+Usage:
+    python router_harness.py [--workers 2] [--models 16] [--requests 200]
+        [--concurrency 8] [--baseline] [-o results.json]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List
+
+import aiohttp
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Drive the prompt router against local fake ComfyUI workers.")
+    parser.add_argument("--workers", type=int, default=2, help="Fake workers behind the router")
+    parser.add_argument("--models", type=int, default=16, help="Distinct checkpoints used by the workload")
+    # The router assumes MAX_RESIDENT_MODELS (8) per worker; lower values show
+    # what happens when workers hold fewer models than the router thinks
+    parser.add_argument("--resident", type=int, default=8, help="Models each fake worker keeps loaded")
+    parser.add_argument("--requests", type=int, default=200, help="/run requests to send")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--run-ms", type=float, default=20.0, help="Time a prompt takes with its models loaded")
+    parser.add_argument("--reload-ms", type=float, default=200.0, help="Extra time per model a worker has to load")
+    parser.add_argument("--inline-kb", type=int, default=256, help="Size of the output data in each /run answer")
+    parser.add_argument("--view-kb", type=int, default=4096, help="Size of the file served by /view")
+    parser.add_argument("--baseline", action="store_true", help="Also send the workload round-robin to the workers")
+    parser.add_argument("--worker-port", type=int, default=8388, help="Port of the first worker")
+    parser.add_argument("--router-port", type=int, default=8290)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="Also write the JSON results to this file")
+    return parser.parse_args()
+
+
+# -- stand-in worker ---------------------------------------------------------
+
+def make_fake_worker(resident: int, run_seconds: float, reload_seconds: float, inline_bytes: int, view_bytes: int):
+    from aiohttp import web
+
+    sys.path.insert(0, REPO_ROOT)
+    from backends.workflow_models import required_models
+
+    loaded: "OrderedDict[str, None]" = OrderedDict()
+    gpu = asyncio.Lock()
+    history: Dict[str, Dict] = {}
+    state = {"waiting": 0, "runs": 0, "reloads": 0}
+    # Stands in for base64 image data in an inline /run answer
+    inline_data = "A" * inline_bytes
+    view_body = os.urandom(view_bytes)
+
+    async def execute(prompt_id: str, workflow: Dict) -> Dict:
+        models = required_models(workflow)
+        state["waiting"] += 1
+        try:
+            async with gpu:
+                state["waiting"] -= 1
+                missing = [m for m in models if m not in loaded]
+                await asyncio.sleep(run_seconds + reload_seconds * len(missing))
+                for model in models:
+                    loaded[model] = None
+                    loaded.move_to_end(model)
+                while len(loaded) > resident:
+                    loaded.popitem(last=False)
+                state["runs"] += 1
+                state["reloads"] += len(missing)
+        except BaseException:
+            state["waiting"] = max(0, state["waiting"] - 1)
+            raise
+        history[prompt_id] = {"status": {"completed": True}, "outputs": {}}
+        return {"prompt_id": prompt_id, "reloaded": len(missing)}
+
+    async def post_prompt(request):
+        body = await request.json()
+        prompt_id = body.get("prompt_id") or uuid.uuid4().hex
+        asyncio.ensure_future(execute(prompt_id, body["prompt"]))
+        return web.json_response({"prompt_id": prompt_id, "number": state["runs"], "node_errors": {}})
+
+    async def get_prompt(request):
+        return web.json_response({"exec_info": {"queue_remaining": state["waiting"]}})
+
+    async def run(request):
+        body = await request.json()
+        workflow = body["prompt"] if isinstance(body.get("prompt"), dict) else body
+        result = await execute(uuid.uuid4().hex, workflow)
+        outputs = [{"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}]
+        if request.query.get("inline") in ("1", "true"):
+            outputs[0]["data"] = inline_data
+        return web.json_response({**result, "outputs": outputs})
+
+    async def get_history(request):
+        prompt_id = request.match_info["prompt_id"]
+        return web.json_response({prompt_id: history[prompt_id]} if prompt_id in history else {})
+
+    async def view(request):
+        return web.Response(body=view_body, content_type="image/png")
+
+    async def stats(request):
+        return web.json_response({**state, "loaded": list(loaded)})
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/prompt", post_prompt)
+    app.router.add_get("/prompt", get_prompt)
+    app.router.add_post("/run", run)
+    app.router.add_get("/history/{prompt_id}", get_history)
+    app.router.add_get("/view", view)
+    app.router.add_get("/harness/stats", stats)
+    return app
+
+
+def run_fake_worker(port: int, *config):
+    from aiohttp import web
+
+    web.run_app(make_fake_worker(*config), host="127.0.0.1", port=port, print=None)
+
+
+# -- router under test -------------------------------------------------------
+
+def run_router(port: int, worker_urls: List[str]):
+    import uvicorn
+
+    sys.path.insert(0, REPO_ROOT)
+    from backends.prompt_router import create_router_app
+
+    uvicorn.run(create_router_app(worker_urls, poll_interval=0.5), host="127.0.0.1", port=port, log_level="warning")
+
+
+async def wait_until_up(url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    return
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+
+# -- load generation ---------------------------------------------------------
+
+def percentiles(samples: List[float]) -> Dict:
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1] * 1000, 3)}
+
+
+def make_workload(models: int, requests: int, seed: int) -> List[Dict]:
+    rng = random.Random(seed)
+    # Skewed, as real model popularity is
+    weights = [1 / (i + 1) for i in range(models)]
+    workflows = []
+    for index in rng.choices(range(models), weights=weights, k=requests):
+        workflows.append({
+            "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": f"model_{index}.safetensors"}},
+            "3": {"class_type": "KSampler", "inputs": {"seed": rng.randrange(1 << 32), "model": ["4", 0]}},
+        })
+    return workflows
+
+
+async def send_all(urls: List[str], workflows: List[Dict], concurrency: int) -> List[Dict]:
+    """POST every workflow to /run, cycling through urls; return one result per request."""
+    pending = list(enumerate(workflows))
+    results: List[Dict] = []
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async def client(session):
+        while pending:
+            index, workflow = pending.pop(0)
+            url = urls[index % len(urls)]
+            t0 = time.monotonic()
+            try:
+                async with session.post(f"{url}/run", params={"inline": "true"}, json={"prompt": workflow}) as response:
+                    body = await response.json()
+                    ok = response.status == 200
+            except (aiohttp.ClientError, ValueError) as e:
+                body, ok = {"error": repr(e)}, False
+            results.append({"seconds": time.monotonic() - t0, "ok": ok, "body": body})
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+    return results
+
+
+async def worker_stats(worker_urls: List[str]) -> List[Dict]:
+    async with aiohttp.ClientSession() as session:
+        stats = []
+        for url in worker_urls:
+            async with session.get(f"{url}/harness/stats") as response:
+                stats.append(await response.json())
+        return stats
+
+
+def summarize(results: List[Dict], before: List[Dict], after: List[Dict], elapsed: float) -> Dict:
+    return {
+        "requests": len(results),
+        "errors": sum(1 for r in results if not r["ok"]),
+        "throughput_rps": round(len(results) / elapsed, 2),
+        "latency_ms": percentiles([r["seconds"] for r in results]),
+        "model_reloads": sum(a["reloads"] - b["reloads"] for a, b in zip(after, before)),
+        "runs_per_worker": [a["runs"] - b["runs"] for a, b in zip(after, before)],
+    }
+
+
+async def check_router(router_url: str, results: List[Dict], workers: int, view_bytes: int) -> Dict:
+    """Spot-check the routing bookkeeping and the streamed passthrough."""
+    tagged = [r for r in results if r["ok"] and isinstance(r["body"].get("worker"), int)]
+    checks = {"answers_with_worker": len(tagged), "history_found": 0, "view_bytes": []}
+    async with aiohttp.ClientSession() as session:
+        for result in tagged[:20]:
+            prompt_id = result["body"]["prompt_id"]
+            async with session.get(f"{router_url}/history/{prompt_id}") as response:
+                if response.status == 200 and prompt_id in await response.json():
+                    checks["history_found"] += 1
+        for index in range(workers):
+            async with session.get(f"{router_url}/workers/{index}/view", params={"filename": "x.png"}) as response:
+                checks["view_bytes"].append(len(await response.read()))
+    checks["view_intact"] = all(n == view_bytes for n in checks["view_bytes"])
+    return checks
+
+
+async def drive(args, worker_urls: List[str], router_url: str) -> Dict:
+    workflows = make_workload(args.models, args.requests, args.seed)
+    results = {}
+
+    before = await worker_stats(worker_urls)
+    t0 = time.monotonic()
+    routed = await send_all([router_url], workflows, args.concurrency)
+    elapsed = time.monotonic() - t0
+    after = await worker_stats(worker_urls)
+    results["router"] = summarize(routed, before, after, elapsed)
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{router_url}/router/stats") as response:
+            results["router"]["placement"] = await response.json()
+    results["router"]["checks"] = await check_router(router_url, routed, len(worker_urls), args.view_kb * 1024)
+
+    if args.baseline:
+        before = after
+        t0 = time.monotonic()
+        direct = await send_all(worker_urls, workflows, args.concurrency)
+        elapsed = time.monotonic() - t0
+        results["round_robin"] = summarize(direct, before, await worker_stats(worker_urls), elapsed)
+    return results
+
+
+def main():
+    args = parse_args()
+    worker_urls = [f"http://127.0.0.1:{args.worker_port + i}" for i in range(args.workers)]
+    router_url = f"http://127.0.0.1:{args.router_port}"
+    config = (args.resident, args.run_ms / 1000, args.reload_ms / 1000, args.inline_kb * 1024, args.view_kb * 1024)
+
+    ctx = multiprocessing.get_context("spawn")
+    processes = [
+        ctx.Process(target=run_fake_worker, args=(args.worker_port + i, *config), daemon=True)
+        for i in range(args.workers)
+    ]
+    router = ctx.Process(target=run_router, args=(args.router_port, worker_urls), daemon=True)
+    for process in processes:
+        process.start()
+    processes.append(router)
+    try:
+        for url in worker_urls:
+            asyncio.run(wait_until_up(f"{url}/prompt"))
+        # Started once the workers answer, so its first poll finds them healthy
+        router.start()
+        asyncio.run(wait_until_up(f"{router_url}/router/stats"))
+        results = asyncio.run(drive(args, worker_urls, router_url))
+        results["config"] = {
+            key: getattr(args, key)
+            for key in ("workers", "models", "resident", "requests", "concurrency", "run_ms", "reload_ms", "inline_kb")
+        }
+    finally:
+        # Router first, so it doesn't log the workers going away
+        for process in reversed(processes):
+            if process.is_alive():
+                process.terminate()
+                process.join(timeout=10)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,9 +12,23 @@ st.caption("Local interface for interacting with the Modal deployment of ComfyUI
 # Modal function handles
 client = modal.Client()
 putfile = modal.Function.lookup("comfyui-app", "putfile")
-list_models_fn = modal.Function.lookup("comfyui-app", "list_models")
+query_models_fn = modal.Function.lookup("comfyui-app", "query_models")
 server_handle = modal.Function.lookup("comfyui-app", "ComfyUIServer.asgi_app")
 
+PAGE_SIZE = 50
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def query_models(subdirs: tuple, search: str, page: int) -> dict:
+    # Cached so Streamlit reruns don't each trigger a remote call
+    return query_models_fn.remote(
+        subdirs=list(subdirs) or None,
+        search=search or None,
+        offset=page * PAGE_SIZE,
+        limit=PAGE_SIZE,
+    )
+
+
 tabs = st.tabs(["Server", "Models"])
 
 with tabs[0]:
@@ -34,17 +48,31 @@ with tabs[1]:
     allowed_dirs = ["unet", "lora", "text_encoders", "vae", "diffusion_models"]
     subdir = st.selectbox("Model subdirectory", allowed_dirs, index=2)
 
-    try:
-        files = list_models_fn.call(subdir)
-    except Exception as e:
-        files = []
-        st.error(f"Unable to list models: {e}")
-
     col1, col2 = st.columns(2)
     with col1:
         st.markdown("### Existing files")
-        if files:
-            st.write(files)
+        filter_dirs = st.multiselect("Filter subdirectories", allowed_dirs)
+        search = st.text_input("Search by name")
+        page = st.number_input("Page", min_value=1, value=1, step=1) - 1
+        try:
+            result = query_models(tuple(filter_dirs), search, int(page))
+        except Exception as e:
+            result = {"total": 0, "items": []}
+            st.error(f"Unable to list models: {e}")
+        if result["items"]:
+            st.caption(f"{result['total']} models")
+            st.dataframe(
+                [
+                    {
+                        "subdir": item["subdir"],
+                        "name": item["name"],
+                        "size (MB)": round(item["size"] / 1e6, 1),
+                        "sha256": (item["sha256"] or "")[:12],
+                    }
+                    for item in result["items"]
+                ],
+                use_container_width=True,
+            )
         else:
             st.write("(no files found)")
 
@@ -55,7 +83,8 @@ with tabs[1]:
         if st.button("Download") and url and filename:
             with st.spinner("Downloading..."):
                 try:
-                    putfile.call(url, filename, subdir)
+                    putfile.call(url, filename, subdir, flush=True)
+                    query_models.clear()
                     st.success("Download complete")
                 except Exception as e:
                     st.error(f"Failed to download: {e}")
@@ -15,32 +15,8 @@ fi
 
 # Ensure Python helper exists
 if [ ! -f "$PYTHON_SCRIPT" ]; then
-cat <<'PYEOF' > "$PYTHON_SCRIPT"
-import sys
-import modal
-import os
-
-app = modal.App("volume-uploader")
-
-volume_name = sys.argv[1]
-local_files = sys.argv[2].split(",")
-remote_dir = sys.argv[3]
-
-vol = modal.Volume.persisted(volume_name)
-
-@app.function(volumes={"/vol": vol})
-def put_files():
-    for local_path in local_files:
-        local_path = local_path.strip()
-        fname = os.path.basename(local_path)
-        remote_path = os.path.join("/vol", remote_dir, fname)
-        os.makedirs(os.path.dirname(remote_path), exist_ok=True)
-        with open(local_path, "rb") as src, open(remote_path, "wb") as dst:
-            dst.write(src.read())
-        print(f"Uploaded: {local_path} -> {remote_path}")
-
-put_files()
-PYEOF
+    echo "Missing $PYTHON_SCRIPT" >&2
+    exit 1
 fi
 
 # Main menu
@@ -53,10 +29,10 @@ select opt in "list" "put" "rm" "quit"; do
             break
             ;;
         "put")
-            read -p "Enter comma-separated local paths: " LOCAL_PATHS
+            read -p "Enter comma-separated local paths (files, directories or globs): " LOCAL_PATHS
             read -p "Enter remote path (prefix, e.g. models/ or /): " REMOTE_PATH
             echo "Uploading to volume..."
-            modal run "$PYTHON_SCRIPT" $VOLUME_NAME "$LOCAL_PATHS" "$REMOTE_PATH"
+            python "$PYTHON_SCRIPT" $VOLUME_NAME "$LOCAL_PATHS" "$REMOTE_PATH"
             break
             ;;
         "rm")
@@ -1,15 +1,33 @@
 import modal
+import asyncio
+import base64
+import hashlib
+import json
 import os
 import subprocess
 import time
 import logging
-from typing import Dict, Any
+import uuid
+from urllib.parse import urlencode
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Deque, Dict, Any, List, Optional, Union
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = modal.App("comfyui-app")
 volume = modal.Volume.from_name("comfyui-storage")
+# Object keys of the outputs offloaded to R2, by prompt id (see backends/output_offload.py)
+output_records = modal.Dict.from_name("comfyui-output-records", create_if_missing=True)
+# R2 credentials for the output offloader. Only attached when deploying with
+# OUTPUT_OFFLOAD=1, so ComfyUI deploys without a cloudflare-storage secret
+offload_secrets = (
+    [modal.Secret.from_name("cloudflare-storage", required_keys=["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"])]
+    if os.environ.get("OUTPUT_OFFLOAD") == "1"
+    else []
+)
 
 image = (
     modal.Image.debian_slim(python_version="3.10")
@@ -26,35 +44,457 @@ image = (
         "httpx",
         "requests",
         "websockets",
-        "python-multipart"
+        "python-multipart",
+        "boto3",
     )
     .run_commands("git clone https://github.com/comfyanonymous/ComfyUI /root/ComfyUI")
     .run_commands("cd /root/ComfyUI && pip install -r requirements.txt")
+    # Shared helpers (downloader, ...) from the repo's backends package
+    .add_local_dir(Path(__file__).resolve().parent.parent.parent / "backends", remote_path="/root/backends")
 )
 
+COMFYUI_DIR = "/root/ComfyUI"
+COMFYUI_URL = "http://127.0.0.1:8188"
+
+# Folder links, the startup probe and proxy header filtering come from
+# backends/comfy_proxy.py, shared with backends/comfy_backend.py
+
+
+# Frontend assets and node definitions only change when ComfyUI, its custom
+# nodes or the models on the volume change, so the proxy can serve them from
+# memory. /object_info lists every checkpoint, LoRA and VAE in its node
+# dropdowns, so model folders and the catalog journal are watched too.
+PROXY_CACHE_MAX_ENTRIES = 1024
+PROXY_CACHE_MAX_BYTES = 256 * 1024 * 1024
+PROXY_CACHE_MAX_ENTRY_BYTES = 32 * 1024 * 1024
+PROXY_CACHE_ROUTES = ("/", "/object_info", "/api/object_info")
+PROXY_CACHE_SUFFIXES = (
+    ".js", ".mjs", ".css", ".map", ".html", ".svg", ".png", ".ico",
+    ".woff", ".woff2", ".ttf", ".json",
+)
+CUSTOM_NODES_DIR = "/storage/custom_nodes"
+MODELS_DIR = "/storage/models"
+CATALOG_DIR = "/storage/catalog"
+CUSTOM_NODES_POLL_INTERVAL = 10.0
+
+
+def is_cacheable_route(path: str) -> bool:
+    """Return True for GET routes whose responses only change with the installed nodes."""
+    if path in PROXY_CACHE_ROUTES or path.startswith(("/object_info/", "/api/object_info/")):
+        return True
+    # API routes (userdata, history, /view outputs) are mutable; only static files qualify
+    if path.startswith(("/api/", "/view", "/userdata", "/history", "/queue")):
+        return False
+    return path.endswith(PROXY_CACHE_SUFFIXES)
+
+
+def _hash_dir(digest, root: str):
+    """Feed the mtimes of root and of each entry directly inside it into digest."""
+    try:
+        digest.update(f"{root}:{os.stat(root).st_mtime_ns};".encode())
+        with os.scandir(root) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                digest.update(f"{entry.name}:{entry.stat(follow_symlinks=False).st_mtime_ns};".encode())
+    except FileNotFoundError:
+        pass
+
+
+def custom_nodes_fingerprint(root: str = CUSTOM_NODES_DIR) -> str:
+    """Hash the names and mtimes of the installed custom node packages."""
+    digest = hashlib.sha1()
+    _hash_dir(digest, root)
+    return digest.hexdigest()
+
+
+def proxy_cache_fingerprint(
+    custom_nodes: str = CUSTOM_NODES_DIR, models: str = MODELS_DIR, catalog: str = CATALOG_DIR
+) -> str:
+    """Changes whenever a custom node package or a model is added, removed or replaced."""
+    digest = hashlib.sha1(custom_nodes_fingerprint(custom_nodes).encode())
+    # A file landing in models/<subdir>/ bumps that subdir's mtime
+    _hash_dir(digest, models)
+    try:
+        subdirs = sorted(e.path for e in os.scandir(models) if e.is_dir())
+    except FileNotFoundError:
+        subdirs = []
+    for subdir in subdirs:
+        _hash_dir(digest, subdir)
+    # Every putfile() and /download ingest appends a catalog journal file
+    _hash_dir(digest, os.path.join(catalog, "journal"))
+    return digest.hexdigest()
+
+
+@dataclass
+class CachedResponse:
+    status_code: int
+    headers: Dict[str, str]
+    body: bytes
+    etag: str
+
+
+class ResponseCache:
+    """Bounded LRU of upstream GET responses with miss coalescing."""
+
+    def __init__(
+        self,
+        max_entries: int = PROXY_CACHE_MAX_ENTRIES,
+        max_bytes: int = PROXY_CACHE_MAX_BYTES,
+        max_entry_bytes: int = PROXY_CACHE_MAX_ENTRY_BYTES,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.not_modified = 0
+        self.invalidations = 0
+
+    def _store(self, key: str, entry: CachedResponse):
+        size = len(entry.body)
+        if entry.status_code != 200 or size > self.max_entry_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old.body)
+        self._entries[key] = entry
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted.body)
+
+    async def fetch(
+        self, key: str, loader: Callable[[], Awaitable[CachedResponse]]
+    ) -> "tuple[CachedResponse, bool]":
+        """Return (entry, hit) for key, calling loader once for concurrent misses."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry, True
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending), True
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            entry = await loader()
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting
+            future.exception()
+            raise
+        else:
+            self._store(key, entry)
+            future.set_result(entry)
+            return entry, False
+        finally:
+            self._inflight.pop(key, None)
+
+    def invalidate(self):
+        self._entries.clear()
+        self._bytes = 0
+        self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "not_modified": self.not_modified,
+            "invalidations": self.invalidations,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an entity tag."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    bare = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == bare for tag in if_none_match.split(","))
+
+
+# ComfyUI binary websocket event types (first 4 bytes, big-endian). Everything
+# except TEXT carries a latent preview that the next preview makes obsolete.
+WS_PREVIEW_EVENTS = {1, 2, 4}  # PREVIEW_IMAGE, UNENCODED_PREVIEW_IMAGE, PREVIEW_IMAGE_WITH_METADATA
+WS_SEND_QUEUE_SIZE = 64
+WS_MAX_FRAME_BYTES = 16 * 1024 * 1024
+
+
+def is_preview_frame(frame: Union[str, bytes]) -> bool:
+    return (
+        isinstance(frame, (bytes, bytearray))
+        and len(frame) >= 4
+        and int.from_bytes(frame[:4], "big") in WS_PREVIEW_EVENTS
+    )
+
+
+class OutboundFrames:
+    """Bounded per-connection send queue that keeps only the newest pending preview.
+
+    Status, progress and executed messages are never dropped: when the queue is
+    full the producer waits, which applies backpressure to the upstream socket.
+    After ``close()`` the frames still queued are handed out, then ``get()``
+    returns None.
+    """
+
+    def __init__(self, maxsize: int = WS_SEND_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self._frames: Deque[Union[str, bytes]] = deque()
+        self._pending_preview: Optional[bytes] = None
+        self._changed = asyncio.Condition()
+        self._closed = False
+        self.dropped_previews = 0
+
+    async def put(self, frame: Union[str, bytes]):
+        async with self._changed:
+            if is_preview_frame(frame):
+                if self._pending_preview is not None:
+                    for i, queued in enumerate(self._frames):
+                        if queued is self._pending_preview:
+                            del self._frames[i]
+                            break
+                    self.dropped_previews += 1
+                self._pending_preview = frame
+            else:
+                await self._changed.wait_for(lambda: len(self._frames) < self.maxsize)
+            self._frames.append(frame)
+            self._changed.notify_all()
+
+    async def close(self):
+        async with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+
+    async def get(self) -> Optional[Union[str, bytes]]:
+        async with self._changed:
+            await self._changed.wait_for(lambda: bool(self._frames) or self._closed)
+            if not self._frames:
+                return None
+            frame = self._frames.popleft()
+            if frame is self._pending_preview:
+                self._pending_preview = None
+            self._changed.notify_all()
+            return frame
+
+
+# Synchronous /run executions are tracked over one internal WebSocket per proxy
+# instead of one upstream socket (and public round trips) per client.
+RUN_TIMEOUT = 600.0
+# Events for prompts nobody has subscribed to yet, kept in case the subscriber
+# is about to arrive (e.g. the prompt finished before /prompt returned)
+TRACKER_ORPHAN_PROMPTS = 256
+RUN_TERMINAL_EVENTS = {"execution_success", "execution_error", "execution_interrupted"}
+
+
+class RunError(Exception):
+    def __init__(self, status_code: int, detail: Any):
+        super().__init__(f"ComfyUI rejected the prompt ({status_code})")
+        self.status_code = status_code
+        self.detail = detail
+
+
+def is_terminal_event(kind: str, data: Dict[str, Any]) -> bool:
+    # Older ComfyUI versions only signal completion with executing(node=None)
+    return kind in RUN_TERMINAL_EVENTS or (kind == "executing" and data.get("node") is None)
+
+
+def output_files(outputs: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Flatten /history outputs into file records with a proxy-relative /view URL."""
+    files = []
+    for node_id, node_output in outputs.items():
+        for kind, items in node_output.items():
+            if not isinstance(items, list):
+                continue
+            for item in items:
+                if isinstance(item, dict) and "filename" in item:
+                    query = {
+                        "filename": item["filename"],
+                        "subfolder": item.get("subfolder", ""),
+                        "type": item.get("type", "output"),
+                    }
+                    files.append({"node": node_id, "kind": kind, **query, "url": f"/view?{urlencode(query)}"})
+    return files
+
+
+class PromptTracker:
+    """Follow prompt execution for many callers over a single ComfyUI WebSocket.
+
+    Prompts are submitted with the tracker's client id, so ComfyUI sends their
+    progress and completion events to this one socket, where they are routed to
+    a queue per prompt id. If the socket drops, pending prompts are checked
+    against /history after reconnecting so a completion is never missed.
+    """
+
+    def __init__(self, client, ws_url: str):
+        self.client = client
+        self.client_id = uuid.uuid4().hex
+        self.ws_url = f"{ws_url}?{urlencode({'clientId': self.client_id})}"
+        self._subscribers: Dict[str, asyncio.Queue] = {}
+        self._orphans: "OrderedDict[str, List]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+        self.connected = asyncio.Event()
+        self.runs = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        import websockets
+
+        delay = 0.1
+        while True:
+            try:
+                async with websockets.connect(self.ws_url, max_size=WS_MAX_FRAME_BYTES) as socket:
+                    delay = 0.1
+                    self.connected.set()
+                    await self._reconcile()
+                    async for frame in socket:
+                        # Binary frames are previews; /run callers only need events
+                        if isinstance(frame, str):
+                            self._dispatch(json.loads(frame))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Run tracker socket lost: {e!r}")
+            self.connected.clear()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5.0)
+
+    def _dispatch(self, message: Dict[str, Any]):
+        data = message.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if not prompt_id:
+            return
+        event = (message.get("type"), data)
+        queue = self._subscribers.get(prompt_id)
+        if queue is not None:
+            queue.put_nowait(event)
+            return
+        self._orphans.setdefault(prompt_id, []).append(event)
+        self._orphans.move_to_end(prompt_id)
+        while len(self._orphans) > TRACKER_ORPHAN_PROMPTS:
+            self._orphans.popitem(last=False)
+
+    def subscribe(self, prompt_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        for event in self._orphans.pop(prompt_id, []):
+            queue.put_nowait(event)
+        self._subscribers[prompt_id] = queue
+        return queue
+
+    def unsubscribe(self, prompt_id: str):
+        self._subscribers.pop(prompt_id, None)
+
+    async def _reconcile(self):
+        for prompt_id, queue in list(self._subscribers.items()):
+            try:
+                entry = (await self.history(prompt_id)).get(prompt_id)
+            except Exception:
+                continue
+            status = (entry or {}).get("status", {})
+            if status.get("completed"):
+                queue.put_nowait(("execution_success", {"prompt_id": prompt_id}))
+            elif status.get("status_str") == "error":
+                queue.put_nowait(("execution_error", {"prompt_id": prompt_id, "exception_message": "failed while the tracker was disconnected"}))
+
+    async def history(self, prompt_id: str) -> Dict[str, Any]:
+        response = await self.client.get(f"/history/{prompt_id}")
+        response.raise_for_status()
+        return response.json()
+
+    async def submit(self, workflow: Dict[str, Any]):
+        """Queue workflow on ComfyUI; return (prompt_id, event queue)."""
+        await asyncio.wait_for(self.connected.wait(), timeout=30)
+        prompt_id = uuid.uuid4().hex
+        queue = self.subscribe(prompt_id)
+        response = await self.client.post(
+            "/prompt", json={"prompt": workflow, "client_id": self.client_id, "prompt_id": prompt_id}
+        )
+        if response.status_code != 200:
+            self.unsubscribe(prompt_id)
+            try:
+                detail = response.json()
+            except ValueError:
+                detail = response.text
+            raise RunError(response.status_code, detail)
+        actual = response.json().get("prompt_id", prompt_id)
+        if actual != prompt_id:
+            # ComfyUI versions that ignore a client-chosen prompt_id
+            self.unsubscribe(prompt_id)
+            queue = self.subscribe(actual)
+        self.runs += 1
+        return actual, queue
+
+    async def follow(self, queue: asyncio.Queue, timeout: float):
+        """Yield (kind, data) events for one prompt up to and including the terminal one."""
+        deadline = asyncio.get_running_loop().time() + timeout
+        while True:
+            remaining = deadline - asyncio.get_running_loop().time()
+            kind, data = await asyncio.wait_for(queue.get(), timeout=max(remaining, 0))
+            yield kind, data
+            if is_terminal_event(kind, data):
+                return
+
+
 @app.function(
     image=image,
     volumes={"/storage": volume},
     timeout=1200,   # 20 minutes, adjust as needed
 )
-def putfile(url: str, filename: str, subdir: str = "text_encoders"):
-    """Download a file into one of the allowed model subdirectories."""
-    import os, requests
+def putfile(
+    url: str,
+    filename: str,
+    subdir: Union[str, List[str]] = "text_encoders",
+    sha256: Optional[str] = None,
+    refresh: bool = False,
+    flush: bool = False,
+):
+    """Download a file into one or more of the allowed model subdirectories.
 
-    allowed_dirs = ["unet", "lora", "text_encoders", "vae", "diffusion_models"]
-    if subdir not in allowed_dirs:
-        raise ValueError(f"Invalid subdir: {subdir}. Choose one of {allowed_dirs}")
+    The content is stored once in the volume's blob store and linked into each
+    subdir; a known ``sha256`` (or a previously downloaded url) skips the network.
+    ``refresh=True`` downloads a previously seen url again, for links whose
+    content has changed.
+    The volume commit is debounced so back-to-back calls share one; pass
+    ``flush=True`` when other containers must see the file as soon as the call
+    returns (the UI does, it lists the subdir straight after).
+    """
+    import requests
+    from backends.model_catalog import ModelCatalog
+    from backends.model_store import ModelStore
+    from backends.volume_commits import scheduler_for
 
-    full_dir = f"/storage/models/{subdir}"
-    os.makedirs(full_dir, exist_ok=True)
+    allowed_dirs = ["unet", "lora", "text_encoders", "vae", "diffusion_models"]
+    subdirs = [subdir] if isinstance(subdir, str) else list(subdir)
+    invalid = [s for s in subdirs if s not in allowed_dirs]
+    if not subdirs or invalid:
+        raise ValueError(f"Invalid subdir: {invalid or subdir}. Choose one of {allowed_dirs}")
 
     try:
-        r = requests.get(url, stream=True, timeout=60)
-        r.raise_for_status()
-        with open(f"{full_dir}/{filename}", "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+        result = ModelStore(catalog=ModelCatalog()).ingest(url, filename, subdirs, sha256=sha256, refresh=refresh)
+        if result["cached"]:
+            logger.info(f"{filename} already stored as {result['sha256']}, linked into {subdirs}")
+        else:
+            logger.info(f"Downloaded {filename} ({result['size']} bytes) at {result['throughput'] / 1e6:.1f} MB/s")
     except requests.Timeout as e:
         logger.error(f"Timeout while downloading {url}: {e}")
         raise RuntimeError(f"Download timed out for {url}") from e
@@ -62,7 +502,11 @@ def putfile(url: str, filename: str, subdir: str = "text_encoders"):
         logger.error(f"Failed to download {url}: {e}")
         raise
     else:
-        volume.commit()
+        commits = scheduler_for(volume)
+        commits.mark_dirty(0 if result["cached"] else result["size"])
+        if flush:
+            commits.flush()
+        return result
 
 
 @app.function(
@@ -72,20 +516,334 @@ def putfile(url: str, filename: str, subdir: str = "text_encoders"):
 )
 def list_models(subdir: str = "text_encoders"):
     """Return the list of files in a model subdirectory."""
-    import os
-
     allowed_dirs = ["unet", "lora", "text_encoders", "vae", "diffusion_models"]
     if subdir not in allowed_dirs:
         raise ValueError(f"Invalid subdir: {subdir}. Choose one of {allowed_dirs}")
 
-    full_dir = f"/storage/models/{subdir}"
-    os.makedirs(full_dir, exist_ok=True)
-    return sorted(os.listdir(full_dir))
+    result = query_models.local(subdirs=[subdir], limit=None)
+    return [item["name"] for item in result["items"]]
+
+
+# Parsed catalog kept warm between calls in the same container
+_catalog = None
+
+
+@app.function(
+    image=image,
+    volumes={"/storage": volume},
+    timeout=300,
+    scaledown_window=300,
+)
+def query_models(
+    subdirs: Optional[List[str]] = None,
+    search: Optional[str] = None,
+    offset: int = 0,
+    limit: Optional[int] = 100,
+    rebuild: bool = False,
+):
+    """Query the model catalog across subdirs with name filtering and pagination.
+
+    Returns {"total": int, "items": [{name, subdir, size, mtime, sha256}, ...]}.
+    Pass rebuild=True after copying files onto the volume by other means.
+    """
+    global _catalog
+    from backends.model_catalog import ModelCatalog
+    from backends.volume_commits import scheduler_for
+
+    if _catalog is None:
+        _catalog = ModelCatalog()
+    volume.reload()
+    if rebuild or _catalog.needs_compaction():
+        if rebuild:
+            _catalog.rebuild()
+        else:
+            _catalog.compact()
+        # Compaction rewrites the same entries, so it can wait for the debounced
+        # commit; a rebuild is asked for because other containers are out of date
+        commits = scheduler_for(volume)
+        commits.mark_dirty()
+        if rebuild:
+            commits.flush()
+    return _catalog.query(subdirs=subdirs, search=search, offset=offset, limit=limit)
+
+
+def create_proxy_app(comfyui_url: str = COMFYUI_URL, offloader=None):
+    """Build the FastAPI app that fronts the ComfyUI server at comfyui_url.
+
+    Kept outside the Modal class so the proxy can also be served locally, for
+    example against a stand-in ComfyUI by scripts/local/proxy_benchmark.py.
+    With an OutputOffloader, finished outputs are pushed to R2 and /run answers
+    carry presigned URLs next to the /view ones.
+    """
+    from fastapi import FastAPI, Request, WebSocket, Response
+    from fastapi.responses import JSONResponse, StreamingResponse
+    from starlette.background import BackgroundTask
+    import httpx, websockets
+    from backends.comfy_proxy import forwardable_headers
+
+    web_app = FastAPI()
+    client = httpx.AsyncClient(base_url=comfyui_url, timeout=300.0)
+    ws_url = comfyui_url.replace("http", "ws", 1) + "/ws"
+    cache = ResponseCache()
+    tracker = PromptTracker(client, ws_url)
+
+    async def watch_storage():
+        fingerprint = await asyncio.to_thread(proxy_cache_fingerprint)
+        while True:
+            await asyncio.sleep(CUSTOM_NODES_POLL_INTERVAL)
+            current = await asyncio.to_thread(proxy_cache_fingerprint)
+            if current != fingerprint:
+                logger.info("Custom nodes or models changed, invalidating proxy cache")
+                cache.invalidate()
+                fingerprint = current
+
+    @web_app.on_event("startup")
+    async def startup_event():
+        web_app.state.cache_watcher = asyncio.create_task(watch_storage())
+        tracker.start()
+        if offloader is not None:
+            web_app.state.offload_watcher = asyncio.create_task(offloader.watch(comfyui_url))
+
+    @web_app.on_event("shutdown")
+    async def shutdown_event():
+        web_app.state.cache_watcher.cancel()
+        if offloader is not None:
+            web_app.state.offload_watcher.cancel()
+        await tracker.stop()
+        await client.aclose()
+
+    @web_app.get("/proxy/cache")
+    async def cache_stats():
+        return cache.stats()
+
+    @web_app.delete("/proxy/cache")
+    async def clear_cache():
+        cache.invalidate()
+        return cache.stats()
+
+    @web_app.websocket("/ws")
+    async def websocket_proxy(websocket: WebSocket):
+        await websocket.accept()
+        uri = ws_url
+        # clientId routes executed/progress messages to this browser session
+        if websocket.url.query:
+            uri += f"?{websocket.url.query}"
+        outbound = OutboundFrames()
+        try:
+            async with websockets.connect(uri, max_size=WS_MAX_FRAME_BYTES) as comfyui_ws:
+                async def forward_to_comfyui():
+                    while True:
+                        message = await websocket.receive()
+                        if message["type"] == "websocket.disconnect":
+                            return
+                        if message.get("bytes") is not None:
+                            await comfyui_ws.send(message["bytes"])
+                        elif message.get("text") is not None:
+                            await comfyui_ws.send(message["text"])
+
+                async def read_from_comfyui():
+                    try:
+                        async for frame in comfyui_ws:
+                            await outbound.put(frame)
+                    finally:
+                        # Let forward_to_client deliver what is still queued
+                        await outbound.close()
+
+                async def forward_to_client():
+                    while True:
+                        frame = await outbound.get()
+                        if frame is None:
+                            return
+                        if isinstance(frame, str):
+                            await websocket.send_text(frame)
+                        else:
+                            await websocket.send_bytes(frame)
+
+                reader = asyncio.create_task(read_from_comfyui())
+                tasks = {
+                    asyncio.create_task(forward_to_comfyui()),
+                    asyncio.create_task(forward_to_client()),
+                }
+                # Upstream closing ends the session only once the queue is
+                # drained: the client leaving or the last frame being sent
+                # is what stops the relay
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                pending.add(reader)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                for task in done | {reader}:
+                    if task.cancelled():
+                        continue
+                    exc = task.exception()
+                    if exc and not isinstance(exc, websockets.exceptions.ConnectionClosed):
+                        logger.debug(f"WebSocket forwarding stopped: {exc!r}")
+        except Exception as e:
+            logger.error(f"WebSocket error: {e}")
+        finally:
+            if outbound.dropped_previews:
+                logger.debug(f"Dropped {outbound.dropped_previews} superseded preview frames")
+            try:
+                await websocket.close()
+            except RuntimeError:
+                # Already closed by the client
+                pass
+
+    async def load_upstream(url: str) -> CachedResponse:
+        response = await client.get(url)
+        # The body is stored decoded, so encoding/length headers no longer apply
+        headers = forwardable_headers(response.headers, drop={"content-encoding", "content-length"})
+        etag = response.headers.get("etag") or f'"{hashlib.sha1(response.content).hexdigest()}"'
+        headers["etag"] = etag
+        return CachedResponse(response.status_code, headers, response.content, etag)
+
+    async def cached_get(request: Request, url: str) -> Response:
+        entry, hit = await cache.fetch(url, lambda: load_upstream(url))
+        cache_status = "HIT" if hit else "MISS"
+        if entry.status_code == 200 and etag_matches(request.headers.get("if-none-match"), entry.etag):
+            cache.not_modified += 1
+            return Response(status_code=304, headers={"etag": entry.etag, "x-proxy-cache": cache_status})
+        return Response(
+            content=entry.body,
+            status_code=entry.status_code,
+            headers={**entry.headers, "x-proxy-cache": cache_status},
+        )
+
+    # Run an API-format workflow and answer once it has finished: either the
+    # workflow itself or {"prompt": workflow} as the body. Outputs come back as
+    # /view URLs on this proxy, or base64-encoded with ?inline=true.
+
+    def read_workflow(body: Dict[str, Any]) -> Dict[str, Any]:
+        return body["prompt"] if isinstance(body.get("prompt"), dict) else body
+
+    async def run_outputs(prompt_id: str, inline: bool) -> List[Dict[str, Any]]:
+        outputs = (await tracker.history(prompt_id)).get(prompt_id, {}).get("outputs", {})
+        files = output_files(outputs)
+        if offloader is not None:
+            try:
+                # Shares the upload with the history watcher if it got there first
+                record = offloader.with_urls(await offloader.offload(prompt_id, outputs))
+            except Exception as e:
+                # The /view URLs still work; R2 links are a bonus
+                logger.warning(f"Offloading outputs of {prompt_id} failed: {e!r}")
+                record = {"files": []}
+            r2_urls = {(f["subfolder"], f["filename"]): f["url"] for f in record["files"] if "url" in f}
+            for file in files:
+                if (file["subfolder"], file["filename"]) in r2_urls:
+                    file["r2_url"] = r2_urls[(file["subfolder"], file["filename"])]
+        if inline:
+            async def embed(record):
+                response = await client.get(record["url"])
+                response.raise_for_status()
+                record["content_type"] = response.headers.get("content-type")
+                record["data"] = base64.b64encode(response.content).decode()
+
+            await asyncio.gather(*(embed(record) for record in files))
+        return files
+
+    @web_app.get("/outputs/{prompt_id}")
+    async def offloaded_outputs(prompt_id: str):
+        """Presigned R2 URLs for a prompt's outputs, once they have been offloaded."""
+        record = await offloader.urls(prompt_id) if offloader is not None else None
+        if record is None:
+            return JSONResponse(status_code=404, content={"error": "No offloaded outputs for this prompt"})
+        return record
+
+    @web_app.post("/run")
+    async def run_workflow(request: Request, timeout: float = RUN_TIMEOUT, inline: bool = False):
+        t0 = time.perf_counter()
+        try:
+            prompt_id, queue = await tracker.submit(read_workflow(await request.json()))
+        except RunError as e:
+            return JSONResponse(status_code=e.status_code, content={"error": e.detail})
+        try:
+            async for kind, data in tracker.follow(queue, timeout):
+                pass
+        except asyncio.TimeoutError:
+            return JSONResponse(status_code=504, content={"prompt_id": prompt_id, "error": "timed out"})
+        finally:
+            tracker.unsubscribe(prompt_id)
+        if kind != "execution_success" and kind != "executing":
+            return JSONResponse(status_code=500, content={"prompt_id": prompt_id, "status": kind, "error": data})
+        return {
+            "prompt_id": prompt_id,
+            "outputs": await run_outputs(prompt_id, inline),
+            "seconds": round(time.perf_counter() - t0, 3),
+        }
+
+    @web_app.post("/run/stream")
+    async def run_workflow_stream(request: Request, timeout: float = RUN_TIMEOUT, inline: bool = False):
+        """Like /run, answered as server-sent events while the prompt executes."""
+        try:
+            prompt_id, queue = await tracker.submit(read_workflow(await request.json()))
+        except RunError as e:
+            return JSONResponse(status_code=e.status_code, content={"error": e.detail})
+
+        def event(kind: str, data: Any) -> str:
+            return f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+
+        async def events():
+            try:
+                yield event("queued", {"prompt_id": prompt_id})
+                async for kind, data in tracker.follow(queue, timeout):
+                    if kind == "executed":
+                        data = {**data, "files": output_files({data.get("node"): data.get("output") or {}})}
+                    if not is_terminal_event(kind, data):
+                        yield event(kind, data)
+                    elif kind in ("execution_success", "executing"):
+                        yield event("done", {"prompt_id": prompt_id, "outputs": await run_outputs(prompt_id, inline)})
+                    else:
+                        yield event("error", {"prompt_id": prompt_id, "status": kind, "error": data})
+            except asyncio.TimeoutError:
+                yield event("error", {"prompt_id": prompt_id, "error": "timed out"})
+            finally:
+                tracker.unsubscribe(prompt_id)
+
+        return StreamingResponse(
+            events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @web_app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH"])
+    async def proxy_request(request: Request, path: str):
+        url = f"/{path}"
+        if request.url.query:
+            url += f"?{request.url.query}"
+
+        if (
+            request.method == "GET"
+            and "range" not in request.headers
+            and is_cacheable_route(request.url.path)
+        ):
+            return await cached_get(request, url)
+
+        # Only stream a request body when the client actually sent one, so plain
+        # GETs are not turned into chunked uploads.
+        has_body = "content-length" in request.headers or "transfer-encoding" in request.headers
+        upstream_request = client.build_request(
+            method=request.method,
+            url=url,
+            headers=forwardable_headers(request.headers, drop={"host"}),
+            content=request.stream() if has_body else None,
+        )
+        response = await client.send(upstream_request, stream=True)
+        # Raw bytes keep the upstream Content-Encoding/Content-Length valid
+        return StreamingResponse(
+            response.aiter_raw(),
+            status_code=response.status_code,
+            headers=forwardable_headers(response.headers),
+            background=BackgroundTask(response.aclose),
+        )
+
+    return web_app
+
 
 @app.cls(
     image=image,
     gpu="A100",
     volumes={"/storage": volume},
+    secrets=offload_secrets,
     timeout=86400,
     container_idle_timeout=3600,
     allow_concurrent_inputs=100,
@@ -93,112 +851,55 @@ def list_models(subdir: str = "text_encoders"):
 class ComfyUIServer:
     def __init__(self):
         self.process = None
+        self.prefetch_thread = None
         self.setup_complete = False
 
     @modal.enter()
-    def setup(self):
-        os.makedirs("/storage/models", exist_ok=True)
-        os.makedirs("/storage/custom_nodes", exist_ok=True)
-        os.makedirs("/storage/output", exist_ok=True)
-        os.makedirs("/storage/input", exist_ok=True)
-        os.chdir("/root/ComfyUI")
-        for folder in ["models", "custom_nodes", "output", "input"]:
-            if os.path.exists(folder):
-                subprocess.run(["rm", "-rf", folder], check=False)
-            os.symlink(f"/storage/{folder}", folder)
+    async def setup(self):
+        from backends.comfy_proxy import BOOT_FOLDERS, LAUNCH_FOLDERS, link_storage_folders, wait_for_comfyui
+        from backends.model_prefetch import start_prefetch
+
+        t0 = time.perf_counter()
+        # Pull the hot model files into the page cache while ComfyUI boots;
+        # it logs its own per-file report and never holds up readiness
+        self.prefetch_thread = start_prefetch()
+        # Custom nodes are imported at launch; the other folders are linked
+        # while ComfyUI boots, before any request can reach them
+        await link_storage_folders(LAUNCH_FOLDERS, comfyui_dir=COMFYUI_DIR)
         self.process = subprocess.Popen([
             "python", "main.py",
             "--disable-security",
             "--listen", "127.0.0.1",
             "--port", "8188",
             "--preview-method", "auto"
-        ])
-        import urllib.request
-        for i in range(60):
-            try:
-                with urllib.request.urlopen("http://127.0.0.1:8188/") as response:
-                    if response.status == 200:
-                        self.setup_complete = True
-                        break
-            except Exception:
-                time.sleep(1)
-        if not self.setup_complete:
-            raise Exception("ComfyUI failed to start within 60 seconds")
+        ], cwd=COMFYUI_DIR)
+        linking = asyncio.ensure_future(link_storage_folders(BOOT_FOLDERS, comfyui_dir=COMFYUI_DIR))
+        try:
+            waited = await wait_for_comfyui(self.process, COMFYUI_URL)
+        finally:
+            await linking
+        self.setup_complete = True
+        logger.info(f"ComfyUI ready in {time.perf_counter() - t0:.2f}s ({waited:.2f}s waiting on the server)")
 
     @modal.exit()
-    def cleanup(self):
+    async def cleanup(self):
+        from backends.model_prefetch import remember_usage
+
         if self.process:
+            try:
+                # ComfyUI's history dies with the process; keep which models it loaded
+                await remember_usage(COMFYUI_URL)
+                await volume.commit.aio()
+            except Exception as e:
+                logger.warning(f"Could not record model usage: {e!r}")
             self.process.terminate()
             self.process.wait()
 
     @modal.asgi_app()
     def asgi_app(self):
-        from fastapi import FastAPI, Request, WebSocket, Response
-        import httpx, websockets, asyncio
-
-        web_app = FastAPI()
-        client = httpx.AsyncClient(base_url="http://127.0.0.1:8188", timeout=300.0)
-
-        @web_app.on_event("shutdown")
-        async def shutdown_event():
-            await client.aclose()
-
-        @web_app.websocket("/ws")
-        async def websocket_proxy(websocket: WebSocket):
-            await websocket.accept()
-            uri = "ws://127.0.0.1:8188/ws"
-            try:
-                async with websockets.connect(uri) as comfyui_ws:
-                    async def forward_to_comfyui():
-                        try:
-                            while True:
-                                data = await websocket.receive_text()
-                                await comfyui_ws.send(data)
-                        except websockets.exceptions.ConnectionClosed:
-                            pass
-
-                    async def forward_to_client():
-                        try:
-                            while True:
-                                data = await comfyui_ws.recv()
-                                await websocket.send_text(data)
-                        except websockets.exceptions.ConnectionClosed:
-                            pass
-
-                    task_to_comfyui = asyncio.create_task(forward_to_comfyui())
-                    task_to_client = asyncio.create_task(forward_to_client())
-                    done, pending = await asyncio.wait(
-                        {task_to_comfyui, task_to_client},
-                        return_when=asyncio.FIRST_COMPLETED,
-                    )
-                    for task in pending:
-                        task.cancel()
-                    await asyncio.gather(*pending, return_exceptions=True)
-            except Exception as e:
-                logger.error(f"WebSocket error: {e}")
-            finally:
-                await websocket.close()
+        from backends.output_offload import output_offloader
 
-        @web_app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH"])
-        async def proxy_request(request: Request, path: str):
-            url = f"/{path}"
-            if request.url.query:
-                url += f"?{request.url.query}"
-            body = await request.body()
-            response = await client.request(
-                method=request.method,
-                url=url,
-                headers={k: v for k, v in request.headers.items() if k.lower() not in ["host", "connection", "content-length"]},
-                content=body if body else None,
-            )
-            return Response(
-                content=response.content,
-                status_code=response.status_code,
-                headers=dict(response.headers),
-                media_type=response.headers.get("content-type", "application/octet-stream")
-            )
-
-        return web_app
+        return create_proxy_app(offloader=output_offloader(output_records))
 
 @app.local_entrypoint()
 def main():
@@ -14,9 +14,9 @@
 # ## Import dependencies and set up paths
 
 # We start by importing the necessary libraries and defining our storage paths.
-# We use Modal Volumes for caching model artifacts and Modal CloudBucketMounts for
-# storing generated images. For more on storing model weights on Modal, see
-# [this guide](https://modal.com/docs/guide/model-weights).
+# We use Modal Volumes for caching model artifacts; generated images are encoded in
+# memory and uploaded straight to R2 with boto3. For more on storing model weights
+# on Modal, see [this guide](https://modal.com/docs/guide/model-weights).
 
 from __future__ import annotations
 
@@ -24,13 +24,100 @@ from pathlib import Path
 
 import modal
 
+# Shared helpers (volume commit scheduler, ...) live in the repo's backends package
+BACKENDS_DIR = Path(__file__).resolve().parent.parent.parent / "backends"
+
 # Container mount directories
 CONTAINER_CACHE_DIR = Path("/cache")
-CONTAINER_CLOUD_MOUNT_DIR = Path("/outputs")
 
 # Modal volume for caching compiled model artifacts and other caches across container restarts to reduce cold start times.
 CONTAINER_CACHE_VOLUME = modal.Volume.from_name("hf-hub-cache", create_if_missing=True)
 
+MODEL_ID = "black-forest-labs/FLUX.1-dev"
+# First block cache threshold; it changes the output pixels, so it is part of
+# the result cache fingerprint
+RESIDUAL_DIFF_THRESHOLD = 0.12
+
+# Seeded requests always run in a pipeline call of their own, so their uploaded
+# images can be served again instead of re-running the pipeline. Entries older
+# than the age limit are ignored; keep the bucket's object lifecycle longer
+# than this.
+RESULT_CACHE_DIR = CONTAINER_CACHE_DIR / ".result_cache"
+RESULT_CACHE_MAX_AGE = 7 * 86400  # 7 days
+RESULT_CACHE_MAX_ENTRIES = 100_000
+
+# Text encoder outputs for recently used prompts. A T5 embedding is ~4 MB in
+# bf16; entries pushed out of GPU memory are parked on the CPU first.
+PROMPT_CACHE_GPU_ENTRIES = 128
+PROMPT_CACHE_CPU_ENTRIES = 1024
+
+# Concurrent requests with compatible settings that arrive within this window
+# are denoised together in one batched pipeline call
+BATCH_WINDOW_SECONDS = 0.025
+MAX_BATCH_IMAGES = 4
+MAX_CONCURRENT_INPUTS = 16
+
+# (height, width, batch) shapes compiled at container start. A request outside
+# these shapes can trigger a recompile in the serving path, and the batcher never
+# grows a batch past the largest batch warmed for its resolution.
+WARMUP_PLAN = [
+    (1024, 1024, 1),
+    (1024, 1024, 2),
+    (1024, 1024, 3),
+    (1024, 1024, 4),
+    (1024, 768, 1),
+    (768, 1024, 1),
+    (768, 768, 1),
+    (512, 512, 1),
+]
+# Resize requests to the nearest warmed (height, width) instead of compiling
+# for a new shape
+SNAP_TO_WARMED_BUCKETS = False
+
+# Linear map from the 16 FLUX latent channels to RGB, used for cheap
+# low-resolution previews while streaming (no VAE decode)
+FLUX_LATENT_RGB_FACTORS = [
+    [-0.0346, 0.0244, 0.0681],
+    [0.0034, 0.0210, 0.0687],
+    [0.0275, -0.0668, -0.0433],
+    [-0.0174, 0.0160, 0.0617],
+    [0.0859, 0.0721, 0.0329],
+    [0.0004, 0.0383, 0.0115],
+    [0.0405, 0.0861, 0.0915],
+    [-0.0236, -0.0185, -0.0259],
+    [-0.0245, 0.0250, 0.1180],
+    [0.1008, 0.0755, -0.0421],
+    [-0.0515, 0.0201, 0.0011],
+    [0.0428, -0.0012, -0.0036],
+    [0.0817, 0.0765, 0.0749],
+    [-0.1264, -0.0522, -0.1103],
+    [-0.0280, -0.0881, -0.0499],
+    [-0.1262, -0.0982, -0.0778],
+]
+FLUX_LATENT_RGB_BIAS = [-0.0329, -0.0718, -0.0851]
+PREVIEW_JPEG_QUALITY = 70
+
+# Inductor settings applied before compiling; part of the mega-cache fingerprint
+INDUCTOR_CONFIG = {
+    "conv_1x1_as_mm": True,
+    "coordinate_descent_check_all_directions": True,
+    "coordinate_descent_tuning": True,
+    "disable_progress": False,
+    "epilogue_fusion": False,
+    "shape_padding": True,
+}
+COMPILE_MODE = "max-autotune-no-cudagraphs"
+# Bump to invalidate every saved mega-cache after a change the fingerprint
+# can't see
+MEGA_CACHE_VERSION = 1
+
+# Upper bounds (seconds) of the latency histogram buckets on /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Threads shared by all requests for encoding images and uploading them to R2
+UPLOAD_WORKERS = 16
+PRESIGNED_URL_EXPIRY = 86400  # 24 hours
+
 # Configure your Cloudflare R2 bucket details here for image storage
 CLOUD_BUCKET_ACCOUNT_ID = "4aa30f66ab0905858439168cc51561d1"
 CLOUD_BUCKET_NAME = "modalflux"
@@ -75,7 +162,7 @@ flux_endpoint_image = nvidia_cuda_image.pip_install(
         "TORCHINDUCTOR_CACHE_DIR": str(CONTAINER_CACHE_DIR / ".inductor_cache"),
         "TRITON_CACHE_DIR": str(CONTAINER_CACHE_DIR / ".triton_cache"),
     }
-)
+).add_local_dir(BACKENDS_DIR, remote_path="/root/backends")
 
 # ## Creating the Modal app
 
@@ -85,19 +172,31 @@ flux_endpoint_image = nvidia_cuda_image.pip_install(
 app = modal.App("flux_endpoint", image=flux_endpoint_image)
 
 with flux_endpoint_image.imports():
+    import base64
+    import bisect
     import concurrent.futures
+    import contextlib
+    import hashlib
+    import json
     import os
+    import queue
+    import threading
     import time
     import uuid
+    from collections import Counter, OrderedDict, deque
     from enum import Enum
-    from typing import Optional
+    from typing import Callable, Iterable, List, Optional, Tuple
 
     import boto3
+    import diffusers
+    from fastapi.responses import PlainTextResponse, StreamingResponse
     import cv2
-    import numpy as np
+    from botocore.config import Config as BotoConfig
     import torch
     from diffusers import FluxPipeline
+    from torch._dynamo.utils import counters as dynamo_counters
     from para_attn.first_block_cache.diffusers_adapters import apply_cache_on_pipe
+    from backends.volume_commits import scheduler_for
     from pydantic import BaseModel, Field
 
     # Supported output formats for generated images
@@ -106,6 +205,12 @@ with flux_endpoint_image.imports():
         JPG = "JPG"
         WEBP = "WEBP"
 
+    CONTENT_TYPES = {
+        OutputFormat.PNG: "image/png",
+        OutputFormat.JPG: "image/jpeg",
+        OutputFormat.WEBP: "image/webp",
+    }
+
     # ### Defining request/response model
 
     # We use Pydantic to define a strongly-typed request model. This gives us
@@ -126,6 +231,415 @@ with flux_endpoint_image.imports():
         output_format: OutputFormat = Field(default=OutputFormat.PNG)
         output_quality: int = Field(default=90, ge=1, le=100)
 
+# ## Latency metrics
+
+# Stage timings are kept as cumulative histograms and rendered in the
+# Prometheus text format, together with how long each cold-start phase took.
+# Stages: `queue_wait`, `prompt_encode`, `denoise_step`, `vae_decode`,
+# `postprocess`, `image_encode`, `upload` and the end-to-end `request`.
+
+
+class StageMetrics:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # stage -> per-bucket counts (last slot is +Inf), sum of seconds
+        self._counts = {}
+        self._sums = {}
+        self.cold_start = {}
+
+    def observe(self, stage: str, seconds: float):
+        slot = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            counts = self._counts.setdefault(stage, [0] * (len(self.buckets) + 1))
+            counts[slot] += 1
+            self._sums[stage] = self._sums.get(stage, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def timed(self, stage: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Record how long a cold-start phase took."""
+        print(f"cold start: {name}")
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.cold_start[name] = time.perf_counter() - t0
+            print(f"cold start: {name} took {self.cold_start[name]:.2f}s")
+
+    def render(self) -> str:
+        lines = [
+            "# HELP flux_stage_seconds Time spent per request stage.",
+            "# TYPE flux_stage_seconds histogram",
+        ]
+        with self._lock:
+            for stage in sorted(self._counts):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), self._counts[stage]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'flux_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'flux_stage_seconds_sum{{stage="{stage}"}} {self._sums[stage]}')
+                lines.append(f'flux_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+        lines += [
+            "# HELP flux_cold_start_seconds Duration of each container start phase.",
+            "# TYPE flux_cold_start_seconds gauge",
+        ]
+        for name, seconds in self.cold_start.items():
+            lines.append(f'flux_cold_start_seconds{{phase="{name}"}} {seconds}')
+        return "\n".join(lines) + "\n"
+
+# ## Shape buckets
+
+# With `SNAP_TO_WARMED_BUCKETS` enabled, a request is moved to the warmed
+# resolution closest to the one it asked for.
+
+
+def nearest_bucket(height: int, width: int, shapes: Iterable[Tuple[int, int, int]]) -> Tuple[int, int]:
+    return min(
+        {(h, w) for h, w, _ in shapes},
+        key=lambda hw: ((hw[0] - height) ** 2 + (hw[1] - width) ** 2, hw),
+    )
+
+# ## Dynamic micro-batching
+
+# Separate users sending requests at the same time can share a single denoising
+# pass as long as everything that shapes the latents and the scheduler matches.
+# The batcher runs on its own thread: endpoint threads submit a request and
+# block on a future while the batcher collects compatible requests for up to
+# `BATCH_WINDOW_SECONDS`, then runs them as one pipeline call.
+
+# Requests with an explicit `seed` are never batched with anything else. The
+# first block cache decides whether to skip a step over the whole batch, and
+# kernel choice and numerics change with batch size, so a seeded image's pixels
+# would otherwise depend on whatever it happened to share a call with.
+
+
+def batch_key(request) -> tuple:
+    """Requests with equal keys can be denoised in the same pipeline call."""
+    true_cfg = request.true_cfg_scale > 1 and request.negative_prompt is not None
+    return (
+        request.height,
+        request.width,
+        request.steps,
+        request.guidance_scale,
+        request.true_cfg_scale if true_cfg else None,
+    )
+
+
+class PendingRequest:
+    def __init__(self, request, events: Optional["queue.Queue"] = None, preview_every: int = 0):
+        self.request = request
+        self.future = concurrent.futures.Future()
+        self.enqueued_at = time.perf_counter()
+        # Streaming requests get (kind, payload) progress events on this queue
+        self.events = events
+        self.preview_every = preview_every
+
+
+class RequestBatcher:
+    def __init__(
+        self,
+        run_batch: Callable[[List["PendingRequest"]], List[list]],
+        window: float = BATCH_WINDOW_SECONDS,
+        max_images: int = MAX_BATCH_IMAGES,
+        warmed_shapes: Optional[Iterable[Tuple[int, int, int]]] = None,
+    ):
+        self.run_batch = run_batch
+        self.window = window
+        self.max_images = max_images
+        # (height, width) -> largest warmed batch; batches stay within it so
+        # batching never compiles a new shape on the serving path
+        self.warmed_batch = None
+        if warmed_shapes is not None:
+            self.warmed_batch = {}
+            for height, width, batch in warmed_shapes:
+                self.warmed_batch[height, width] = max(batch, self.warmed_batch.get((height, width), 0))
+        self._queue = queue.Queue()
+        # Requests pulled while filling a batch they didn't fit in
+        self._deferred = deque()
+        self.batch_sizes = Counter()  # images per pipeline call -> count
+        self.batch_requests = Counter()  # requests per pipeline call -> count
+        self._thread = threading.Thread(target=self._loop, name="flux-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, request, events=None, preview_every: int = 0) -> "concurrent.futures.Future":
+        pending = PendingRequest(request, events, preview_every)
+        self._queue.put(pending)
+        return pending.future
+
+    def batch_limit(self, request) -> int:
+        if self.warmed_batch is None:
+            return self.max_images
+        return min(self.max_images, self.warmed_batch.get((request.height, request.width), 1))
+
+    def _collect(self) -> List["PendingRequest"]:
+        first = self._deferred.popleft() if self._deferred else self._queue.get()
+        if first.request.seed is not None:
+            return [first]
+        key = batch_key(first.request)
+        limit = self.batch_limit(first.request)
+        batch, images = [first], first.request.num_images
+
+        def fits(item):
+            return (
+                item.request.seed is None
+                and batch_key(item.request) == key
+                and images + item.request.num_images <= limit
+            )
+
+        for item in list(self._deferred):
+            if fits(item):
+                self._deferred.remove(item)
+                batch.append(item)
+                images += item.request.num_images
+
+        deadline = time.monotonic() + self.window
+        while images < limit:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if fits(item):
+                batch.append(item)
+                images += item.request.num_images
+            else:
+                self._deferred.append(item)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            images = sum(p.request.num_images for p in batch)
+            self.batch_sizes[images] += 1
+            self.batch_requests[len(batch)] += 1
+            try:
+                results = self.run_batch(batch)
+            except Exception as e:
+                for pending in batch:
+                    pending.future.set_exception(e)
+                continue
+            for pending, result in zip(batch, results):
+                pending.future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "images_per_batch": dict(sorted(self.batch_sizes.items())),
+            "requests_per_batch": dict(sorted(self.batch_requests.items())),
+            "queued": self._queue.qsize() + len(self._deferred),
+        }
+
+# ## Result cache for seeded requests
+
+# A request with an explicit `seed` runs alone (see the batcher), so for a given
+# model and set of optimizations it renders the same image every time. The
+# object keys of its first upload are remembered on the cache volume, and a
+# repeat request only needs fresh presigned URLs. The key hashes every request
+# field together with a fingerprint of everything else that affects the output.
+
+# Lookups read the entry file directly, so the in-memory index (creation times
+# for eviction) is only needed for housekeeping. Listing up to
+# `RESULT_CACHE_MAX_ENTRIES` files on the volume is slow, so it is rebuilt on a
+# background thread and container start does not wait for it.
+
+
+class ResultCache:
+    def __init__(
+        self,
+        root: Path,
+        fingerprint: dict,
+        max_age: float = RESULT_CACHE_MAX_AGE,
+        max_entries: int = RESULT_CACHE_MAX_ENTRIES,
+    ):
+        self.root = root
+        self.fingerprint = json.dumps(fingerprint, sort_keys=True)
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # key -> created timestamp, oldest first
+        self._entries = OrderedDict()
+        self.indexed = False
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._scanner = threading.Thread(target=self._scan, name="result-cache-scan", daemon=True)
+        self._scanner.start()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.json"
+
+    def _scan(self):
+        t0 = time.perf_counter()
+        found = {}
+        try:
+            for path in self.root.glob("*/*.json"):
+                try:
+                    found[path.stem] = path.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+        except Exception as e:
+            print(f"error indexing result cache: {e}")
+            return
+        with self._lock:
+            # Entries put while scanning are newer than what is on disk
+            found.update(self._entries)
+            self._entries = OrderedDict(sorted(found.items(), key=lambda item: item[1]))
+            self.indexed = True
+            self._evict()
+        print(f"indexed {len(found)} result cache entries in {time.perf_counter() - t0:.1f}s")
+
+    def key(self, request) -> Optional[str]:
+        """Canonical cache key, or None for unseeded (non-deterministic) requests."""
+        if request.seed is None:
+            return None
+        fields = json.dumps(request.model_dump(mode="json"), sort_keys=True)
+        return hashlib.sha256(f"{self.fingerprint}\n{fields}".encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        """Return the stored object keys for key, if present and fresh."""
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            entry = None
+        with self._lock:
+            if entry is not None and time.time() - entry["created"] <= self.max_age:
+                self.hits += 1
+                return entry["object_keys"]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, object_keys: List[str]):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        created = time.time()
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"created": created, "object_keys": object_keys}, f)
+        os.replace(tmp, path)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = created
+            self._evict()
+        scheduler_for(CONTAINER_CACHE_VOLUME).mark_dirty(path.stat().st_size)
+
+    def _evict(self):
+        # Only the index entries go; uploaded objects may still be referenced
+        # by outstanding presigned URLs and are left to the bucket lifecycle
+        cutoff = time.time() - self.max_age
+        while self._entries:
+            key, created = next(iter(self._entries.items()))
+            if created >= cutoff and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[key]
+            self.evictions += 1
+            try:
+                self._path(key).unlink()
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "indexed": self.indexed,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+# ## Prompt embedding cache
+
+# Production traffic repeats prompts and negative prompts heavily, and each
+# repeat would otherwise re-run CLIP and T5. Embeddings are keyed by the exact
+# `(prompt, prompt_2)` strings and kept in a two-level LRU: hot entries stay on
+# the GPU, older ones are moved to CPU memory before being dropped.
+
+
+class PromptEmbeddingCache:
+    def __init__(
+        self,
+        encode: Callable[[str, str], tuple],
+        gpu_entries: int = PROMPT_CACHE_GPU_ENTRIES,
+        cpu_entries: int = PROMPT_CACHE_CPU_ENTRIES,
+        device: str = "cuda",
+    ):
+        self.encode = encode
+        self.gpu_entries = gpu_entries
+        self.cpu_entries = cpu_entries
+        self.device = device
+        self._gpu = OrderedDict()
+        self._cpu = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.cpu_hits = 0
+        self.misses = 0
+        self.encode_seconds = 0.0
+
+    def get(self, prompt: str, prompt_2: str) -> tuple:
+        """Return (prompt_embeds, pooled_prompt_embeds) on the GPU for one prompt."""
+        key = (prompt, prompt_2)
+        with self._lock:
+            if key in self._gpu:
+                self._gpu.move_to_end(key)
+                self.hits += 1
+                return self._gpu[key]
+            parked = self._cpu.pop(key, None)
+        if parked is not None:
+            embeds = tuple(t.to(self.device, non_blocking=True) for t in parked)
+            with self._lock:
+                self.hits += 1
+                self.cpu_hits += 1
+        else:
+            t0 = time.perf_counter()
+            with torch.no_grad():
+                embeds = self.encode(prompt, prompt_2)
+            torch.cuda.synchronize()
+            with self._lock:
+                self.misses += 1
+                self.encode_seconds += time.perf_counter() - t0
+        self._insert(key, embeds)
+        return embeds
+
+    def _insert(self, key, embeds):
+        with self._lock:
+            self._gpu[key] = embeds
+            while len(self._gpu) > self.gpu_entries:
+                old_key, old = self._gpu.popitem(last=False)
+                if self.cpu_entries > 0:
+                    self._cpu[old_key] = tuple(t.to("cpu") for t in old)
+            while len(self._cpu) > self.cpu_entries:
+                self._cpu.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            mean_encode = self.encode_seconds / self.misses if self.misses else 0.0
+            return {
+                "gpu_entries": len(self._gpu),
+                "cpu_entries": len(self._cpu),
+                "hits": self.hits,
+                "cpu_hits": self.cpu_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "encode_seconds": self.encode_seconds,
+                # estimated from the mean cost of a miss
+                "saved_encode_seconds": self.hits * mean_encode,
+            }
+
 # ## The FluxService class
 
 # This class handles model loading, optimization, and inference. We use Modal's
@@ -141,23 +655,15 @@ with flux_endpoint_image.imports():
         ),
     ],
     gpu="H100",
-    volumes={
-        CONTAINER_CACHE_DIR: CONTAINER_CACHE_VOLUME,
-        CONTAINER_CLOUD_MOUNT_DIR: modal.CloudBucketMount(
-            bucket_name=CLOUD_BUCKET_NAME,
-            bucket_endpoint_url=f"https://{CLOUD_BUCKET_ACCOUNT_ID}.r2.cloudflarestorage.com",
-            secret=modal.Secret.from_name(
-                "cloudflare-storage",
-                required_keys=["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"],
-            ),
-        ),
-    },
+    volumes={CONTAINER_CACHE_DIR: CONTAINER_CACHE_VOLUME},
     min_containers=1,
     buffer_containers=0,
     scaledown_window=300,  # 5 minutes
     timeout=3600,  # 1 hour
     enable_memory_snapshot=True,
 )
+# Concurrent inputs are what gives the batcher something to batch
+@modal.concurrent(max_inputs=MAX_CONCURRENT_INPUTS)
 class FluxService:
     # ## Model optimization methods
 
@@ -168,7 +674,7 @@ class FluxService:
         # apply first block cache, see: [ParaAttention](https://github.com/chengzeyi/ParaAttention)
         apply_cache_on_pipe(
             self.pipe,
-            residual_diff_threshold=0.12,  # don't recommend going higher
+            residual_diff_threshold=RESIDUAL_DIFF_THRESHOLD,  # don't recommend going higher
         )
 
         # fuse qkv projections
@@ -180,21 +686,16 @@ class FluxService:
         self.pipe.vae.to(memory_format=torch.channels_last)
 
         # torch compile configs
-        config = torch._inductor.config
-        config.conv_1x1_as_mm = True
-        config.coordinate_descent_check_all_directions = True
-        config.coordinate_descent_tuning = True
-        config.disable_progress = False
-        config.epilogue_fusion = False
-        config.shape_padding = True
+        for name, value in INDUCTOR_CONFIG.items():
+            setattr(torch._inductor.config, name, value)
 
         # mark layers for compilation with dynamic shapes enabled
         self.pipe.transformer = torch.compile(
-            self.pipe.transformer, mode="max-autotune-no-cudagraphs", dynamic=True
+            self.pipe.transformer, mode=COMPILE_MODE, dynamic=True
         )
 
         self.pipe.vae.decode = torch.compile(
-            self.pipe.vae.decode, mode="max-autotune-no-cudagraphs", dynamic=True
+            self.pipe.vae.decode, mode=COMPILE_MODE, dynamic=True
         )
 
     def _compile(self):
@@ -216,43 +717,138 @@ class FluxService:
 
             post_grad.same_meta = _safe_same_meta
 
-        print("triggering torch compile")
-        self.pipe("dummy prompt", height=1024, width=1024, num_images_per_prompt=1)
-
-        # comment this out if you only need num_images_per_prompt=1
-        print("recompiling for dynamic batch size")
-        self.pipe("dummy prompt", height=1024, width=1024, num_images_per_prompt=2)
+        # Run every bucket of the warmup plan once, so compilation (or loading
+        # it from the mega-cache) happens here rather than on a user request.
+        # Every step runs the same graphs, so two steps compile everything a
+        # full request would
+        self.warmup_report = []
+        for height, width, batch in WARMUP_PLAN:
+            print(f"warming up {height}x{width}, batch {batch}")
+            torch.cuda.synchronize()
+            t0 = time.perf_counter()
+            self.pipe(
+                "dummy prompt", height=height, width=width, num_images_per_prompt=batch, num_inference_steps=2
+            )
+            torch.cuda.synchronize()
+            seconds = time.perf_counter() - t0
+            self.warmup_report.append({
+                "height": height,
+                "width": width,
+                "batch": batch,
+                "seconds": round(seconds, 3),
+                "in_mega_cache": (height, width, batch) in self.cached_shapes,
+            })
+            print(f"warmed {height}x{width}, batch {batch} in {seconds:.1f}s")
+        self.warmed_shapes = {tuple(shape) for shape in WARMUP_PLAN}
+
+        # Graphs compiled after this point are recompiles in the serving path
+        self.recompilations = 0
+        self.cold_shapes = Counter()
 
     # ## Mega-cache management
 
     # PyTorch "mega-cache" serializes compiled model artifacts into a blob that
     # can be easily transferred to another machine with the same GPU.
 
+    # Artifacts are only valid for the exact torch build, GPU, inductor config
+    # and set of compiled shapes that produced them, so each combination gets
+    # its own directory named after a fingerprint of all of these. A manifest
+    # next to the blob records its digest and warmed shapes; both files are
+    # written to a temp file and renamed into place, so a reader never sees a
+    # half-written cache.
+
+    def _mega_cache_fingerprint(self) -> dict:
+        return {
+            "version": MEGA_CACHE_VERSION,
+            "model": MODEL_ID,
+            "torch": torch.__version__,
+            "cuda": torch.version.cuda,
+            "gpu": torch.cuda.get_device_name(),
+            "diffusers": diffusers.__version__,
+            "residual_diff_threshold": RESIDUAL_DIFF_THRESHOLD,
+            "inductor_config": INDUCTOR_CONFIG,
+            "compile_mode": COMPILE_MODE,
+            "warmup_plan": sorted(WARMUP_PLAN),
+        }
+
     def _load_mega_cache(self):
         print("loading torch mega-cache")
-        try:
-            if self.mega_cache_bin_path.exists():
-                with open(self.mega_cache_bin_path, "rb") as f:
-                    artifact_bytes = f.read()
+        fingerprint = self._mega_cache_fingerprint()
+        digest = hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()[:16]
+        cache_dir = self.mega_cache_dir / f"v{MEGA_CACHE_VERSION}" / digest
+        self.mega_cache_bin_path = cache_dir / "flux_torch_mega"
+        self.mega_cache_manifest_path = cache_dir / "manifest.json"
+        self.mega_cache_report = {"fingerprint": digest, "status": "miss", "load_seconds": 0.0, "bytes": 0}
+        # Shapes whose compiled artifacts the saved mega-cache should contain
+        self.cached_shapes = set()
+        self.mega_cache_manifest = {}
 
-                if artifact_bytes:
-                    torch.compiler.load_cache_artifacts(artifact_bytes)
-            else:
-                print("torch mega cache not found, regenerating...")
+        t0 = time.perf_counter()
+        try:
+            with open(self.mega_cache_manifest_path) as f:
+                manifest = json.load(f)
+            with open(self.mega_cache_bin_path, "rb") as f:
+                artifact_bytes = f.read()
+            if hashlib.sha256(artifact_bytes).hexdigest() != manifest["sha256"]:
+                raise ValueError("artifact digest does not match the manifest")
+            torch.compiler.load_cache_artifacts(artifact_bytes)
+        except FileNotFoundError:
+            print(f"torch mega cache {digest} not found, regenerating...")
         except Exception as e:
+            self.mega_cache_report["status"] = "error"
             print(f"error loading torch mega-cache: {e}")
+        else:
+            self.mega_cache_manifest = manifest
+            self.cached_shapes = {tuple(shape) for shape in manifest["shapes"]}
+            self.mega_cache_report.update(status="hit", bytes=len(artifact_bytes))
+        self.mega_cache_report["load_seconds"] = round(time.perf_counter() - t0, 3)
+        print(f"torch mega-cache {digest}: {self.mega_cache_report['status']} "
+              f"in {self.mega_cache_report['load_seconds']:.2f}s")
+        self._fxgraph_misses_before = dynamo_counters["inductor"]["fxgraph_cache_miss"]
 
     def _save_mega_cache(self):
+        shapes = sorted(self.warmed_shapes)
+        # Nothing was compiled from scratch during warmup: the loaded cache
+        # already holds every artifact, so skip serializing it again
+        compiled = dynamo_counters["inductor"]["fxgraph_cache_miss"] - self._fxgraph_misses_before
+        if self.mega_cache_report["status"] == "hit" and not compiled:
+            self.mega_cache_report["saved"] = False
+            print("torch mega-cache unchanged, not saving")
+            return
+
         print("saving torch mega-cache")
         try:
             artifacts = torch.compiler.save_cache_artifacts()
             artifact_bytes, _ = artifacts
-
-            with open(self.mega_cache_bin_path, "wb") as f:
+            digest = hashlib.sha256(artifact_bytes).hexdigest()
+            if digest == self.mega_cache_manifest.get("sha256"):
+                self.mega_cache_report["saved"] = False
+                print("torch mega-cache unchanged, not saving")
+                return
+
+            self.mega_cache_bin_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.mega_cache_bin_path.with_suffix(".tmp")
+            with open(tmp, "wb") as f:
                 f.write(artifact_bytes)
-
-            # persist changes to volume
-            CONTAINER_CACHE_VOLUME.commit()
+            os.replace(tmp, self.mega_cache_bin_path)
+            # The manifest goes last: it is what marks the blob as complete
+            manifest = {
+                "sha256": digest,
+                "bytes": len(artifact_bytes),
+                "shapes": [list(shape) for shape in shapes],
+                "fingerprint": self._mega_cache_fingerprint(),
+                "created": time.time(),
+            }
+            tmp = self.mega_cache_manifest_path.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp, self.mega_cache_manifest_path)
+            self.mega_cache_manifest = manifest
+            self.mega_cache_report["saved"] = True
+
+            # the debounced commit persists it, or the exit hook if the
+            # container scales down first
+            scheduler_for(CONTAINER_CACHE_VOLUME).mark_dirty(len(artifact_bytes))
         except Exception as e:
             print(f"error saving torch mega-cache: {e}")
 
@@ -263,26 +859,33 @@ class FluxService:
 
     @modal.enter(snap=True)
     def load(self):
+        self.stage_metrics = StageMetrics()
         print("downloading (if necessary) and loading model")
-        self.pipe = FluxPipeline.from_pretrained(
-            "black-forest-labs/FLUX.1-dev",
-            torch_dtype=torch.bfloat16,
-            use_safetensors=True,
-        ).to("cpu")
-
-        # Set up mega cache paths
-        mega_cache_dir = CONTAINER_CACHE_DIR / ".mega_cache"
-        mega_cache_dir.mkdir(parents=True, exist_ok=True)
-        self.mega_cache_bin_path = mega_cache_dir / "flux_torch_mega"
+        with self.stage_metrics.phase("load_weights"):
+            self.pipe = FluxPipeline.from_pretrained(
+                MODEL_ID,
+                torch_dtype=torch.bfloat16,
+                use_safetensors=True,
+            ).to("cpu")
+
+        # Set up the mega cache root; the per-fingerprint paths need the GPU
+        # and are resolved in setup()
+        self.mega_cache_dir = CONTAINER_CACHE_DIR / ".mega_cache"
+        self.mega_cache_dir.mkdir(parents=True, exist_ok=True)
 
     @modal.enter(snap=False)
     def setup(self):
-        self.pipe.to("cuda")
-
-        self._load_mega_cache()
-        self._optimize()
-        self._compile()
-        self._save_mega_cache()
+        with self.stage_metrics.phase("move_to_gpu"):
+            self.pipe.to("cuda")
+
+        with self.stage_metrics.phase("load_mega_cache"):
+            self._load_mega_cache()
+        with self.stage_metrics.phase("optimize"):
+            self._optimize()
+        with self.stage_metrics.phase("warmup"):
+            self._compile()
+        with self.stage_metrics.phase("save_mega_cache"):
+            self._save_mega_cache()
 
         # Initialize S3 client for R2 storage
         try:
@@ -292,88 +895,342 @@ class FluxService:
                 aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
                 aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
                 region_name="auto",
+                # one pooled connection per upload thread
+                config=BotoConfig(max_pool_connections=UPLOAD_WORKERS),
             )
         except Exception as e:
             print(f"Error initiating s3 client: {e}")
             raise
 
-    # ## The main inference endpoint
+        # Long-lived so requests don't pay for thread startup, and so uploads
+        # from concurrent requests share one bounded pool
+        self.upload_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=UPLOAD_WORKERS, thread_name_prefix="flux-upload"
+        )
+        self.prompt_cache = PromptEmbeddingCache(self._encode_prompt)
+        self.latent_rgb_factors = torch.tensor(FLUX_LATENT_RGB_FACTORS, device="cuda")
+        self.latent_rgb_bias = torch.tensor(FLUX_LATENT_RGB_BIAS, device="cuda")
+        self.batcher = RequestBatcher(self._run_batch, warmed_shapes=self.warmed_shapes)
+        self.result_cache = ResultCache(
+            RESULT_CACHE_DIR,
+            fingerprint={
+                "model": MODEL_ID,
+                "residual_diff_threshold": RESIDUAL_DIFF_THRESHOLD,
+                "diffusers": diffusers.__version__,
+                "torch": torch.__version__,
+                "gpu": torch.cuda.get_device_name(),
+            },
+        )
 
-    # This method handles incoming requests, generates images, and uploads them
-    # to cloud storage.
+    @modal.exit()
+    def shutdown(self):
+        # Result cache entries and the mega-cache are committed in batches
+        # while serving; don't leave the last batch to the atexit hook
+        scheduler_for(CONTAINER_CACHE_VOLUME).flush()
 
-    @modal.fastapi_endpoint(method="POST")
-    def inference(self, request: InferenceRequest):
-        generator = (
-            torch.Generator("cuda").manual_seed(request.seed)
-            if request.seed is not None
-            else None
+    def _encode_prompt(self, prompt: str, prompt_2: str) -> tuple:
+        prompt_embeds, pooled_prompt_embeds, _ = self.pipe.encode_prompt(
+            prompt=prompt, prompt_2=prompt_2, device="cuda", num_images_per_prompt=1
         )
+        return prompt_embeds, pooled_prompt_embeds
+
+    # ## Batched pipeline call
+
+    # Each image gets its own generator: image `i` of a request with `seed`
+    # uses `seed + i`. Seeded requests arrive here alone, since the first block
+    # cache and the kernels make the output depend on the batch. Prompt
+    # embeddings come from the prompt cache and are repeated per image, which
+    # lets requests with different `num_images` share one call.
+
+    def _run_batch(self, batch):
+        started = time.perf_counter()
+        for pending in batch:
+            self.stage_metrics.observe("queue_wait", started - pending.enqueued_at)
+
+        first = batch[0].request
+        true_cfg = batch_key(first)[-1] is not None
+        embeds, pooled, negative_embeds, negative_pooled, generators = [], [], [], [], []
+        for pending in batch:
+            request = pending.request
+            prompt_embeds, pooled_prompt_embeds = self.prompt_cache.get(
+                request.prompt, request.prompt2 or request.prompt
+            )
+            embeds.append(prompt_embeds.expand(request.num_images, -1, -1))
+            pooled.append(pooled_prompt_embeds.expand(request.num_images, -1))
+            if true_cfg:
+                prompt_embeds, pooled_prompt_embeds = self.prompt_cache.get(
+                    request.negative_prompt, request.negative_prompt2 or request.negative_prompt
+                )
+                negative_embeds.append(prompt_embeds.expand(request.num_images, -1, -1))
+                negative_pooled.append(pooled_prompt_embeds.expand(request.num_images, -1))
+            for i in range(request.num_images):
+                generator = torch.Generator("cuda")
+                if request.seed is not None:
+                    generator.manual_seed(request.seed + i)
+                else:
+                    generator.seed()
+                generators.append(generator)
+        self.stage_metrics.observe("prompt_encode", time.perf_counter() - started)
+
+        shape = (first.height, first.width, len(generators))
+        if shape not in self.warmed_shapes:
+            self.cold_shapes[shape] += 1
+        graphs_before = dynamo_counters["stats"]["unique_graphs"]
 
-        # Time the inference
         torch.cuda.synchronize()
         t0 = time.perf_counter()
+        step_ends = [t0]
+
+        # Synchronizing per step costs a little overlap but makes the step
+        # times real GPU times rather than kernel launch times
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            torch.cuda.synchronize()
+            now = time.perf_counter()
+            self.stage_metrics.observe("denoise_step", now - step_ends[-1])
+            step_ends.append(now)
+            self._publish_progress(batch, step + 1, callback_kwargs["latents"])
+            return callback_kwargs
 
-        # Generate images using the FLUX pipeline
         images = self.pipe(
-            prompt=request.prompt,
-            prompt_2=request.prompt2,
-            negative_prompt=request.negative_prompt,
-            negative_prompt_2=request.negative_prompt2,
-            true_cfg_scale=request.true_cfg_scale,
-            height=request.height,
-            width=request.width,
-            num_inference_steps=request.steps,
-            guidance_scale=request.guidance_scale,
-            num_images_per_prompt=request.num_images,
-            generator=generator,
-            output_type="np",
+            prompt_embeds=torch.cat(embeds),
+            pooled_prompt_embeds=torch.cat(pooled),
+            negative_prompt_embeds=torch.cat(negative_embeds) if true_cfg else None,
+            negative_pooled_prompt_embeds=torch.cat(negative_pooled) if true_cfg else None,
+            true_cfg_scale=first.true_cfg_scale,
+            height=first.height,
+            width=first.width,
+            num_inference_steps=first.steps,
+            guidance_scale=first.guidance_scale,
+            num_images_per_prompt=1,
+            generator=generators,
+            output_type="pt",
+            callback_on_step_end=on_step_end,
         ).images
-
         torch.cuda.synchronize()
-        print(f"inference time: {time.perf_counter() - t0:.2f}s")
-        t1 = time.perf_counter()
+        decoded = time.perf_counter()
+        self.stage_metrics.observe("vae_decode", decoded - step_ends[-1])
+        # Quantize to uint8 and reorder to HWC BGR for OpenCV on the GPU, so
+        # only a quarter of the bytes cross to the host and the encode threads
+        # get arrays they can use as-is
+        images = (images.float() * 255).to(torch.uint8).permute(0, 2, 3, 1).flip(-1).cpu().numpy()
+        self.stage_metrics.observe("postprocess", time.perf_counter() - decoded)
+        print(f"inference time: {time.perf_counter() - t0:.2f}s ({len(batch)} requests, {len(generators)} images)")
+        if dynamo_counters["stats"]["unique_graphs"] > graphs_before:
+            self.recompilations += 1
+            print(f"recompiled for {shape[0]}x{shape[1]}, batch {shape[2]} while serving")
+
+        # Split the batch back into per-request image lists
+        results, offset = [], 0
+        for pending in batch:
+            results.append(images[offset : offset + pending.request.num_images])
+            offset += pending.request.num_images
+        return results
+
+    # ## Streaming progress
+
+    # Streaming requests get a `step` event after every denoising step and,
+    # every `preview_every` steps, a preview made by projecting their slice of
+    # the latents to RGB with a fixed linear map. That is a few small matmuls,
+    # so previews cost nothing like a VAE decode.
+
+    def _publish_progress(self, batch, step: int, latents):
+        first = batch[0].request
+        offset = 0
+        for pending in batch:
+            n = pending.request.num_images
+            if pending.events is not None:
+                pending.events.put(("step", {"step": step, "steps": first.steps}))
+                if pending.preview_every and (step % pending.preview_every == 0 or step == first.steps):
+                    previews = self._latent_previews(latents[offset : offset + n], first.height, first.width)
+                    pending.events.put(("preview", {"step": step, "images": previews}))
+            offset += n
+
+    def _latent_previews(self, latents, height: int, width: int):
+        """RGB uint8 arrays at 1/8 resolution from packed FLUX latents."""
+        latents = FluxPipeline._unpack_latents(latents, height, width, self.pipe.vae_scale_factor)
+        rgb = torch.einsum("bchw,cr->bhwr", latents.float(), self.latent_rgb_factors) + self.latent_rgb_bias
+        return ((rgb.clamp(-1, 1) + 1) * 127.5).to(torch.uint8).cpu().numpy()
+
+    # ## Encoding and uploading images
+
+    # Images are encoded in memory and sent to R2 with `put_object`, skipping
+    # the round trip through a bucket mount. Every image is its own task on the
+    # shared upload pool, so its object key is ready as soon as its upload lands.
+
+    def _encode_and_upload(self, image_bgr, output_format, output_quality) -> str:
+        """Encode one image, upload it and return its object key."""
+        match output_format:
+            case OutputFormat.JPG:
+                params = [cv2.IMWRITE_JPEG_QUALITY, output_quality]
+            case OutputFormat.WEBP:
+                params = [cv2.IMWRITE_WEBP_QUALITY, output_quality]
+            case _:
+                params = []
+
+        ext = output_format.value.lower()
+        with self.stage_metrics.timed("image_encode"):
+            ok, encoded = cv2.imencode(f".{ext}", image_bgr, params)
+        if not ok:
+            raise RuntimeError(f"failed to encode image as {output_format.value}")
+
+        key = f"{uuid.uuid4()}.{ext}"
+        with self.stage_metrics.timed("upload"):
+            self.s3_client.put_object(
+                Bucket=CLOUD_BUCKET_NAME,
+                Key=key,
+                Body=encoded.tobytes(),
+                ContentType=CONTENT_TYPES[output_format],
+            )
+        return key
+
+    def _presign(self, key: str) -> str:
+        # Generate a signed URL for the uploaded image
+        # This allows clients to download the image directly from R2
+        return self.s3_client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": CLOUD_BUCKET_NAME, "Key": key},
+            ExpiresIn=PRESIGNED_URL_EXPIRY,
+        )
 
-        # Process and upload images to cloud storage
-        image_urls = []
-        CONTAINER_CLOUD_MOUNT_DIR.mkdir(parents=True, exist_ok=True)
-
-        # image processing
-        def process_image(image):
-            # Generate unique filename
-            filename = str(uuid.uuid4())
-            filename_with_ext = f"{filename}.{request.output_format.value.lower()}"
-            output_path = CONTAINER_CLOUD_MOUNT_DIR / filename_with_ext
-
-            # Convert to uint8 and BGR format for OpenCV
-            image_np = (image * 255).astype(np.uint8)
-            image_bgr = cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR)
-
-            # Set encoding parameters based on format
-            match request.output_format:
-                case OutputFormat.JPG:
-                    params = [cv2.IMWRITE_JPEG_QUALITY, request.output_quality]
-                case OutputFormat.WEBP:
-                    params = [cv2.IMWRITE_WEBP_QUALITY, request.output_quality]
-                case _:
-                    params = []
-
-            # Save image using OpenCV
-            cv2.imwrite(str(output_path), image_bgr, params)
-
-            # Generate a signed URL for the uploaded image
-            # This allows clients to download the image directly from R2
-            signed_url = self.s3_client.generate_presigned_url(
-                "get_object",
-                Params={"Bucket": CLOUD_BUCKET_NAME, "Key": filename_with_ext},
-                ExpiresIn=86400,  # 24 hour expiry
+    def _submit_uploads(self, images, request) -> List["concurrent.futures.Future"]:
+        """Queue every image for upload; each future resolves to its object key."""
+        return [
+            self.upload_pool.submit(
+                self._encode_and_upload, image, request.output_format, request.output_quality
             )
-            return signed_url
+            for image in images
+        ]
 
-        # process images in parallel
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            image_urls = list(executor.map(process_image, images))
+    # ## The main inference endpoint
 
-        torch.cuda.synchronize()
-        print(f"image processing and cloud save time: {time.perf_counter() - t1:.2f}s")
-        return image_urls
+    # This method handles incoming requests, generates images, and uploads them
+    # to cloud storage.
+
+    @modal.fastapi_endpoint(method="POST")
+    def inference(self, request: InferenceRequest):
+        with self.stage_metrics.timed("request"):
+            return self._inference(request)
+
+    def _snap(self, request):
+        if SNAP_TO_WARMED_BUCKETS:
+            height, width = nearest_bucket(request.height, request.width, self.warmed_shapes)
+            request = request.model_copy(update={"height": height, "width": width})
+        return request
+
+    def _inference(self, request):
+        request = self._snap(request)
+
+        # Seeded requests seen before only need new signed URLs
+        cache_key = self.result_cache.key(request)
+        if cache_key is not None:
+            object_keys = self.result_cache.get(cache_key)
+            if object_keys is not None:
+                return [self._presign(key) for key in object_keys]
+
+        # Generate images, possibly batched with other concurrent requests
+        images = self.batcher.submit(request).result()
+        t1 = time.perf_counter()
+
+        object_keys = [future.result() for future in self._submit_uploads(images, request)]
+        if cache_key is not None:
+            self.result_cache.put(cache_key, object_keys)
+
+        print(f"image encode and upload time: {time.perf_counter() - t1:.2f}s")
+        return [self._presign(key) for key in object_keys]
+
+    @modal.fastapi_endpoint(method="GET")
+    def batch_stats(self):
+        """Histogram of pipeline batch sizes seen by this container."""
+        return self.batcher.stats()
+
+    # ## Streaming endpoint
+
+    # Same request body as `inference`, answered as server-sent events:
+    # `step` after every denoising step, optional `preview` images, an `image`
+    # event carrying each URL as soon as that image's upload completes, and a
+    # final `done` (or `error`). GPU work is identical to the blocking endpoint.
+
+    @modal.fastapi_endpoint(method="POST")
+    def inference_stream(self, request: InferenceRequest, preview_every: int = 0):
+        request = self._snap(request)
+        return StreamingResponse(
+            self._stream_events(request, preview_every),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    def _stream_events(self, request, preview_every: int):
+        def event(kind: str, data) -> str:
+            return f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+
+        cache_key = self.result_cache.key(request)
+        object_keys = self.result_cache.get(cache_key) if cache_key is not None else None
+        if object_keys is not None:
+            urls = [self._presign(key) for key in object_keys]
+            for index, url in enumerate(urls):
+                yield event("image", {"index": index, "url": url})
+            yield event("done", {"urls": urls, "cached": True})
+            return
+
+        events = queue.Queue()
+        future = self.batcher.submit(request, events=events, preview_every=max(0, preview_every))
+        future.add_done_callback(lambda _: events.put(("generated", None)))
+        yield event("queued", {"steps": request.steps, "num_images": request.num_images})
+        while True:
+            kind, payload = events.get()
+            if kind == "generated":
+                break
+            if kind == "preview":
+                images = []
+                for preview in payload["images"]:
+                    _, jpeg = cv2.imencode(
+                        ".jpg", cv2.cvtColor(preview, cv2.COLOR_RGB2BGR),
+                        [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_JPEG_QUALITY],
+                    )
+                    images.append("data:image/jpeg;base64," + base64.b64encode(jpeg.tobytes()).decode())
+                payload = {"step": payload["step"], "images": images}
+            yield event(kind, payload)
+
+        try:
+            images = future.result()
+            uploads = self._submit_uploads(images, request)
+            object_keys, urls = [None] * len(uploads), [None] * len(uploads)
+            index_of = {upload: index for index, upload in enumerate(uploads)}
+            for upload in concurrent.futures.as_completed(uploads):
+                index = index_of[upload]
+                object_keys[index] = upload.result()
+                urls[index] = self._presign(object_keys[index])
+                yield event("image", {"index": index, "url": urls[index]})
+        except Exception as e:
+            yield event("error", {"detail": str(e)})
+            return
+
+        if cache_key is not None:
+            self.result_cache.put(cache_key, object_keys)
+        yield event("done", {"urls": urls, "cached": False})
+
+    @modal.fastapi_endpoint(method="GET")
+    def metrics(self):
+        """Stage latency histograms and cold-start phases in Prometheus text format."""
+        return PlainTextResponse(self.stage_metrics.render(), media_type="text/plain; version=0.0.4")
+
+    @modal.fastapi_endpoint(method="GET")
+    def compile_stats(self):
+        """Warmup timings per bucket and recompiles seen while serving."""
+        return {
+            "mega_cache": self.mega_cache_report,
+            "warmup": self.warmup_report,
+            "recompilations": self.recompilations,
+            "unwarmed_shapes": [
+                {"height": h, "width": w, "batch": b, "requests": n}
+                for (h, w, b), n in sorted(self.cold_shapes.items())
+            ],
+        }
+
+    @modal.fastapi_endpoint(method="GET")
+    def cache_stats(self):
+        """Hit rates of this container's caches."""
+        return {
+            "results": self.result_cache.stats(),
+            "prompt_embeddings": self.prompt_cache.stats(),
+        }
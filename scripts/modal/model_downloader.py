@@ -1,6 +1,7 @@
 from modal import App, Volume, Image
 import subprocess
 import os
+from pathlib import Path
 from typing import List, Tuple
 
 app = App(name="bulk-file-downloader")
@@ -9,7 +10,12 @@ app = App(name="bulk-file-downloader")
 volume = Volume.persisted("my-persistent-volume")
 
 # Base image with download tools
-image = Image.debian_slim().apt_install("wget", "curl")
+image = (
+    Image.debian_slim()
+    .apt_install("wget", "curl")
+    # Shared helpers (commit scheduler, ...) from the repo's backends package
+    .add_local_dir(Path(__file__).resolve().parent.parent.parent / "backends", remote_path="/root/backends")
+)
 
 @app.function(
     image=image,
@@ -17,7 +23,9 @@ image = Image.debian_slim().apt_install("wget", "curl")
     timeout=3600,
 )
 def download_single_file(url: str, filename: str, subfolder: str = "") -> dict:
-    """Download a single file to the volume"""
+    """Download a single file to the volume; the commit is debounced, batch callers flush once at the end"""
+    from backends.volume_commits import scheduler_for
+
     try:
         # Create subfolder if specified
         if subfolder:
@@ -43,6 +51,7 @@ def download_single_file(url: str, filename: str, subfolder: str = "") -> dict:
         # Get file size
         file_size = os.path.getsize(filepath)
         print(f"Downloaded {filename} ({file_size} bytes) to {filepath}")
+        scheduler_for(volume).mark_dirty(file_size)
         
         return {
             "status": "success", 
@@ -65,6 +74,8 @@ def download_single_file(url: str, filename: str, subfolder: str = "") -> dict:
 )
 def download_files_sequential(file_list: List[Tuple[str, str]], subfolder: str = "") -> List[dict]:
     """Download multiple files sequentially in a single container"""
+    from backends.volume_commits import scheduler_for
+
     results = []
     
     for url, filename in file_list:
@@ -72,8 +83,8 @@ def download_files_sequential(file_list: List[Tuple[str, str]], subfolder: str =
         results.append(result)
     
     # Commit volume after all downloads
-    volume.commit()
-    print(f"Completed downloading {len(file_list)} files")
+    scheduler_for(volume).flush()
+    print(f"Completed downloading {len(file_list)} files ({scheduler_for(volume).stats()['saved']} commits saved)")
     return results
 
 @app.function(
@@ -83,6 +94,8 @@ def download_files_sequential(file_list: List[Tuple[str, str]], subfolder: str =
 )
 def download_files_parallel_worker(file_batch: List[Tuple[str, str]], subfolder: str = "") -> List[dict]:
     """Worker function for parallel downloading"""
+    from backends.volume_commits import scheduler_for
+
     results = []
     
     for url, filename in file_batch:
@@ -111,6 +124,7 @@ def download_files_parallel_worker(file_batch: List[Tuple[str, str]], subfolder:
             
             file_size = os.path.getsize(filepath)
             print(f"Downloaded {filename} ({file_size} bytes)")
+            scheduler_for(volume).mark_dirty(file_size)
             
             results.append({
                 "status": "success", 
@@ -124,7 +138,7 @@ def download_files_parallel_worker(file_batch: List[Tuple[str, str]], subfolder:
             results.append({"status": "failed", "url": url, "error": str(e)})
     
     # Commit volume after batch
-    volume.commit()
+    scheduler_for(volume).flush()
     return results
 
 def chunk_list(lst: List, chunk_size: int) -> List[List]: